@@ -0,0 +1,67 @@
+"""Compare the pure python and libyaml loaders on a synthetic cluster repo.
+
+Usage: python -m benchmarks.yaml_loading [number of apps]
+"""
+
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import yaml
+
+from gitops.common.utils import SafeLoader
+from gitops.utils import yaml as gitops_yaml
+
+
+def make_deployment(i: int) -> dict:
+    return {
+        "chart": {"type": "git", "git_repo_url": "https://github.com/uptick/workforce", "git_sha": "develop"},
+        "images": {"template": "{account_id}.dkr.ecr.ap-southeast-2.amazonaws.com/uptick:{tag}"},
+        "image-tag": f"qa-server-{i:08x}",
+        "namespace": "workforce",
+        "cluster": f"cluster-{i % 3}",
+        "tags": ["customer", "production", f"group-{i % 10}"],
+        "containers": {
+            "fg": {"replicas": 2, "command": ["gunicorn", "-c", "gunicorn.py"], "cpu": "500m", "memory": "1Gi"},
+            "bg": {"replicas": 1, "command": ["dramatiq", "tasks"], "cpu": "250m", "memory": "512Mi"},
+        },
+        "environment": {f"VARIABLE_{j}": f"value-{i}-{j}" for j in range(60)},
+    }
+
+
+def make_apps_tree(path: Path, n_apps: int) -> list[Path]:
+    files = []
+    for i in range(n_apps):
+        app_path = path / f"app-{i:05}"
+        app_path.mkdir()
+        with open(app_path / "deployment.yml", "w") as f:
+            gitops_yaml.dump(make_deployment(i), f, default_flow_style=False)
+        files.append(app_path / "deployment.yml")
+    return files
+
+
+def load_all(files: list[Path], loader: type) -> tuple[list, float]:
+    start = time.perf_counter()
+    results = []
+    for file in files:
+        with open(file) as f:
+            results.append(yaml.load(f, Loader=loader))  # noqa: S506
+    return results, time.perf_counter() - start
+
+
+def main() -> None:
+    n_apps = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    with tempfile.TemporaryDirectory() as directory:
+        files = make_apps_tree(Path(directory), n_apps)
+        python_results, python_time = load_all(files, yaml.SafeLoader)
+        fast_results, fast_time = load_all(files, SafeLoader)
+
+    assert python_results == fast_results, "Loaders disagree"
+    print(f"Loaded {n_apps} apps")
+    print(f"  pure python: {python_time:.3f}s")
+    print(f"  {SafeLoader.__name__}: {fast_time:.3f}s ({python_time / fast_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
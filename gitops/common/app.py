@@ -1,9 +1,13 @@
+import copy
+import hashlib
 import json
 import os
 from base64 import b64encode
+from collections.abc import Callable
+from functools import cached_property, partial
 from typing import Any
 
-from .utils import load_yaml
+from .utils import ValueInterner, load_yaml
 
 DEPLOYMENT_ATTRIBUTES = [
     "tags",
@@ -16,7 +20,112 @@ DEPLOYMENT_ATTRIBUTES = [
 ]
 
 
+_PENDING = object()
+
+
+class LazyValues(dict):
+    """A dictionary where some values are only computed when first accessed.
+
+    Pending keys are present (so `in`, `len` and iteration behave as usual), but their
+    loader isn't called until the value itself is read. Pickling keeps them pending.
+    """
+
+    def __init__(self, values: dict, loaders: dict[str, Callable[[], Any]]):
+        super().__init__(values)
+        self._loaders = dict(loaders)
+        for key in loaders:
+            super().__setitem__(key, _PENDING)
+
+    def is_pending(self, key: str) -> bool:
+        return key in self._loaders
+
+    def resolve(self, key: str | None = None) -> None:
+        """Compute the value of `key`, or of every pending key."""
+        for pending_key in [key] if key is not None else list(self._loaders):
+            if pending_key in self._loaders:
+                super().__setitem__(pending_key, self._loaders.pop(pending_key)())
+
+    def __getitem__(self, key: Any) -> Any:
+        self.resolve(key)
+        return super().__getitem__(key)
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        self._loaders.pop(key, None)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key: Any) -> None:
+        self._loaders.pop(key, None)
+        super().__delitem__(key)
+
+    def __iter__(self):
+        # Defined so that `dict(values)` and `{**values}` go through `__getitem__`
+        # rather than copying the raw (possibly pending) values.
+        return super().__iter__()
+
+    def __eq__(self, other: object) -> bool:
+        self.resolve()
+        return super().__eq__(other)
+
+    def __ne__(self, other: object) -> bool:
+        return not self == other
+
+    __hash__ = None  # type: ignore[assignment]
+
+    def __repr__(self) -> str:
+        self.resolve()
+        return super().__repr__()
+
+    def __reduce__(self) -> tuple:
+        resolved = {key: value for key, value in super().items() if key not in self._loaders}
+        return (type(self), (resolved, self._loaders))
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        return self[key] if key in self else default
+
+    def items(self):  # type: ignore[override]
+        self.resolve()
+        return super().items()
+
+    def values(self):  # type: ignore[override]
+        self.resolve()
+        return super().values()
+
+    def pop(self, key: Any, *default: Any) -> Any:
+        self.resolve(key)
+        return super().pop(key, *default)
+
+    def popitem(self) -> tuple:
+        self.resolve()
+        return super().popitem()
+
+    def setdefault(self, key: Any, default: Any = None) -> Any:
+        self.resolve(key)
+        return super().setdefault(key, default)
+
+    def copy(self) -> dict:
+        self.resolve()
+        return dict(super().items())
+
+
+def encode_secret_values(secrets: dict, encode: bool) -> dict[str, str]:
+    if not encode:
+        return dict(secrets)
+    return {k: b64encode(str(v).encode()).decode() for k, v in secrets.items()}
+
+
+def load_secrets_file(path: str, encode: bool) -> dict[str, str]:
+    secrets = load_yaml(os.path.join(path, "secrets.yml")).get("secrets") or {}
+    return encode_secret_values(secrets, encode)
+
+
+def format_image(template: str, tag: str, account_id: str | Callable[[], str]) -> str:
+    return template.format(account_id=account_id() if callable(account_id) else account_id, tag=tag)
+
+
 class App:
+    # Worked out from `values` once, and forgotten whenever `values` changes.
+    CACHED_PROPERTIES = ("fingerprint", "image_repository_name", "image_tag", "image_prefix")
+
     def __init__(
         self,
         name: str,
@@ -26,41 +135,84 @@ class App:
         load_secrets: bool = True,
         encode_secrets: bool = True,
         # deprecated
-        account_id: str = "",
+        account_id: str | Callable[[], str] = "",
     ) -> None:
         """
         :params name: The name of the app
         :params path: The path to the app directory
-        :params deployments: The deployments dictionary (injecting for testing)
+        :params deployments: The deployments dictionary (injecting for testing, or preloaded from a cache)
         :params secrets: The secrets dictionary (injecting for testing)
         :params load_secrets: Whether to load the secrets file
         :params encode_secrets: Whether to base64 encode the secrets
+        :params account_id: The account id for the image template, or a function to look it up with
+
+        Secrets are only loaded and encoded when first accessed, and if `account_id` is a
+        function it is only called when the full image is needed.
         """
         self.encode_secrets = encode_secrets
         self.name = name
         self.path = path
         self.account_id = account_id
         if path:
-            deployments = load_yaml(os.path.join(path, "deployment.yml"))
-            if load_secrets:
-                secrets = load_yaml(os.path.join(path, "secrets.yml")).get("secrets", {})
+            if deployments is None:
+                deployments = load_yaml(os.path.join(path, "deployment.yml"))
         deployments = deployments or {}
-        secrets = secrets or {}
-        self.values = self._make_values(deployments, secrets)
+        if path and load_secrets:
+            secrets_loader = partial(load_secrets_file, path, encode_secrets)
+        else:
+            secrets_loader = partial(encode_secret_values, secrets or {}, encode_secrets)
+        self.values = self._make_values(deployments, secrets_loader)
         self.namespace: str = self.values["namespace"]
         self.chart = Chart(self.values["chart"])
 
     def __eq__(self, other: object) -> bool:
+        if self is other:
+            return True
         return (
             type(self) == type(other)  # noqa
             and isinstance(other, App)
             and self.name == other.name
-            and json.dumps(self.values, sort_keys=True) == json.dumps(other.values, sort_keys=True)
+            and self.fingerprint == other.fingerprint
         )
 
+    def __hash__(self) -> int:
+        # Apps used as dict keys or in sets mustn't be changed with `set_value`.
+        return hash((self.name, self.fingerprint))
+
+    @property
+    def values(self) -> LazyValues:
+        return self._values
+
+    @values.setter
+    def values(self, values: LazyValues) -> None:
+        self._values = values
+        self._forget_cached_properties()
+
+    def _forget_cached_properties(self) -> None:
+        for name in self.CACHED_PROPERTIES:
+            self.__dict__.pop(name, None)
+
+    @cached_property
+    def fingerprint(self) -> str:
+        """A digest of the app's values, equal for apps with equal values."""
+        canonical = json.dumps(self.values, sort_keys=True, separators=(",", ":"))
+        return hashlib.blake2b(canonical.encode(), digest_size=16).hexdigest()
+
     def __repr__(self) -> str:
         return f"App(name={self.name}, cluster={self.cluster}, tags={self.tags})"
 
+    def copy(self) -> "App":
+        """A copy of the app whose values can be changed with `set_value` without affecting this one."""
+        app = copy.copy(self)
+        app.values = copy.copy(self.values)
+        return app
+
+    def share_values(self, interner: ValueInterner) -> None:
+        """Replace the loaded values with equal ones shared with other apps through `interner`."""
+        for key in list(self.values):
+            if not self.values.is_pending(key):
+                self.values[key] = interner.intern(self.values[key])
+
     def is_inactive(self) -> bool:
         return "inactive" in self.values.get("tags", [])
 
@@ -70,34 +222,34 @@ class App:
             app.set_value("deployments.label.GITHUB_DEPLOYMENT_KEY", "1")
         """
         keys = path.split(".")
-        current_dict = self.values
+        current_dict: dict = self.values
         for key in keys[:-1]:
-            current_dict = current_dict.setdefault(key, {})
+            # Nested values may be shared with other apps extending the same base file,
+            # so copy them on the way down rather than writing into them.
+            nested_dict = dict(current_dict.get(key) or {})
+            current_dict[key] = nested_dict
+            current_dict = nested_dict
         current_dict[keys[-1]] = value
+        self._forget_cached_properties()
 
-    def _make_values(self, deployments: dict, secrets: dict[str, str]) -> dict:
-        def encode(value: str) -> str:
-            return b64encode(str(value).encode()).decode() if self.encode_secrets else value
-
-        values = {**deployments, "secrets": {**{k: encode(v) for k, v in secrets.items()}}}
+    def _make_values(self, deployments: dict, secrets_loader: Callable[[], dict[str, str]]) -> LazyValues:
+        values = dict(deployments)
+        loaders: dict[str, Callable[[], Any]] = {"secrets": secrets_loader}
 
-        image = self._make_image(deployments)
-        if image:
+        # The image with the account id left as a placeholder. Enough to work out the
+        # repository, tag and prefix without looking the account id up.
+        self._image_reference = ""
+        if "image-tag" in deployments:
+            template, tag = deployments["images"]["template"], deployments["image-tag"]
+            self._image_reference = template.format(account_id="{account_id}", tag=tag)
+            loaders["image"] = partial(format_image, template, tag, self.account_id)
+        elif image := deployments.get("image", ""):
             values["image"] = image
 
         # Don't include the `images` key. It will only cause everything to be
         # redeployed when any group changes.
         values.pop("images", None)
-        return values
-
-    def _make_image(self, deployment_config: dict) -> str:
-        if "image-tag" in deployment_config:
-            return deployment_config["images"]["template"].format(
-                account_id=self.account_id,
-                tag=deployment_config["image-tag"],
-            )
-        else:
-            return deployment_config.get("image", "")
+        return LazyValues(values, loaders)
 
     @property
     def image(self) -> str:
@@ -109,16 +261,22 @@ class App:
             return image
 
     @property
+    def _unresolved_image(self) -> str:
+        if isinstance(self.values, LazyValues) and self.values.is_pending("image"):
+            return self._image_reference
+        return self.image
+
+    @cached_property
     def image_repository_name(self) -> str:
         """305686791668.dkr.ecr.ap-southeast-2.amazonaws.com/[uptick]:yoink-9f03ac80f3"""
-        return self.image.split(":")[0].split("/")[-1]
+        return self._unresolved_image.split(":")[0].split("/")[-1]
 
-    @property
+    @cached_property
     def image_tag(self) -> str:
         """305686791668.dkr.ecr.ap-southeast-2.amazonaws.com/uptick:[yoink-9f03ac80f3]"""
-        return self.image.split(":")[-1]
+        return self._unresolved_image.split(":")[-1]
 
-    @property
+    @cached_property
     def image_prefix(self) -> str:
         """Gets the image prefix portion of {prefix}-{git hash}
         305686791668.dkr.ecr.ap-southeast-2.amazonaws.com/uptick:[yoink]-9f03ac80f3
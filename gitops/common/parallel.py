@@ -0,0 +1,57 @@
+import os
+from collections.abc import Callable, Iterable
+from concurrent.futures import ProcessPoolExecutor
+from typing import TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# Below this many items, starting up worker processes costs more than it saves.
+PARALLEL_THRESHOLD = int(os.environ.get("GITOPS_PARALLEL_LOAD_THRESHOLD", "64"))
+
+
+def get_load_workers() -> int:
+    """Number of processes used to load apps. Defaults to the number of CPUs."""
+    return int(os.environ.get("GITOPS_LOAD_WORKERS", "0")) or os.cpu_count() or 1
+
+
+def parallel_map(
+    fn: Callable[[T], R], items: Iterable[T], workers: int | None = None, threshold: int | None = None
+) -> list[R]:
+    """Map `fn` over `items` using a pool of processes.
+
+    Results are returned in the same order as `items`, and the first exception raised
+    by `fn` (in that order) is re-raised to the caller, just like a plain loop would.
+    `fn` and `items` must be picklable. Small inputs are processed serially.
+    """
+    items = list(items)
+    workers = workers or get_load_workers()
+    threshold = PARALLEL_THRESHOLD if threshold is None else threshold
+    if workers <= 1 or len(items) < max(threshold, 2):
+        return [fn(item) for item in items]
+
+    workers = min(workers, len(items))
+    chunksize = max(1, len(items) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(fn, items, chunksize=chunksize))
+
+
+def parallel_map_chunks(
+    fn: Callable[[list[T]], list[R]], items: Iterable[T], workers: int | None = None, threshold: int | None = None
+) -> list[R]:
+    """Same as `parallel_map`, but `fn` is called with chunks of `items`, returning a result for each item.
+
+    Lets the items of a chunk share work in the worker process that loads them, like
+    parsing the files they have in common (see `extends_cache`).
+    """
+    items = list(items)
+    workers = workers or get_load_workers()
+    threshold = PARALLEL_THRESHOLD if threshold is None else threshold
+    if workers <= 1 or len(items) < max(threshold, 2):
+        return fn(items)
+
+    workers = min(workers, len(items))
+    chunksize = max(1, len(items) // (workers * 4))
+    chunks = [items[i : i + chunksize] for i in range(0, len(items), chunksize)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return [result for chunk in executor.map(fn, chunks) for result in chunk]
@@ -1,34 +1,141 @@
+import hashlib
 import os
+import sys
+from collections.abc import Hashable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import IO, Any
 
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # PyYAML was built without libyaml
+    from yaml import SafeLoader  # type: ignore[assignment]
+
+
+# Files already loaded in the current `extends_cache` block, by absolute path.
+_loaded_files: ContextVar[dict[str, tuple[dict, dict[str, str]]] | None] = ContextVar("_loaded_files", default=None)
+
+
+def safe_load(stream: str | bytes | IO) -> Any:
+    """Same as `yaml.safe_load`, but uses the libyaml parser when it is available."""
+    return yaml.load(stream, Loader=SafeLoader)  # noqa: S506
+
 
 def load_yaml(path: str) -> dict:
-    with open(path) as file:
-        return resolve_values(yaml.safe_load(file), path)
+    return load_yaml_with_dependencies(path)[0]
+
+
+@contextmanager
+def extends_cache() -> Iterator[None]:
+    """Load each yaml file at most once within this block.
+
+    Apps commonly `extends` a handful of shared base files, which would otherwise be
+    parsed again for every app. Values loaded within the block share the parsed
+    base files (see `merge`), so they must not be modified in place.
+    """
+    token = _loaded_files.set({})
+    try:
+        yield
+    finally:
+        _loaded_files.reset(token)
+
+
+def load_yaml_with_dependencies(path: str) -> tuple[dict, list[str]]:
+    """Load a yaml file, resolving `extends`.
+
+    Also returns the list of files the values were built from, starting with
+    `path` itself and followed by its chain of `extends` parents.
+    """
+    values, digests = load_yaml_with_digests(path)
+    return values, list(digests)
 
 
-def resolve_values(values: dict, path: str) -> dict:
+def load_yaml_with_digests(path: str) -> tuple[dict, dict[str, str]]:
+    """Same as `load_yaml_with_dependencies`, but with the sha256 of each file as it was parsed."""
+    loaded_files = _loaded_files.get()
+    if loaded_files is not None and (loaded := loaded_files.get(os.path.abspath(path))):
+        return loaded
+
+    # Parsed from the same bytes that are hashed, so the digests always match the values.
+    with open(path, "rb") as file:
+        content = file.read()
+    values = safe_load(content)
+    digests = {path: hashlib.sha256(content).hexdigest()}
     if "extends" not in values:
-        return values
-    parent_values = load_yaml(os.path.join(os.path.dirname(path), values["extends"]))
-    return deep_merge(parent_values, values)
+        result = values, digests
+    else:
+        parent_values, parent_digests = load_yaml_with_digests(os.path.join(os.path.dirname(path), values["extends"]))
+        result = merge(parent_values, values), {**digests, **parent_digests}
+
+    if loaded_files is not None:
+        loaded_files[os.path.abspath(path)] = result
+    return result
 
 
-def deep_merge(parent: dict, child: dict) -> dict:
-    """Deeply merge two dictionaries.
+def merge(parent: dict, child: dict) -> dict:
+    """Deeply merge `child` into `parent`, returning a new dictionary.
 
-    Dictionary entries will be followed and merged, anything else will be
-    replaced. If the child dictionary has overlapping values. `child` is merged
-    into `parent`. The operation is in-place, but the result is still returned.
+    Dictionary entries are followed and merged, anything else in `child` replaces
+    the value in `parent`. Neither argument is modified.
+    Subtrees that `child` doesn't override are shared with `parent` rather than
+    copied, so the result must be copied before being modified in place.
     """
+    merged = dict(parent)
     for key, value in child.items():
-        parent_value = parent.get(key)
-        if isinstance(parent_value, dict):
-            if isinstance(value, dict):
-                deep_merge(parent_value, value)
-            else:
-                parent[key] = value
+        parent_value = merged.get(key)
+        if isinstance(parent_value, dict) and isinstance(value, dict):
+            merged[key] = merge(parent_value, value)
+        else:
+            merged[key] = value
+    return merged
+
+
+class ValueInterner:
+    """Shares a single instance of equal values between everything interned with it.
+
+    Strings are interned, and equal lists and dictionaries (built from yaml values)
+    are replaced by the first one seen, so apps with large identical subtrees
+    (environments, containers, charts, tags) only keep one copy in memory. Interned
+    values are shared, so like `merge` results they must be copied before being
+    modified in place.
+    """
+
+    def __init__(self) -> None:
+        # The shared instance of each list and dictionary, by its structure.
+        self._values: dict[Hashable, Any] = {}
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def clear(self) -> None:
+        self._values.clear()
+
+    def intern(self, value: Any) -> Any:
+        return self._intern(value)[0]
+
+    def _intern(self, value: Any) -> tuple[Any, Hashable]:
+        """The shared instance of `value`, and a key identifying its structure."""
+        if type(value) is str:
+            value = sys.intern(value)
+            return value, value
+        if type(value) is dict:
+            items = [(self._intern(key), self._intern(item)) for key, item in value.items()]
+            structure: Hashable = (dict, tuple((key[1], item[1]) for key, item in items))
+            if (shared := self._values.get(structure)) is None:
+                shared = self._values[structure] = {key[0]: item[0] for key, item in items}
+        elif type(value) is list:
+            interned = [self._intern(item) for item in value]
+            structure = (list, tuple(item[1] for item in interned))
+            if (shared := self._values.get(structure)) is None:
+                shared = self._values[structure] = [item[0] for item in interned]
         else:
-            parent[key] = value
-    return parent
+            try:
+                hash(value)
+            except TypeError:
+                return value, (id, id(value))
+            # Include the type, as `1`, `1.0` and `True` are equal.
+            return value, (type(value), value)
+        # Shared instances are kept alive by `_values`, so their ids stay unique.
+        return shared, (type(shared), id(shared))
@@ -6,11 +6,11 @@ from invoke import run, task
 
 from .settings import get_apps_directory
 from .utils import config
-from .utils.apps import get_apps, update_app
+from .utils.apps import get_apps, update_app, update_apps
 from .utils.async_runner import run_tasks_async_with_progress
 from .utils.cli import colourise, progress, success, success_negative, warning
 from .utils.exceptions import AppOperationAborted
-from .utils.images import colour_image, get_latest_image
+from .utils.images import colour_image, get_latest_images
 from .utils.kube import run_job
 from .utils.tags import colour_tag, sort_tags
 
@@ -42,6 +42,7 @@ def bump(  # noqa: C901
     push=False,
     redeploy=False,
     skip_migrations=False,
+    refresh=False,
 ):
     """Bump image tag on selected app(s).
     Provide `image_tag` to set to a specific image tag, or provide `prefix` to use latest image
@@ -50,6 +51,9 @@ def bump(  # noqa: C901
     Provide `push` to automatically push the commit (and retry on conflict.)
     Provide `redeploy` to redeploy servers even if nothing has changed.
     Provide `skip_migrations` to disable running migrations via helm hooks.
+    Image listings cached within the last `GITOPS_IMAGE_CACHE_TTL` seconds are used, and
+    checked for new images if they have none with an app's prefix. Provide `refresh` to
+    always check ECR for new images.
     """
     prompt_message = "The following apps will have their image bumped"
     if image_tag:
@@ -72,22 +76,28 @@ def bump(  # noqa: C901
     if push:
         run(f"cd {get_apps_directory()}; git pull")
 
+    # Resolve every app's target tag up front, so that ECR is queried concurrently and
+    # only once per repository and prefix.
+    # The prefix to bump each app with. An empty prefix means tags without a dash.
+    image_prefixes = {app.name: prefix if prefix is not None else app.image_prefix for app in apps}
+    latest_images = {}
+    if image_tag is None:
+        latest_images = get_latest_images(
+            {(app.image_repository_name, image_prefixes[app.name]) for app in apps}, refresh=refresh
+        )
+
+    updates = {}
     for app in apps:
         app_name = app.name
         prev_image_tag = app.image_tag
         if image_tag is None:
-            # if we haven't specified a prefix
-            if prefix is None:
-                new_image_prefix = app.image_prefix
-            else:
-                new_image_prefix = prefix
-            new_image_tag = get_latest_image(app.image_repository_name, new_image_prefix)
+            new_image_tag = latest_images[(app.image_repository_name, image_prefixes[app_name])]
         else:
             new_image_tag = image_tag
 
         if not new_image_tag:
             if image_tag is None:
-                target_image = prefix or app.image_prefix
+                target_image = image_prefixes[app_name]
             else:
                 target_image = image_tag
 
@@ -100,12 +110,14 @@ def bump(  # noqa: C901
                 f"Bumping {colourise(app_name, Fore.LIGHTGREEN_EX)}: {colour_image(prev_image_tag)}"
                 f" -> {colour_image(new_image_tag)}"
             )
-            update_app(app_name, **{"image-tag": new_image_tag})
+            updates[app_name] = {"image-tag": new_image_tag}
         elif redeploy:
             print(f"Redeploying {colourise(app_name, Fore.LIGHTGREEN_EX)}")
-            update_app(app_name, **{"bump": str(uuid.uuid4())})
+            updates[app_name] = {"bump": str(uuid.uuid4())}
         else:
             print(f"Skipping {colourise(app_name, Fore.LIGHTGREEN_EX)}: already on" f" {colour_image(new_image_tag)}")
+    update_apps(updates)
+
     if redeploy:
         commit_message = f"Redeploying {filter}"
     else:
@@ -283,6 +295,7 @@ def setenv(ctx, filter, values, exclude=""):
             message=(
                 f"{colourise('The env var(s)', Fore.LIGHTBLUE_EX)}\n{colourise(formatted_splitenvs, Fore.LIGHTYELLOW_EX)}\n{colourise('will be added to the following apps:', Fore.LIGHTBLUE_EX)}"
             ),
+            load_secrets=False,
         )
     except AppOperationAborted:
         print(success_negative("Aborted."))
@@ -321,12 +334,13 @@ def unsetenv(ctx, filter, values, exclude=""):
             message=(
                 f"{colourise('The env var(s)', Fore.LIGHTBLUE_EX)}\n{colourise(formatted_splitenvs, Fore.LIGHTYELLOW_EX)}\n{colourise('will be removed from the following apps:', Fore.LIGHTBLUE_EX)}"
             ),
+            load_secrets=False,
         )
     except AppOperationAborted:
         print(success_negative("Aborted."))
         return
     for app in apps:
-        environment = app.values.get("environment") or {}
+        environment = dict(app.values.get("environment") or {})
         for e in splitenvs:
             if e in environment:
                 del environment[e]
@@ -353,6 +367,7 @@ def setcluster(ctx, filter, cluster, exclude=""):
                 f" {colourise(cluster, Fore.LIGHTYELLOW_EX)}"
                 f" {colourise('cluster:', Fore.LIGHTBLUE_EX)}"
             ),
+            load_secrets=False,
         )
     except AppOperationAborted:
         print(success_negative("Aborted."))
@@ -4,3 +4,22 @@ from pathlib import Path
 
 def get_apps_directory() -> Path:
     return Path(os.environ.get("GITOPS_APPS_DIRECTORY", "apps"))
+
+
+def get_cache_directory() -> Path | None:
+    """Where gitops keeps its persistent caches. Returns None if caching is disabled."""
+    if os.environ.get("GITOPS_DISABLE_CACHE"):
+        return None
+    if cache_directory := os.environ.get("GITOPS_CACHE_DIR"):
+        return Path(cache_directory)
+    return Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "gitops"
+
+
+def get_image_cache_ttl() -> float:
+    """How long, in seconds, cached ECR image listings are used before checking ECR for new images."""
+    return float(os.environ.get("GITOPS_IMAGE_CACHE_TTL", 300))
+
+
+def get_ecr_workers() -> int:
+    """Number of ECR repositories `bump` looks up images in at once."""
+    return int(os.environ.get("GITOPS_ECR_WORKERS", 8))
@@ -1,4 +1,5 @@
 import sys
+from functools import partial
 from pathlib import Path
 from typing import Literal
 
@@ -6,14 +7,19 @@ from colorama import Fore
 from tabulate import tabulate
 
 from gitops.common.app import DEPLOYMENT_ATTRIBUTES, App
+from gitops.common.parallel import parallel_map, parallel_map_chunks
+from gitops.common.utils import extends_cache
 from gitops.settings import get_apps_directory
 from gitops.utils import yaml as yaml
 
 from . import get_account_id
+from .cache import load_deployments
 from .cli import colourise, confirm, warning
 from .exceptions import AppDirectoryDoesNotExist, AppDoesNotExist, AppOperationAborted
 from .images import colour_image
+from .tag_index import FilterExpression, load_tag_index
 from .tags import colour_tags, validate_tags
+from .yaml_patch import patch_top_level_keys
 
 
 def is_valid_app_directory(directory: Path) -> bool:
@@ -25,11 +31,14 @@ def is_valid_app_directory(directory: Path) -> bool:
 def get_app_details(
     app_name: str, load_secrets: bool = True, encode_secrets: bool = True, exit_if_not_found: bool = True
 ) -> App:
-    account_id = get_account_id() if load_secrets else "UNKNOWN"
+    # The account id is only looked up if something needs the app's full image.
+    account_id = get_account_id if load_secrets else "UNKNOWN"
+    path = get_apps_directory() / app_name
     try:
         app = App(
             app_name,
-            path=str(get_apps_directory() / app_name),
+            path=str(path),
+            deployments=load_deployments(path / "deployment.yml"),
             load_secrets=load_secrets,
             encode_secrets=encode_secrets,
             account_id=account_id,
@@ -48,20 +57,56 @@ def get_app_details(
     return app
 
 
+def get_apps_details(app_names: list[str], load_secrets: bool = True, encode_secrets: bool = True) -> list[App]:
+    """`get_app_details` of many apps, parsing the base files they share only once.
+
+    Called in each worker process by `get_apps`, as the `extends_cache` isn't carried over to them.
+    """
+    with extends_cache():
+        return [
+            get_app_details(app_name, load_secrets=load_secrets, encode_secrets=encode_secrets)
+            for app_name in app_names
+        ]
+
+
 def update_app(app_name: str, **kwargs: object) -> None:
+    """Set top level values of an app's `deployment.yml`. Empty lists and dicts remove the key.
+
+    Only the changed keys are rewritten, unless the file needs to be dumped in full
+    (see `patch_top_level_keys`).
+    """
     filename = get_apps_directory() / app_name / "deployment.yml"
     with open(filename) as f:
-        data = yaml.safe_load(f)
+        text = f.read()
+    updates, deletions = {}, set()
     for k, v in kwargs.items():
         if k not in DEPLOYMENT_ATTRIBUTES:
             print(warning(f"Key '{k}' is not a recognised deployment attribute for {app_name}."))
         if v in [[], {}]:
-            if k in data:
-                del data[k]
+            deletions.add(k)
         else:
-            data[k] = v
-    with open(filename, "w") as f:
-        yaml.dump(data, f, default_flow_style=False)
+            updates[k] = v
+
+    patched = patch_top_level_keys(text, updates, deletions)
+    if patched is None:
+        data = yaml.safe_load(text)
+        for k in deletions:
+            data.pop(k, None)
+        data.update(updates)
+        patched = yaml.dump(data, default_flow_style=False)
+    if patched != text:
+        with open(filename, "w") as f:
+            f.write(patched)
+
+
+def _update_app(update: tuple[str, dict]) -> None:
+    app_name, values = update
+    update_app(app_name, **values)
+
+
+def update_apps(updates: dict[str, dict]) -> None:
+    """Apply `update_app` to many apps, in parallel. Maps app names to the values to update."""
+    parallel_map(_update_app, updates.items())
 
 
 def get_apps(  # noqa: C901
@@ -77,47 +122,48 @@ def get_apps(  # noqa: C901
     `exclude`. The incoming filter and exclude params may come in as a list or commastring.
     For the purpose of this filtering, app names and image tag prefixes are also considered as
     tags. For instance, you can do get_apps(tags=[emeriss, production], exclude=[arafire]).
+    `filter` may also be a boolean expression, eg. `(customer|internal)&production&!inactive`.
     Calling this method without any args returns all apps.
     There are three modes for communicating selected apps to the user:
     - PROMPT: Prints selected apps and asks for confirmation to proceed.
     - PREVIEW: Prints selected apps then proceeds.
     - SILENT: Proceeds without printing.
     Apps with the `inactive` tag are excluded by default, unless requested otherwise.
+    Secrets are only read when first accessed. With `load_secrets=False` only the app metadata
+    is loaded: secrets are left empty and the AWS account id is never looked up.
     """
     if filter == "all":
-        filter = set()
-    else:
-        filter = set(filter.split(",") if filter and isinstance(filter, str) else filter)
+        filter = ""
+    filter_expression = FilterExpression(filter if isinstance(filter, str) else ",".join(filter))
 
     exclude = set(exclude.split(",") if exclude and isinstance(exclude, str) else exclude)
-
     if autoexclude_inactive:
         exclude.add("inactive")
+    exclude_expressions = [FilterExpression(e) for e in exclude if e]
 
-    apps = []
     existing_tags = {"suspended", "inactive", "release", "qa", "no_shutdown"}
 
     try:
         directory = sorted(get_apps_directory().iterdir())
     except FileNotFoundError as e:
         raise AppDoesNotExist() from e
-    for entry in directory:
-        if not entry.is_dir():
-            continue
-        elif not is_valid_app_directory(entry):
-            continue
-        app = get_app_details(entry.name, load_secrets=load_secrets, encode_secrets=encode_secrets)
-
-        pseudotags = [app.name, app.cluster]
-        if app.image and app.image_prefix:
-            pseudotags.append(app.image_prefix)
-
-        tags = set(app.tags + pseudotags)
-        existing_tags |= tags
-        if filter <= tags and not exclude & tags:
-            apps.append(app)
-
-    validate_tags(filter | exclude, existing_tags)
+    app_names = [entry.name for entry in directory if entry.is_dir() and is_valid_app_directory(entry)]
+
+    index = load_tag_index(get_apps_directory(), app_names)
+    existing_tags |= index.tags
+    validate_tags(
+        filter_expression.tags.union(*(expression.tags for expression in exclude_expressions)),
+        existing_tags,
+    )
+
+    selected = filter_expression(index)
+    for expression in exclude_expressions:
+        selected &= ~expression(index)
+
+    apps = parallel_map_chunks(
+        partial(get_apps_details, load_secrets=load_secrets, encode_secrets=encode_secrets),
+        index.get_names(selected),
+    )
 
     if mode in ["PROMPT", "PREVIEW"]:
         if mode == "PROMPT" and message is None:
@@ -0,0 +1,271 @@
+"""Persistent caches of parsed app definitions and ECR image listings.
+
+Parsing every `deployment.yml` in a cluster repo is by far the slowest part of
+most commands. The resolved deployment values of each app are kept in a SQLite
+database under the user's cache directory, along with the list of files they
+were built from (the `deployment.yml` itself and its chain of `extends` parents).
+
+An entry is reused as long as none of those files has changed. Files are first
+compared by mtime, size and inode, and only when those differ is the content
+hash checked. Secrets are never cached.
+
+The images of ECR repositories (digest, tags and push time) are kept in a separate
+database, so `bump` doesn't need to page through every image each time it runs.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any
+
+from gitops.common.utils import load_yaml_with_dependencies, load_yaml_with_digests
+from gitops.settings import get_cache_directory
+
+CACHE_FILENAME = "apps.sqlite3"
+IMAGE_CACHE_FILENAME = "images.sqlite3"
+# Files modified this recently may be modified again within the same mtime tick,
+# so their stat information is not trusted and the content hash is always checked.
+RACY_MTIME_WINDOW_NS = 2_000_000_000
+
+
+def file_digest(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def stat_signature(path: str) -> list[int]:
+    """The mtime, size and inode of a file. Recently modified files get an mtime that never matches."""
+    stat = os.stat(path)
+    mtime_ns = stat.st_mtime_ns
+    if time.time_ns() - mtime_ns < RACY_MTIME_WINDOW_NS:
+        mtime_ns = -1
+    return [mtime_ns, stat.st_size, stat.st_ino]
+
+
+def make_dependency(path: str, sha256: str | None = None) -> dict[str, Any]:
+    """
+    :params sha256: The digest of the content the cached values were parsed from. A file
+        changed since then was modified within the racy window, so is hashed again on use.
+    """
+    mtime_ns, size, ino = stat_signature(path)
+    return {
+        "path": path,
+        "mtime_ns": mtime_ns,
+        "size": size,
+        "ino": ino,
+        "sha256": sha256 or file_digest(path),
+    }
+
+
+def has_string_keys(value: Any) -> bool:
+    """Whether every dictionary key in `value` is a string, so survives a json round trip."""
+    if isinstance(value, dict):
+        return all(isinstance(key, str) and has_string_keys(item) for key, item in value.items())
+    if isinstance(value, list):
+        return all(has_string_keys(item) for item in value)
+    return True
+
+
+def validate_dependencies(dependencies: list[dict[str, Any]]) -> list[dict[str, Any]] | None:
+    """Check that none of the files a cache entry was built from has changed.
+
+    Returns the (possibly refreshed) dependency list if the entry is still valid,
+    otherwise None.
+    """
+    validated = []
+    for dependency in dependencies:
+        try:
+            stat = os.stat(dependency["path"])
+        except FileNotFoundError:
+            return None
+        if (stat.st_mtime_ns, stat.st_size, stat.st_ino) == (
+            dependency["mtime_ns"],
+            dependency["size"],
+            dependency["ino"],
+        ):
+            validated.append(dependency)
+            continue
+        if stat.st_size != dependency["size"]:
+            return None
+        # Stat information changed (touched, checked out again, ...) but the content may not have.
+        fresh_dependency = make_dependency(dependency["path"])
+        if fresh_dependency["sha256"] != dependency["sha256"]:
+            return None
+        validated.append(fresh_dependency)
+    return validated
+
+
+class SQLiteCache:
+    """A cache database in the gitops cache directory, with the tables in `schema`."""
+
+    schema: list[str] = []
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # SQLite connections must not be shared with other threads or forked processes.
+        if getattr(self._local, "pid", None) != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            for statement in self.schema:
+                connection.execute(statement)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+
+class AppCache(SQLiteCache):
+    schema = [
+        "CREATE TABLE IF NOT EXISTS deployments"
+        " (path TEXT PRIMARY KEY, dependencies TEXT NOT NULL, deployments TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS tag_indexes (directory TEXT PRIMARY KEY, payload TEXT NOT NULL)",
+    ]
+
+    def get(self, path: str) -> tuple[dict, list[str]] | None:
+        row = self.connection.execute(
+            "SELECT dependencies, deployments FROM deployments WHERE path = ?", (path,)
+        ).fetchone()
+        if not row:
+            return None
+        dependencies = json.loads(row[0])
+        validated = validate_dependencies(dependencies)
+        if validated is None:
+            return None
+        if validated != dependencies:
+            self.connection.execute(
+                "UPDATE deployments SET dependencies = ? WHERE path = ?", (json.dumps(validated), path)
+            )
+        return json.loads(row[1]), [dependency["path"] for dependency in validated]
+
+    def set(self, path: str, deployments: dict, digests: dict[str, str]) -> None:
+        """Cache the values parsed from the files in `digests` (by path), as they were parsed."""
+        if not has_string_keys(deployments):
+            # Json would turn other keys into strings, changing the values.
+            return
+        try:
+            serialised = json.dumps(deployments)
+        except (TypeError, ValueError):
+            # Values that don't survive a json round trip (eg. dates) are not cached.
+            return
+        dependencies = [make_dependency(dependency_path, sha256) for dependency_path, sha256 in digests.items()]
+        self.connection.execute(
+            "INSERT OR REPLACE INTO deployments (path, dependencies, deployments) VALUES (?, ?, ?)",
+            (path, json.dumps(dependencies), serialised),
+        )
+
+    def load_deployments(self, path: str) -> tuple[dict, list[str]]:
+        path = os.path.abspath(path)
+        if (cached := self.get(path)) is not None:
+            return cached
+        deployments, digests = load_yaml_with_digests(path)
+        digests = {os.path.abspath(p): sha256 for p, sha256 in digests.items()}
+        self.set(path, deployments, digests)
+        return deployments, list(digests)
+
+    def get_tag_index(self, directory: str) -> dict | None:
+        row = self.connection.execute("SELECT payload FROM tag_indexes WHERE directory = ?", (directory,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_tag_index(self, directory: str, payload: dict) -> None:
+        self.connection.execute(
+            "INSERT OR REPLACE INTO tag_indexes (directory, payload) VALUES (?, ?)", (directory, json.dumps(payload))
+        )
+
+
+class ImageCache(SQLiteCache):
+    """Details (digest, tags and push time) of the images in ECR repositories."""
+
+    schema = [
+        "CREATE TABLE IF NOT EXISTS images (repository TEXT NOT NULL, digest TEXT NOT NULL,"
+        " tags TEXT NOT NULL, pushed_at TEXT NOT NULL, PRIMARY KEY (repository, digest))",
+        "CREATE TABLE IF NOT EXISTS image_repositories (repository TEXT PRIMARY KEY, refreshed_at REAL NOT NULL)",
+    ]
+
+    def get(self, repository: str) -> tuple[float, list[dict]] | None:
+        """When the repository was last refreshed, and its images in the order they were listed."""
+        row = self.connection.execute(
+            "SELECT refreshed_at FROM image_repositories WHERE repository = ?", (repository,)
+        ).fetchone()
+        if not row:
+            return None
+        images = [
+            {"imageDigest": digest, "imageTags": json.loads(tags), "imagePushedAt": datetime.fromisoformat(pushed_at)}
+            for digest, tags, pushed_at in self.connection.execute(
+                "SELECT digest, tags, pushed_at FROM images WHERE repository = ? ORDER BY rowid", (repository,)
+            )
+        ]
+        return row[0], images
+
+    def set(self, repository: str, images: list[dict], refreshed_at: float) -> None:
+        with self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.execute("DELETE FROM images WHERE repository = ?", (repository,))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO images (repository, digest, tags, pushed_at) VALUES (?, ?, ?, ?)",
+                [
+                    (
+                        repository,
+                        image["imageDigest"],
+                        json.dumps(image["imageTags"]),
+                        image["imagePushedAt"].isoformat(),
+                    )
+                    for image in images
+                ],
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO image_repositories (repository, refreshed_at) VALUES (?, ?)",
+                (repository, refreshed_at),
+            )
+
+
+_app_cache: AppCache | None = None
+_image_cache: ImageCache | None = None
+
+
+def get_app_cache() -> AppCache | None:
+    global _app_cache
+    cache_directory = get_cache_directory()
+    if cache_directory is None:
+        return None
+    if _app_cache is None or _app_cache.path != cache_directory / CACHE_FILENAME:
+        _app_cache = AppCache(cache_directory / CACHE_FILENAME)
+    return _app_cache
+
+
+def get_image_cache() -> ImageCache | None:
+    global _image_cache
+    cache_directory = get_cache_directory()
+    if cache_directory is None:
+        return None
+    if _image_cache is None or _image_cache.path != cache_directory / IMAGE_CACHE_FILENAME:
+        _image_cache = ImageCache(cache_directory / IMAGE_CACHE_FILENAME)
+    return _image_cache
+
+
+def load_deployments_with_dependencies(path: str | Path) -> tuple[dict, list[str]]:
+    """Load the resolved values of a `deployment.yml`, using the persistent cache when possible.
+
+    Also returns the absolute paths of the files the values were built from.
+    """
+    cache = get_app_cache()
+    if cache is not None:
+        try:
+            return cache.load_deployments(str(path))
+        except (sqlite3.Error, OSError):
+            # An unusable cache shouldn't stop anyone from working.
+            pass
+    deployments, dependency_paths = load_yaml_with_dependencies(str(path))
+    return deployments, [os.path.abspath(p) for p in dependency_paths]
+
+
+def load_deployments(path: str | Path) -> dict:
+    return load_deployments_with_dependencies(path)[0]
@@ -12,3 +12,7 @@ class AppDirectoryDoesNotExist(Exception):
 
 class CommandError(Exception):
     pass
+
+
+class InvalidFilterExpression(Exception):
+    pass
@@ -1,13 +1,25 @@
+import sqlite3
+import threading
+import time
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from functools import lru_cache
 from hashlib import md5
+from typing import Any
 
 import boto3
 from colorama import Fore
 
+from gitops.settings import get_ecr_workers, get_image_cache_ttl
+
+from .cache import get_image_cache
 from .cli import colourise
 
 BATCH_SIZE = 100
 
+_client_lock = threading.Lock()
+
 
 def get_image(tag: str) -> str:
     """Finds a specific image in ECR."""
@@ -15,37 +27,172 @@ def get_image(tag: str) -> str:
     raise NotImplementedError
 
 
-@lru_cache
-def get_latest_image(repository_name: str, prefix: str) -> str | None:
-    """Finds latest image in ECR with the given prefix and returns the image tag"""
-    ecr_client = boto3.client("ecr")
-    client_paginator = ecr_client.get_paginator("describe_images")
+class ImageIndex:
+    """The latest `(tag, pushed at)` of a repository's images, for every tag prefix.
+
+    An image tag `qa-server-1a2b3c` counts towards the prefixes `qa` and `qa-server`, and
+    tags without a `-` count towards the empty prefix. Only the first matching tag of an
+    image counts for each prefix, and on a tie the image listed first wins.
+    """
+
+    def __init__(self, images: Iterable[dict]):
+        self.latest: dict[str, tuple[str, datetime]] = {}
+        for image in images:
+            pushed_at = image["imagePushedAt"]
+            seen: set[str] = set()
+            for tag in image.get("imageTags", []):
+                for prefix in get_tag_prefixes(tag):
+                    if prefix in seen:
+                        continue
+                    seen.add(prefix)
+                    latest = self.latest.get(prefix)
+                    if latest is None or pushed_at > latest[1]:
+                        self.latest[prefix] = (tag, pushed_at)
+
+    def get_latest_tag(self, prefix: str) -> str | None:
+        latest = self.latest.get(prefix)
+        return latest[0] if latest else None
+
+
+def get_tag_prefixes(tag: str) -> Iterator[str]:
+    """Every prefix `get_latest_image` could match `tag` by."""
+    if "-" not in tag:
+        yield ""
+        return
+    position = tag.find("-")
+    while position != -1:
+        yield tag[:position]
+        position = tag.find("-", position + 1)
+
 
-    results = []
+def describe_images(ecr_client: Any, repository_name: str) -> Iterator[dict]:
+    client_paginator = ecr_client.get_paginator("describe_images")
     for ecr_response in client_paginator.paginate(
         repositoryName=repository_name,
         filter={"tagStatus": "TAGGED"},
         maxResults=BATCH_SIZE,
     ):
-        for image in ecr_response["imageDetails"]:
-            if prefix != "":
-                if prefix_tags := [tag for tag in image["imageTags"] if tag.startswith(prefix + "-")]:
-                    results.append((prefix_tags[0], image["imagePushedAt"]))
-            else:
-                if prefix_tags := [tag for tag in image["imageTags"] if "-" not in tag]:
-                    results.append((prefix_tags[0], image["imagePushedAt"]))
-
-    if not results:
+        yield from ecr_response["imageDetails"]
+
+
+def list_image_tags(ecr_client: Any, repository_name: str) -> dict[str, set[str]]:
+    """The tags of each image digest. Much cheaper than describing every image."""
+    image_tags: dict[str, set[str]] = {}
+    client_paginator = ecr_client.get_paginator("list_images")
+    for ecr_response in client_paginator.paginate(
+        repositoryName=repository_name,
+        filter={"tagStatus": "TAGGED"},
+        maxResults=BATCH_SIZE * 10,
+    ):
+        for image_id in ecr_response["imageIds"]:
+            image_tags.setdefault(image_id["imageDigest"], set()).add(image_id["imageTag"])
+    return image_tags
+
+
+def refresh_images(ecr_client: Any, repository_name: str, images: list[dict]) -> list[dict]:
+    """Bring a previous listing of a repository's images up to date.
+
+    Only images that are new, or whose tags have changed, are described again.
+    """
+    image_tags = list_image_tags(ecr_client, repository_name)
+    kept = [image for image in images if image_tags.get(image["imageDigest"]) == set(image["imageTags"])]
+    kept_digests = {image["imageDigest"] for image in kept}
+    digests = [digest for digest in image_tags if digest not in kept_digests]
+    for i in range(0, len(digests), BATCH_SIZE):
+        ecr_response = ecr_client.describe_images(
+            repositoryName=repository_name,
+            imageIds=[{"imageDigest": digest} for digest in digests[i : i + BATCH_SIZE]],
+        )
+        kept.extend(ecr_response["imageDetails"])
+    return kept
+
+
+def load_images(repository_name: str, refresh: bool = False) -> list[dict]:
+    """The images of a repository, from the image cache if it was refreshed recently enough."""
+    # Creating clients isn't thread safe, using them is.
+    with _client_lock:
+        ecr_client = boto3.client("ecr")
+    cache = get_image_cache()
+    try:
+        cached = cache.get(repository_name) if cache else None
+    except (sqlite3.Error, OSError):
+        cache, cached = None, None
+    if cached is None:
+        images = list(describe_images(ecr_client, repository_name))
+    else:
+        refreshed_at, images = cached
+        age = time.time() - refreshed_at
+        if not refresh and age < get_image_cache_ttl():
+            print(f"Using images of {repository_name} cached {age:.0f}s ago; new images may be missed.")
+            return images
+        images = refresh_images(ecr_client, repository_name, images)
+
+    if cache:
+        try:
+            cache.set(repository_name, images, time.time())
+        except (sqlite3.Error, OSError):
+            pass
+    return images
+
+
+@lru_cache
+def get_image_index(repository_name: str, refresh: bool = False) -> ImageIndex:
+    """Scans a repository once per process, however many prefixes are looked up in it."""
+    return ImageIndex(load_images(repository_name, refresh=refresh))
+
+
+def get_latest_tags(repository_name: str, prefixes: Iterable[str], refresh: bool = False) -> dict[str, str | None]:
+    """The latest image tag of a repository with each prefix.
+
+    A recent listing from the image cache is checked for new images if any prefix has
+    none in it, as they may have been pushed since.
+    """
+    index = get_image_index(repository_name, refresh)
+    latest_tags = {prefix: index.get_latest_tag(prefix) for prefix in prefixes}
+    if not refresh and None in latest_tags.values():
+        index = get_image_index(repository_name, True)
+        latest_tags = {prefix: index.get_latest_tag(prefix) for prefix in latest_tags}
+    return latest_tags
+
+
+def get_latest_image(repository_name: str, prefix: str, refresh: bool = False) -> str | None:
+    """Finds latest image in ECR with the given prefix and returns the image tag
+
+    :params refresh: Check ECR for new images even if the image cache is recent
+    """
+    latest_image_tag = get_latest_tags(repository_name, [prefix], refresh)[prefix]
+    if latest_image_tag is None:
         if prefix:
             print(f'No images found in repository: {repository_name} with tag "{prefix}-*".')
         else:
             print(f"No images found in repository: {repository_name}")
-        return None
-
-    latest_image_tag = sorted(results, key=lambda image: image[1], reverse=True)[0][0]
     return latest_image_tag
 
 
+def get_latest_images(lookups: Iterable[tuple[str, str]], refresh: bool = False) -> dict[tuple[str, str], str | None]:
+    """Finds the latest image tag of many `(repository name, prefix)` pairs at once.
+
+    Each repository is only loaded once, and different repositories are loaded
+    concurrently (see `get_ecr_workers`).
+    """
+    prefixes_by_repository: dict[str, set[str]] = {}
+    for repository_name, prefix in lookups:
+        prefixes_by_repository.setdefault(repository_name, set()).add(prefix)
+    if not prefixes_by_repository:
+        return {}
+
+    workers = min(get_ecr_workers(), len(prefixes_by_repository))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        latest_tags = executor.map(
+            lambda item: get_latest_tags(item[0], item[1], refresh), prefixes_by_repository.items()
+        )
+        return {
+            (repository_name, prefix): tag
+            for repository_name, tags in zip(prefixes_by_repository, latest_tags, strict=True)
+            for prefix, tag in tags.items()
+        }
+
+
 def colour_image(image_tag: str) -> str:
     if not image_tag:
         return image_tag
@@ -23,6 +23,7 @@ from invoke import run
 from invoke.exceptions import Failure, UnexpectedExit
 
 from gitops.common.app import App
+from gitops.common.utils import safe_load
 from gitops.settings import get_apps_directory
 from gitops.utils.async_runner import async_run
 
@@ -199,7 +200,7 @@ def render_template(
     for k, v in values.items():
         template = template.replace("{{ %s }}" % k, v)  # noqa
 
-    job_json = yaml.safe_load(template)
+    job_json = safe_load(template)
     # Adding extra labels to k8s job pod spec
     for k, v in extra_labels.items():
         job_json["spec"]["template"]["metadata"]["labels"][k] = v
@@ -0,0 +1,199 @@
+"""Select apps by tag without loading every app.
+
+`TagIndex` maps each tag (and pseudotag: app name, cluster and image prefix) to the
+set of apps carrying it, stored as a bitset over the sorted app names. Selecting
+apps is then integer arithmetic on those bitsets, and only the selected apps need
+to be loaded in full.
+
+The index is persisted in the app cache, and reused for as long as the app
+directories and every file their values were built from are unchanged.
+"""
+
+import os
+import re
+import sqlite3
+from collections.abc import Callable, Iterable
+from functools import partial
+from pathlib import Path
+
+from gitops.common.app import App
+from gitops.common.parallel import parallel_map_chunks
+from gitops.common.utils import extends_cache
+
+from .cache import get_app_cache, load_deployments_with_dependencies, stat_signature
+from .exceptions import InvalidFilterExpression
+
+OPERATORS = ("(", ")", "!", "&", "|", ",")
+TOKEN_PATTERN = re.compile(r"\s*(?:([()!&|,])|([^\s()!&|,]+))")
+
+
+class TagIndex:
+    def __init__(self, names: list[str], bitsets: dict[str, int]):
+        self.names = names
+        self.bitsets = bitsets
+        self.everything = (1 << len(names)) - 1
+
+    @classmethod
+    def from_app_tags(cls, app_tags: dict[str, Iterable[str]]) -> "TagIndex":
+        names = sorted(app_tags)
+        bitsets: dict[str, int] = {}
+        for position, name in enumerate(names):
+            for tag in app_tags[name]:
+                bitsets[tag] = bitsets.get(tag, 0) | (1 << position)
+        return cls(names, bitsets)
+
+    @property
+    def tags(self) -> set[str]:
+        return set(self.bitsets)
+
+    def get(self, tag: str) -> int:
+        return self.bitsets.get(tag, 0)
+
+    def get_names(self, bitset: int) -> list[str]:
+        """App names in `bitset`, in sorted order. Costs O(selected apps)."""
+        names = []
+        while bitset:
+            lowest_bit = bitset & -bitset
+            names.append(self.names[lowest_bit.bit_length() - 1])
+            bitset ^= lowest_bit
+        return names
+
+
+class FilterExpression:
+    """A tag filter compiled to bitset operations against a `TagIndex`.
+
+    eg. `(customer|internal)&production&!inactive`
+
+    `!` is NOT, `&` is AND and `|` is OR, in decreasing order of precedence.
+    For backwards compatibility `,` is also AND, and an empty expression matches
+    every app.
+    """
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        self.tags: set[str] = set()
+        self._tokens = self._tokenize(expression)
+        self._position = 0
+        if self._tokens:
+            self._evaluate = self._parse_or()
+        else:
+            self._evaluate = lambda index: index.everything
+        if self._position != len(self._tokens):
+            raise InvalidFilterExpression(f"Unexpected {self._tokens[self._position]!r} in filter {expression!r}")
+
+    def __call__(self, index: TagIndex) -> int:
+        return self._evaluate(index)
+
+    def _tokenize(self, expression: str) -> list[str]:
+        tokens = []
+        position = 0
+        expression = expression.strip()
+        while position < len(expression):
+            match = TOKEN_PATTERN.match(expression, position)
+            if not match:
+                raise InvalidFilterExpression(f"Invalid filter {expression!r}")
+            tokens.append(match.group(1) or match.group(2))
+            position = match.end()
+        return tokens
+
+    def _peek(self) -> str | None:
+        return self._tokens[self._position] if self._position < len(self._tokens) else None
+
+    def _take(self) -> str:
+        token = self._peek()
+        if token is None:
+            raise InvalidFilterExpression(f"Unexpected end of filter {self.expression!r}")
+        self._position += 1
+        return token
+
+    def _parse_or(self) -> Callable[[TagIndex], int]:
+        left = self._parse_and()
+        while self._peek() == "|":
+            self._take()
+            left = partial(lambda a, b, index: a(index) | b(index), left, self._parse_and())
+        return left
+
+    def _parse_and(self) -> Callable[[TagIndex], int]:
+        left = self._parse_not()
+        while self._peek() in ("&", ","):
+            self._take()
+            left = partial(lambda a, b, index: a(index) & b(index), left, self._parse_not())
+        return left
+
+    def _parse_not(self) -> Callable[[TagIndex], int]:
+        if self._peek() == "!":
+            self._take()
+            operand = self._parse_not()
+            return lambda index: index.everything & ~operand(index)
+        return self._parse_atom()
+
+    def _parse_atom(self) -> Callable[[TagIndex], int]:
+        symbol = self._take()
+        if symbol == "(":
+            inner = self._parse_or()
+            if self._take() != ")":
+                raise InvalidFilterExpression(f"Missing ')' in filter {self.expression!r}")
+            return inner
+        if symbol in OPERATORS:
+            raise InvalidFilterExpression(f"Unexpected {symbol!r} in filter {self.expression!r}")
+        self.tags.add(symbol)
+        return lambda index: index.get(symbol)
+
+
+def get_app_tags(app: App) -> set[str]:
+    """All tags of an app, including its pseudotags: name, cluster and image prefix."""
+    pseudotags = [app.name, app.cluster]
+    if app.image and app.image_prefix:
+        pseudotags.append(app.image_prefix)
+    return set(app.tags + pseudotags)
+
+
+def load_app_tags(directory: Path, app_name: str) -> tuple[list[str], list[str]]:
+    deployments, dependencies = load_deployments_with_dependencies(directory / app_name / "deployment.yml")
+    app = App(app_name, deployments=deployments, load_secrets=False)
+    return sorted(get_app_tags(app)), dependencies
+
+
+def load_apps_tags(directory: Path, app_names: list[str]) -> list[tuple[list[str], list[str]]]:
+    # Worker processes don't inherit the caller's extends cache, so each chunk opens its own.
+    with extends_cache():
+        return [load_app_tags(directory, app_name) for app_name in app_names]
+
+
+def is_unchanged(stats: dict[str, list[int]]) -> bool:
+    for path, signature in stats.items():
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+        if [stat.st_mtime_ns, stat.st_size, stat.st_ino] != signature:
+            return False
+    return True
+
+
+def load_tag_index(directory: Path, app_names: list[str]) -> TagIndex:
+    """Load the tag index of the apps in `directory`, rebuilding it if anything changed."""
+    cache = get_app_cache()
+    key = os.path.abspath(directory)
+    try:
+        payload = cache.get_tag_index(key) if cache else None
+    except (sqlite3.Error, OSError):
+        cache, payload = None, None
+    if payload and payload["names"] == app_names and is_unchanged(payload["stats"]):
+        return TagIndex(payload["names"], {tag: int(bitset, 16) for tag, bitset in payload["bitsets"].items()})
+
+    results = parallel_map_chunks(partial(load_apps_tags, directory), app_names)
+    index = TagIndex.from_app_tags({name: tags for name, (tags, _) in zip(app_names, results, strict=True)})
+
+    if cache:
+        dependencies = {dependency for _, app_dependencies in results for dependency in app_dependencies}
+        payload = {
+            "names": index.names,
+            "bitsets": {tag: f"{bitset:x}" for tag, bitset in index.bitsets.items()},
+            "stats": {dependency: stat_signature(dependency) for dependency in sorted(dependencies)},
+        }
+        try:
+            cache.set_tag_index(key, payload)
+        except (sqlite3.Error, OSError):
+            pass
+    return index
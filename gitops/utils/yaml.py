@@ -44,3 +44,7 @@ del map_constructor, map_representer
 # This allows users a drop-in replacement:
 #   import utils.yaml as yaml
 from yaml import *  # type: ignore # noqa isort:skip
+
+# Loading goes through libyaml when it is available. Dumping always uses the pure
+# python emitter above, as libyaml's emitter can't indent dashed lists.
+from gitops.common.utils import safe_load  # type: ignore[assignment] # noqa: E402, F401, F811 isort:skip
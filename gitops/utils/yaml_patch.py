@@ -0,0 +1,130 @@
+"""Edit top level keys of a yaml document without re-serialising all of it.
+
+`update_app` only ever changes a handful of top level keys of a `deployment.yml`.
+Rather than loading and dumping the whole file (which is slow, drops comments and
+can reformat unrelated lines), the text of each changed key is replaced in place
+with what a full dump would have produced for it. Everything else in the file is
+left byte for byte as it was.
+
+Only plain block mappings can be patched this way. Anything unusual (flow style,
+explicit document markers, anchors and aliases, block scalars) is left to a full
+dump, signalled by `patch_top_level_keys` returning None.
+"""
+
+from collections.abc import Iterator
+from typing import Any
+
+import yaml as pyyaml
+
+from gitops.common.utils import SafeLoader
+
+from . import yaml
+
+
+def get_top_level_spans(text: str) -> dict[str, tuple[int, int]] | None:
+    """Where each top level key of `text` starts and ends, as character offsets.
+
+    A span runs from the start of the key's line to the end of the line its value
+    ends on, including that line break. Returns None if the document can't be
+    safely patched.
+    """
+    events: Iterator[Any] = iter(pyyaml.parse(text, Loader=SafeLoader))
+    if not isinstance(next(events), pyyaml.StreamStartEvent):
+        return None
+    document_start = next(events)
+    if not isinstance(document_start, pyyaml.DocumentStartEvent) or document_start.explicit:
+        return None
+    root = next(events)
+    if not isinstance(root, pyyaml.MappingStartEvent) or root.flow_style or root.anchor or root.tag:
+        return None
+
+    spans: dict[str, tuple[int, int]] = {}
+    while True:
+        key = next(events)
+        if isinstance(key, pyyaml.MappingEndEvent):
+            break
+        key_mark: Any = key.start_mark
+        if (
+            not isinstance(key, pyyaml.ScalarEvent)
+            or key.style
+            or key.anchor
+            or key_mark.column != 0
+            or key.value in spans
+            or key.value == "<<"
+        ):
+            return None
+        value_end = _get_value_end(events)
+        if value_end is None:
+            return None
+        line_end = text.find("\n", value_end)
+        spans[key.value] = (key_mark.index, len(text) if line_end == -1 else line_end + 1)
+
+    document_end = next(events)
+    if not isinstance(document_end, pyyaml.DocumentEndEvent) or document_end.explicit:
+        return None
+    if not isinstance(next(events), pyyaml.StreamEndEvent):
+        return None
+    return spans
+
+
+def _get_value_end(events: Iterator[Any]) -> int | None:
+    """Consume the events of one value, returning where its last character is."""
+    value_end = None
+    # Whether each collection we're in is in flow style.
+    flow_styles: list[bool] = []
+    while True:
+        event = next(events)
+        end_mark: Any = event.end_mark
+        if isinstance(event, pyyaml.AliasEvent) or getattr(event, "anchor", None):
+            return None
+        if isinstance(event, pyyaml.ScalarEvent):
+            if event.style in ("|", ">"):
+                return None
+            value_end = end_mark.index
+        elif isinstance(event, pyyaml.CollectionStartEvent):
+            flow_styles.append(bool(event.flow_style))
+        elif isinstance(event, pyyaml.CollectionEndEvent):
+            # The end of a block collection is only found at the start of whatever comes
+            # after it, so use the end of its last item instead.
+            if flow_styles.pop():
+                value_end = end_mark.index
+        if not flow_styles:
+            return value_end
+
+
+def dump_top_level_key(key: str, value: Any) -> str:
+    return yaml.dump({key: value}, default_flow_style=False)
+
+
+def patch_top_level_keys(text: str, updates: dict[str, Any], deletions: set[str]) -> str | None:
+    """Set the top level keys in `updates` and remove the keys in `deletions`.
+
+    New keys are added at the end of the document. Returns None if the document
+    needs to be re-serialised in full instead.
+    """
+    try:
+        spans = get_top_level_spans(text)
+    except (pyyaml.YAMLError, StopIteration):
+        return None
+    if spans is None or (set(spans) <= deletions and not updates):
+        # Removing every key leaves an empty document, which a full dump writes as `{}`.
+        return None
+
+    replacements = []
+    for key in deletions:
+        if key in spans:
+            replacements.append((*spans[key], ""))
+    additions = []
+    for key, value in updates.items():
+        if key in spans:
+            replacements.append((*spans[key], dump_top_level_key(key, value)))
+        else:
+            additions.append(dump_top_level_key(key, value))
+
+    for start, end, replacement in sorted(replacements, reverse=True):
+        text = text[:start] + replacement + text[end:]
+    if additions:
+        if text and not text.endswith("\n"):
+            text += "\n"
+        text += "".join(additions)
+    return text
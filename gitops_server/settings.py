@@ -5,3 +5,25 @@ CLUSTER_NAME = os.getenv("CLUSTER_NAME", "")
 CLUSTER_NAMESPACE = os.getenv("CLUSTER_NAMESPACE", "")
 ACCOUNT_ID = os.getenv("ACCOUNT_ID", "")
 GITHUB_WEBHOOK_KEY = os.getenv("GITHUB_WEBHOOK_KEY", "")
+# How many commits of parsed app definitions to keep in memory
+APP_DEFINITIONS_CACHE_SIZE = int(os.getenv("GITOPS_APP_DEFINITIONS_CACHE_SIZE", "8"))
+# How many distinct parsed apps to keep in memory for reuse across commits
+APP_CACHE_SIZE = int(os.getenv("GITOPS_APP_CACHE_SIZE", "5000"))
+# How many built git chart checkouts to keep, and for how long (in seconds) after last use
+CHART_CACHE_SIZE = int(os.getenv("GITOPS_CHART_CACHE_SIZE", "10"))
+CHART_CACHE_MAX_AGE = int(os.getenv("GITOPS_CHART_CACHE_MAX_AGE", "3600"))
+# Where to keep built helm chart dependencies, and how many sets of them
+HELM_DEPENDENCY_CACHE_DIR = os.getenv("GITOPS_HELM_DEPENDENCY_CACHE_DIR", "/tmp/gitops/helm-dependencies")
+HELM_DEPENDENCY_CACHE_SIZE = int(os.getenv("GITOPS_HELM_DEPENDENCY_CACHE_SIZE", "50"))
+# How often (in seconds) to refresh the indexes of helm repos, and where to keep pulled charts
+HELM_REPO_UPDATE_INTERVAL = int(os.getenv("GITOPS_HELM_REPO_UPDATE_INTERVAL", "600"))
+HELM_CHART_CACHE_DIR = os.getenv("GITOPS_HELM_CHART_CACHE_DIR", "/tmp/gitops/helm-charts")
+# Where to keep queued pushes and the progress of their deploys, to resume them after a restart.
+# Only survives the pod restarting on a persistent volume (see `persistence` in the chart values).
+DEPLOY_QUEUE_PATH = os.getenv("GITOPS_DEPLOY_QUEUE_PATH", "/var/gitops/deploy-queue.sqlite3")
+# The priority of apps by tag when waiting to install, like "production=8,sandbox=1". Apps
+# without a listed tag have the `default` priority. Higher priorities go first and get a
+# bigger share of installs, proportional to their priority.
+DEPLOY_PRIORITIES = os.getenv("GITOPS_DEPLOY_PRIORITIES", "production=8,customer=8,default=4,sandbox=1,preview=1")
+# How many apps with a tag can install at once, like "preview=1"
+DEPLOY_TAG_QUOTAS = os.getenv("GITOPS_DEPLOY_TAG_QUOTAS", "")
@@ -1,12 +1,21 @@
+import asyncio
 import logging
+import multiprocessing
 import os
-from typing import TypedDict
+import re
+from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor
+from typing import NotRequired, TypedDict
 
+from gitops.common import parallel
 from gitops.common.app import App
+from gitops.common.utils import extends_cache
 from gitops_server import settings
 
 logger = logging.getLogger("gitops")
 
+EXTENDS_PATTERN = re.compile(r"""^extends:[ \t]*["']?([^"'#\s]+)""", re.MULTILINE)
+
 
 class RunOutput(TypedDict):
     exit_code: int
@@ -16,21 +25,151 @@ class RunOutput(TypedDict):
 class UpdateAppResult(RunOutput):
     app_name: str
     slack_message: str
+    # Skipped, as a later deploy was going to change the app again.
+    superseded: NotRequired[bool]
+
+
+def load_app(entry: tuple[str, str]) -> App:
+    name, path = entry
+    app = App(name, path, account_id=settings.ACCOUNT_ID)
+    # The repo is a temporary checkout, so read the secrets before it's removed. The
+    # fingerprint is worked out here too, so it's done by the worker processes.
+    app.values.resolve()
+    app.fingerprint  # noqa: B018
+    return app
+
+
+def load_apps(entries: list[tuple[str, str]]) -> list[App]:
+    with extends_cache():
+        return [load_app(entry) for entry in entries]
+
+
+_app_loader: ProcessPoolExecutor | None = None
+
+
+def get_app_loader() -> ProcessPoolExecutor:
+    """A long lived pool of processes to load apps in.
+
+    The server has threads running, and forking a threaded process can deadlock the
+    children, so the workers are started by a forkserver (or spawned) instead.
+    """
+    global _app_loader
+    if _app_loader is None:
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        _app_loader = ProcessPoolExecutor(
+            max_workers=parallel.get_load_workers(), mp_context=multiprocessing.get_context(method)
+        )
+    return _app_loader
+
+
+async def load_apps_in_background(entries: list[tuple[str, str]]) -> list[App]:
+    """Load apps without blocking the event loop, over `get_app_loader` if there are many."""
+    workers = parallel.get_load_workers()
+    if workers <= 1 or len(entries) < max(parallel.PARALLEL_THRESHOLD, 2):
+        return await asyncio.to_thread(load_apps, entries)
+    chunksize = max(1, len(entries) // (workers * 4))
+    loop = asyncio.get_running_loop()
+    chunks = await asyncio.gather(
+        *[
+            loop.run_in_executor(get_app_loader(), load_apps, entries[i : i + chunksize])
+            for i in range(0, len(entries), chunksize)
+        ]
+    )
+    return [app for chunk in chunks for app in chunk]
+
+
+def get_app_entries(
+    repo_path: str, app_names: Iterable[str] | None = None, skip: Iterable[str] = ()
+) -> list[tuple[str, str]]:
+    """The name and directory of each app in a checkout of a cluster repo, sorted by name.
+
+    :params app_names: Only these apps, rather than all of them
+    :params skip: Apps to leave out, eg. because they're already loaded
+    """
+    path = os.path.join(repo_path, "apps")
+    skip = set(skip)
+    return [
+        (entry, os.path.join(path, entry))
+        for entry in sorted(os.listdir(path) if app_names is None else set(app_names))
+        if entry[0] != "." and entry not in skip and os.path.isdir(os.path.join(path, entry))
+    ]
+
+
+def get_extends_path(path: str) -> str | None:
+    """The file `path` extends, found without parsing the yaml."""
+    try:
+        with open(path) as f:
+            match = EXTENDS_PATTERN.search(f.read())
+    except OSError:
+        return None
+    if not match:
+        return None
+    return os.path.normpath(os.path.join(os.path.dirname(path), match.group(1)))
+
+
+def get_extends_chains(repo_path: str) -> dict[str, list[str]]:
+    """The chain of `extends` parents of every app in a cluster repo, relative to the repo root."""
+    apps_path = os.path.join(repo_path, "apps")
+    if not os.path.isdir(apps_path):
+        return {}
+    extends: dict[str, str | None] = {}
+    chains = {}
+    for entry in os.listdir(apps_path):
+        if entry[0] == "." or not os.path.isdir(os.path.join(apps_path, entry)):
+            continue
+        chain: list[str] = []
+        path = get_extends_path(os.path.join(apps_path, entry, "deployment.yml"))
+        while path and path not in chain:
+            chain.append(path)
+            if path not in extends:
+                extends[path] = get_extends_path(path)
+            path = extends[path]
+        chains[entry] = [os.path.relpath(path, repo_path) for path in chain]
+    return chains
+
+
+def get_affected_app_names(changed_paths: Iterable[str], extends_chains: dict[str, list[str]]) -> set[str]:
+    """Names of the apps affected by changes to `changed_paths` (relative to the repo root).
+
+    An app is affected if anything in its directory changed, or any file in its
+    chain of `extends` parents (see `get_extends_chains`) did.
+    """
+    changed = {os.path.normpath(path) for path in changed_paths}
+    affected = {
+        path.split(os.sep)[1] for path in changed if path.startswith("apps" + os.sep) and path.count(os.sep) > 1
+    }
+    for app_name, chain in extends_chains.items():
+        if not changed.isdisjoint(chain):
+            affected.add(app_name)
+    return affected
 
 
 class AppDefinitions:
-    def __init__(self, name, apps: dict[str, App] | None = None, path: str | None = None):
+    def __init__(
+        self,
+        name,
+        apps: dict[str, App] | None = None,
+        path: str | None = None,
+        app_names: Iterable[str] | None = None,
+    ):
+        """
+        :params name: The name of the cluster repo
+        :params apps: The apps, if they're already loaded
+        :params path: The path to a checkout of the cluster repo to load apps from
+        :params app_names: Only load these apps from `path`, rather than all of them
+
+        Apps already in `apps` aren't loaded again from `path`.
+        """
         self.name = name
         self.apps = apps or {}
 
         if path:
-            path = os.path.join(path, "apps")
+            # Loaded serially: the server loads large repos with `load_apps_in_background`.
+            for app in load_apps(get_app_entries(path, app_names, skip=self.apps)):
+                self.apps[app.name] = app
 
-            for entry in os.listdir(path):
-                entry_path = os.path.join(path, entry)
-                if entry[0] != "." and not os.path.isfile(entry_path):
-                    app = App(entry, entry_path, account_id=settings.ACCOUNT_ID)
-                    self.apps[entry] = app
+        # Every app, including those filtered out below, so they can be reused.
+        self.loaded_apps = dict(self.apps)
 
         # Removing apps that are suspended or not part of this cluster
         for app in list(self.apps.values()):
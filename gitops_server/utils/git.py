@@ -6,6 +6,7 @@ import tempfile
 from collections.abc import AsyncGenerator
 from contextlib import asynccontextmanager
 from pathlib import Path
+from typing import TypeGuard
 
 from opentelemetry.trace import get_tracer
 
@@ -16,7 +17,12 @@ logger = logging.getLogger("gitops")
 
 REPO_CACHE_DIR = Path("/tmp/gitops/repocache")
 REPO_CACHE: dict[str, Path] = {}
-repo_lock = asyncio.Semaphore(1)
+# Guards changes to each cached repo (cloning, fetching, adding worktrees), by repo url.
+REPO_LOCKS: dict[str, asyncio.Lock] = {}
+# Fetches in progress, by repo url.
+FETCHES: dict[str, asyncio.Future] = {}
+# What files encrypted by git-crypt start with.
+GIT_CRYPT_HEADER = b"\0GITCRYPT\0"
 
 
 async def clone_repo(git_repo_url: str, path: str, sha: str | None = None, branch: str | None = None):
@@ -38,13 +44,104 @@ async def clone_repo(git_repo_url: str, path: str, sha: str | None = None, branc
             await run(f"cd {path}; git-crypt unlock {GIT_CRYPT_KEY_FILE}")
 
 
-def is_sha(sha_or_ref: str | None) -> bool:
+def is_sha(sha_or_ref: str | None) -> TypeGuard[str]:
     """Check if the given string is a valid SHA-1 hash or a short SHA."""
     if not sha_or_ref:
         return False
     return bool(re.fullmatch(r"[a-fA-F0-9]{4,40}", sha_or_ref))
 
 
+def get_repo_lock(git_repo_url: str) -> asyncio.Lock:
+    return REPO_LOCKS.setdefault(git_repo_url, asyncio.Lock())
+
+
+async def ensure_repo_cache(git_repo_url: str) -> Path:
+    """Clones git_repo_url into the repo cache, if it isn't there already. Returns the cached repo's path"""
+    cache_path = REPO_CACHE_DIR / git_repo_url.split("/")[-1].split(".")[0]
+
+    if not (cache_path / ".git").exists():
+        async with get_repo_lock(git_repo_url):
+            # Someone else may have cloned it while we waited.
+            if not (cache_path / ".git").exists():
+                logger.info("Repo %s not in cache, cloning", git_repo_url)
+                if cache_path.exists():
+                    await run(f"rm -rf {cache_path}", suppress_errors=True)
+                if not cache_path.exists():
+                    cache_path.mkdir(parents=True)
+                REPO_CACHE[git_repo_url] = cache_path
+                await clone_repo(git_repo_url, path=str(cache_path))
+    return cache_path
+
+
+async def has_commit(cache_path: Path, sha: str) -> bool:
+    result = await run(f"cd {cache_path}; git cat-file -e {sha}^{{commit}}", suppress_errors=True)
+    return result["exit_code"] == 0
+
+
+async def fetch_repo(git_repo_url: str) -> None:
+    """Fetches into the repo cache of git_repo_url. Concurrent calls wait on the same fetch"""
+    if (fetch := FETCHES.get(git_repo_url)) is None:
+        fetch = FETCHES[git_repo_url] = asyncio.ensure_future(_fetch_repo(git_repo_url))
+    # Shielded, so one caller being cancelled doesn't cancel the fetch for the others.
+    await asyncio.shield(fetch)
+
+
+async def _fetch_repo(git_repo_url: str) -> None:
+    try:
+        cache_path = await ensure_repo_cache(git_repo_url)
+        with tracer.start_as_current_span("fetch_repo"):
+            async with get_repo_lock(git_repo_url):
+                await run(f"cd {cache_path}; git fetch", suppress_errors=True)
+    finally:
+        # Later callers start a fresh fetch.
+        del FETCHES[git_repo_url]
+
+
+async def ensure_commits(git_repo_url: str, *shas: str) -> Path:
+    """Makes sure the repo cache has shas, only fetching if it doesn't already. Returns the cached repo's path"""
+    cache_path = await ensure_repo_cache(git_repo_url)
+    # A fetch that was already in progress may have started before the commits were
+    # pushed, so try a second, fresh fetch before giving up.
+    for _ in range(2):
+        if all([await has_commit(cache_path, sha) for sha in shas]):
+            break
+        await fetch_repo(git_repo_url)
+    return cache_path
+
+
+async def get_changed_paths(git_repo_url: str, before: str, after: str) -> list[str] | None:
+    """Paths changed between two commits, from a tree diff on the cached repo.
+
+    Returns None if the diff can't be worked out (eg. `before` is missing for a new
+    branch, or is beyond the cache's shallow history).
+    """
+    if not (is_sha(before) and is_sha(after)) or set(before) == {"0"}:
+        return None
+    with tracer.start_as_current_span("get_changed_paths"):
+        cache_path = await ensure_commits(git_repo_url, before, after)
+        result = await run(
+            f"cd {cache_path}; git diff --name-only --no-renames -z {before} {after}", suppress_errors=True
+        )
+    if result["exit_code"] != 0:
+        logger.warning("Could not diff %s..%s: %s", before, after, result["output"])
+        return None
+    return [path for path in result["output"].split("\0") if path]
+
+
+async def get_tree_hashes(repo_path: str) -> dict[str, str]:
+    """The git object hash of every file and directory of a checkout's HEAD, by path relative to the repo root.
+
+    A directory's hash changes whenever anything inside it does.
+    """
+    result = await run("git ls-tree -r -t -z --full-tree HEAD", cwd=repo_path)
+    hashes = {}
+    for entry in result["output"].split("\0"):
+        if entry:
+            info, path = entry.split("\t", 1)
+            hashes[path] = info.split()[2]
+    return hashes
+
+
 @asynccontextmanager
 async def temp_repo(git_repo_url: str, ref: str | None) -> AsyncGenerator[str, None]:
     """Checks out a git_repo_url to a temporary folder location. Returns temporary folder location"""
@@ -56,26 +153,67 @@ async def temp_repo(git_repo_url: str, ref: str | None) -> AsyncGenerator[str, N
             return
 
     with tracer.start_as_current_span("checkout_temp_repo"):
-        cache_path = REPO_CACHE_DIR / git_repo_url.split("/")[-1].split(".")[0]
-
-        # Prep the repo cache
-        if not (cache_path / ".git").exists():
-            logger.info("Repo %s not in cache, cloning", git_repo_url)
-            async with repo_lock:
-                if cache_path.exists():
-                    await run(f"rm -rf {cache_path}", suppress_errors=True)
-                if not cache_path.exists():
-                    cache_path.mkdir(parents=True)
-                REPO_CACHE[git_repo_url] = cache_path
-                await clone_repo(git_repo_url, path=str(cache_path))
-
-        # Copy the repo cache to a temporary folder
         with tempfile.TemporaryDirectory() as temporary_folder_path:
-            await run(f"rm -rf {temporary_folder_path}", suppress_errors=True)
-            await run(f"cp -r {cache_path} {temporary_folder_path}")
-            await run(f"cd {temporary_folder_path};git fetch; git checkout {ref}")
-
-            yield temporary_folder_path
+            await checkout_repo(git_repo_url, ref, temporary_folder_path)
+            try:
+                yield temporary_folder_path
+            finally:
+                await remove_checkout(git_repo_url, temporary_folder_path)
+
+
+async def checkout_repo(git_repo_url: str, sha: str, path: str) -> None:
+    """Checks out git_repo_url at sha to path, as a worktree of the repo cache. Anything already at path is replaced
+
+    Worktrees share the cache's object database, so a checkout only costs writing the
+    files of that commit. Remove them with `remove_checkout`; worktrees whose folder
+    was deleted some other way are pruned by the next checkout.
+
+    If git-crypt didn't decrypt the worktree, the whole cache is copied instead. Raises
+    if files are still encrypted after that, rather than deploying them.
+    """
+    cache_path = await ensure_commits(git_repo_url, sha)
+    await run(f"rm -rf {path}", suppress_errors=True)
+    # Adding and pruning worktrees both write to the cache's shared metadata.
+    async with get_repo_lock(git_repo_url):
+        await run(f"cd {cache_path}; git worktree prune")
+        await run(f"cd {cache_path}; git worktree add --detach {path} {sha}")
+        if not await get_encrypted_paths(path):
+            return
+        # Whether git-crypt finds its key from a linked worktree depends on its version, so
+        # fall back to copying the (unlocked) cache, which keeps the key alongside it.
+        logger.warning("Worktree of %s at %s was not decrypted, copying the repo cache instead", git_repo_url, sha)
+        await run(f"cd {cache_path}; git worktree remove --force {path}", suppress_errors=True)
+        await run(f"rm -rf {path}", suppress_errors=True)
+        await run(f"cp -r {cache_path} {path}; cd {path}; git checkout {sha}")
+    if encrypted_paths := await get_encrypted_paths(path):
+        raise Exception(f"Could not decrypt {', '.join(encrypted_paths)} of {git_repo_url} at {sha}")
+
+
+async def get_encrypted_paths(repo_path: str) -> list[str]:
+    """Paths of a checkout that git-crypt should have decrypted, but are still encrypted.
+
+    Always empty when there's no git-crypt key to unlock with.
+    """
+    if not os.environ.get("GIT_CRYPT_KEY_FILE"):
+        return []
+    result = await run("git ls-files -z | git check-attr -z --stdin filter", cwd=repo_path)
+    # Output is a list of path, attribute, value triples.
+    fields = result["output"].split("\0")
+    paths = [path for path, value in zip(fields[::3], fields[2::3], strict=False) if value == "git-crypt"]
+    encrypted_paths = []
+    for path in paths:
+        with open(Path(repo_path) / path, "rb") as f:
+            if f.read(len(GIT_CRYPT_HEADER)) == GIT_CRYPT_HEADER:
+                encrypted_paths.append(path)
+    return encrypted_paths
+
+
+async def remove_checkout(git_repo_url: str, path: str) -> None:
+    """Removes a checkout made by `checkout_repo`."""
+    cache_path = await ensure_repo_cache(git_repo_url)
+    async with get_repo_lock(git_repo_url):
+        await run(f"cd {cache_path}; git worktree remove --force {path}", suppress_errors=True)
+    await run(f"rm -rf {path}", suppress_errors=True)
 
 
 @asynccontextmanager
@@ -0,0 +1,281 @@
+"""Built git chart checkouts, shared between the apps deploying them.
+
+Most apps of a cluster deploy the same chart at the same commit, so rather than each
+app checking out the chart and running `helm dependency build` itself, each distinct
+`(repo, sha)` is prepared once and the built chart is handed to every app using it.
+The checkout is shared, so users must treat it as read only.
+
+The dependencies of a chart rarely change between commits, so the tarballs that
+`helm dependency build` downloads are also kept by the digest of the files that pin
+them (see `DependencyCache`).
+
+Charts from helm repos are handled similarly: each repo is only added once (see
+`HelmRepos`), and each released chart version only pulled once (see `ChartTarballs`).
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import time
+from collections.abc import AsyncGenerator, Awaitable, Callable
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+
+import yaml
+
+from gitops.common.utils import safe_load
+
+logger = logging.getLogger("gitops")
+
+
+@dataclass
+class Workspace:
+    path: str
+    # Done once the chart is checked out and built.
+    ready: asyncio.Future
+    # How many deploys are using the workspace right now.
+    users: int = 0
+    last_used: float = field(default_factory=time.monotonic)
+
+
+class ChartWorkspaces:
+    def __init__(
+        self,
+        prepare: Callable[[str, str, str], Awaitable[None]],
+        max_workspaces: int,
+        max_age: float,
+    ):
+        """
+        :params prepare: Checks out and builds the chart of a repo url and sha to a path
+        :params max_workspaces: How many workspaces to keep once they're no longer in use
+        :params max_age: How long (in seconds) to keep workspaces after they were last used
+        """
+        self.prepare = prepare
+        self.max_workspaces = max_workspaces
+        self.max_age = max_age
+        self.workspaces: dict[tuple[str, str], Workspace] = {}
+
+    @asynccontextmanager
+    async def checkout(self, url: str, sha: str) -> AsyncGenerator[str, None]:
+        """The path of the built chart in `url` at `sha`.
+
+        Concurrent checkouts of the same chart wait on a single preparation, and a
+        workspace is never removed while it is in use.
+        """
+        key = (url, sha)
+        workspace = self.workspaces.get(key)
+        if workspace is None:
+            path = tempfile.mkdtemp(prefix="gitops-chart-")
+            workspace = Workspace(path, asyncio.ensure_future(self._prepare(key, path)))
+            self.workspaces[key] = workspace
+        workspace.users += 1
+        try:
+            # Shielded, so one user being cancelled doesn't cancel the others' preparation.
+            await asyncio.shield(workspace.ready)
+            yield workspace.path
+        finally:
+            workspace.users -= 1
+            workspace.last_used = time.monotonic()
+            await self.evict()
+
+    async def _prepare(self, key: tuple[str, str], path: str) -> None:
+        try:
+            await self.prepare(*key, path)
+        except BaseException:
+            # Forget the failed workspace, so the next checkout tries again.
+            if (workspace := self.workspaces.get(key)) and workspace.path == path:
+                del self.workspaces[key]
+            await asyncio.to_thread(shutil.rmtree, path, True)
+            raise
+
+    async def evict(self) -> None:
+        """Remove unused workspaces beyond `max_workspaces`, oldest first, or older than `max_age`."""
+        now = time.monotonic()
+        excess = len(self.workspaces) - self.max_workspaces
+        idle = sorted(
+            (
+                (key, workspace)
+                for key, workspace in self.workspaces.items()
+                if workspace.users == 0 and workspace.ready.done()
+            ),
+            key=lambda item: item[1].last_used,
+        )
+        for key, workspace in idle:
+            if excess <= 0 and now - workspace.last_used < self.max_age:
+                continue
+            # Removing earlier workspaces yields to other tasks, which may have started using this one.
+            if workspace.users or self.workspaces.get(key) is not workspace:
+                continue
+            logger.info("Removing chart workspace for %s at %s.", *key)
+            del self.workspaces[key]
+            excess -= 1
+            await asyncio.to_thread(shutil.rmtree, workspace.path, True)
+
+
+# The files that decide what `helm dependency build` fetches. At least one lock file is
+# needed, otherwise version ranges can resolve differently from one build to the next.
+DEPENDENCY_FILES = ["Chart.yaml", "requirements.yaml"]
+DEPENDENCY_LOCK_FILES = ["Chart.lock", "requirements.lock"]
+
+
+def has_local_dependencies(chart_path: str) -> bool:
+    """Whether the chart has subcharts committed in `charts/`, or `file://` dependencies.
+
+    Their content isn't pinned by the lock file, so can change without the digest changing.
+    """
+    if os.path.exists(os.path.join(chart_path, "charts")):
+        return True
+    for name in DEPENDENCY_FILES:
+        try:
+            with open(os.path.join(chart_path, name), "rb") as f:
+                values = safe_load(f.read())
+        except OSError:
+            continue
+        except yaml.YAMLError:
+            return True
+        dependencies = values.get("dependencies") if isinstance(values, dict) else None
+        for dependency in dependencies if isinstance(dependencies, list) else []:
+            if isinstance(dependency, dict) and str(dependency.get("repository", "")).startswith("file://"):
+                return True
+    return False
+
+
+def get_dependencies_digest(chart_path: str) -> str | None:
+    """A digest of the chart's pinned dependencies, or None if they aren't pinned (or are local)."""
+    if has_local_dependencies(chart_path):
+        return None
+    digest = hashlib.sha256()
+    locked = False
+    for name in DEPENDENCY_FILES + DEPENDENCY_LOCK_FILES:
+        try:
+            with open(os.path.join(chart_path, name), "rb") as f:
+                content = f.read()
+        except OSError:
+            continue
+        locked = locked or name in DEPENDENCY_LOCK_FILES
+        digest.update(f"{name}\0{len(content)}\0".encode())
+        digest.update(content)
+    return digest.hexdigest() if locked else None
+
+
+class DependencyCache:
+    """Downloaded dependency tarballs, by the digest of the dependencies they were built from.
+
+    Only charts without local dependencies are cached, so their `charts/` folder holds
+    nothing but what `helm dependency build` downloaded.
+    """
+
+    def __init__(self, path: str, max_entries: int):
+        """
+        :params path: The folder to keep built dependencies in
+        :params max_entries: How many sets of dependencies to keep, dropping the least recently used
+        """
+        self.path = path
+        self.max_entries = max_entries
+
+    def restore(self, digest: str, chart_path: str) -> bool:
+        """Copy the dependencies built for `digest` into the chart, if there are any.
+
+        Files already in the chart's `charts/` folder are left alone.
+        """
+        entry = os.path.join(self.path, digest)
+        if not os.path.isdir(entry):
+            return False
+        charts_path = os.path.join(chart_path, "charts")
+        os.makedirs(charts_path, exist_ok=True)
+        for name in os.listdir(entry):
+            if not os.path.exists(destination := os.path.join(charts_path, name)):
+                shutil.copy2(os.path.join(entry, name), destination)
+        os.utime(entry)
+        return True
+
+    def store(self, digest: str, chart_path: str) -> None:
+        """Keep the dependencies just built in the chart for `digest`."""
+        os.makedirs(self.path, exist_ok=True)
+        # Copied aside first and renamed into place, so entries are never seen half written.
+        staging = tempfile.mkdtemp(prefix=".staging-", dir=self.path)
+        if os.path.isdir(charts_path := os.path.join(chart_path, "charts")):
+            for name in os.listdir(charts_path):
+                if name.endswith(".tgz") and os.path.isfile(path := os.path.join(charts_path, name)):
+                    shutil.copy2(path, staging)
+        try:
+            os.rename(staging, os.path.join(self.path, digest))
+        except OSError:
+            # Someone else stored the same dependencies first.
+            shutil.rmtree(staging, ignore_errors=True)
+        self.evict()
+
+    def evict(self) -> None:
+        entries = sorted(
+            (entry for entry in os.scandir(self.path) if not entry.name.startswith(".")),
+            key=lambda entry: entry.stat().st_mtime,
+        )
+        for entry in entries[: max(len(entries) - self.max_entries, 0)]:
+            logger.info("Removing cached chart dependencies %s.", entry.name)
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+class HelmRepos:
+    """The helm repos added with `helm repo add`, and when their indexes were last refreshed."""
+
+    def __init__(self, update_interval: float):
+        """
+        :params update_interval: How long (in seconds) to use a repo's index before refreshing it
+        """
+        self.update_interval = update_interval
+        self.urls: dict[str, str] = {}
+        self.updated_at: dict[str, float] = {}
+        self.locks: dict[str, asyncio.Lock] = {}
+
+    def get_lock(self, name: str) -> asyncio.Lock:
+        return self.locks.setdefault(name, asyncio.Lock())
+
+    def is_added(self, name: str, url: str) -> bool:
+        return self.urls.get(name) == url
+
+    def is_stale(self, name: str) -> bool:
+        return time.monotonic() - self.updated_at.get(name, float("-inf")) >= self.update_interval
+
+    def mark_updated(self, name: str, url: str) -> None:
+        self.urls[name] = url
+        self.updated_at[name] = time.monotonic()
+
+
+class ChartTarballs:
+    """Chart tarballs pulled from helm repos, by repo url, chart and version.
+
+    A released chart version doesn't change, so once pulled it is kept for good.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.locks: dict[str, asyncio.Lock] = {}
+
+    def get_key(self, repo_url: str, chart: str, version: str) -> str:
+        return hashlib.sha256(f"{repo_url}\0{chart}\0{version}".encode()).hexdigest()
+
+    def get_lock(self, key: str) -> asyncio.Lock:
+        return self.locks.setdefault(key, asyncio.Lock())
+
+    def get(self, key: str) -> str | None:
+        """The path of the pulled tarball, if there is one."""
+        folder = os.path.join(self.path, key)
+        if not os.path.isdir(folder):
+            return None
+        tarballs = [name for name in os.listdir(folder) if name.endswith(".tgz")]
+        return os.path.join(folder, tarballs[0]) if tarballs else None
+
+    def make_staging_folder(self) -> str:
+        """A folder to pull a tarball into, before it's added with `add`."""
+        os.makedirs(self.path, exist_ok=True)
+        return tempfile.mkdtemp(prefix=".staging-", dir=self.path)
+
+    def add(self, key: str, staging_folder: str) -> str | None:
+        folder = os.path.join(self.path, key)
+        # Anything already there didn't have a tarball, so isn't worth keeping.
+        shutil.rmtree(folder, ignore_errors=True)
+        os.rename(staging_folder, folder)
+        return self.get(key)
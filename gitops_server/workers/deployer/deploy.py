@@ -4,16 +4,30 @@ import logging
 import os
 import tempfile
 import uuid
+from collections.abc import AsyncGenerator, Awaitable, Callable, Iterable
+from contextlib import AsyncExitStack, asynccontextmanager
 
 from opentelemetry import trace
 
-from gitops.common.app import App
+from gitops.common.app import App, Chart
 from gitops_server import settings
-from gitops_server.types import AppDefinitions, UpdateAppResult
+from gitops_server.types import (
+    AppDefinitions,
+    UpdateAppResult,
+    get_affected_app_names,
+    get_app_entries,
+    get_extends_chains,
+    load_apps_in_background,
+)
 from gitops_server.utils import get_repo_name_from_url, github, run, slack
-from gitops_server.utils.git import temp_repo
+from gitops_server.utils.git import checkout_repo, get_changed_paths, get_tree_hashes, is_sha, temp_repo
 
+from .charts import ChartTarballs, ChartWorkspaces, DependencyCache, HelmRepos, get_dependencies_digest
 from .hooks import handle_failed_deploy, handle_successful_deploy
+from .journal import DeployProgress
+from .locks import AppLocks
+from .scheduler import DeployScheduler, parse_tag_values
+from .snapshots import AppSnapshots, Snapshot, get_app_keys
 
 tracer = trace.get_tracer(__name__)
 
@@ -22,6 +36,91 @@ ROLE_ARN = f"arn:aws:iam::{settings.ACCOUNT_ID}:role/GitopsAccess"
 logger = logging.getLogger("gitops")
 GITOPS_MAX_PARALLEL_DEPLOYS = os.environ.get("GITOPS_MAX_PARALLEL_DEPLOYS", "5")
 MAX_HELM_HISTORY = 3
+# Files apps have been seen to `extends` (relative to the repo root), by cluster repo url.
+EXTENDS_BASES: dict[str, set[str]] = {}
+APP_SNAPSHOTS = AppSnapshots(settings.APP_DEFINITIONS_CACHE_SIZE, settings.APP_CACHE_SIZE)
+
+
+HELM_DEPENDENCIES = DependencyCache(settings.HELM_DEPENDENCY_CACHE_DIR, settings.HELM_DEPENDENCY_CACHE_SIZE)
+
+
+async def build_chart_dependencies(path: str) -> None:
+    """Run `helm dependency build` for a chart, unless the same dependencies were built before."""
+    digest = get_dependencies_digest(path)
+    if digest is not None and await asyncio.to_thread(HELM_DEPENDENCIES.restore, digest, path):
+        logger.info(f"Using cached chart dependencies {digest}.")
+        return
+    with tracer.start_as_current_span("helm_dependency_build"):
+        await run(f"cd {path}; helm dependency build")
+    if digest is not None:
+        await asyncio.to_thread(HELM_DEPENDENCIES.store, digest, path)
+
+
+async def prepare_chart(url: str, sha: str, path: str) -> None:
+    await checkout_repo(url, sha, path)
+    await build_chart_dependencies(path)
+
+
+CHART_WORKSPACES = ChartWorkspaces(prepare_chart, settings.CHART_CACHE_SIZE, settings.CHART_CACHE_MAX_AGE)
+
+
+HELM_REPOS = HelmRepos(settings.HELM_REPO_UPDATE_INTERVAL)
+CHART_TARBALLS = ChartTarballs(settings.HELM_CHART_CACHE_DIR)
+
+
+async def ensure_helm_repo(name: str, url: str) -> None:
+    """Add a helm repo if it hasn't been already, and refresh its index once it's stale."""
+    async with HELM_REPOS.get_lock(name):
+        if not HELM_REPOS.is_added(name, url):
+            force_update = " --force-update" if name in HELM_REPOS.urls else ""
+            with tracer.start_as_current_span("helm_repo_add"):
+                await run(f"helm repo add{force_update} {name} {url}")
+        elif HELM_REPOS.is_stale(name):
+            with tracer.start_as_current_span("helm_repo_update"):
+                await run(f"helm repo update {name}")
+        else:
+            return
+        HELM_REPOS.mark_updated(name, url)
+
+
+async def get_helm_chart(chart: Chart) -> str:
+    """The chart to deploy for a helm repo chart.
+
+    Versioned charts are pulled once and deployed from the local tarball after that,
+    without touching the repo. Unversioned charts follow the repo's latest release.
+    """
+    assert chart.helm_repo and chart.helm_repo_url and chart.helm_chart
+    if not chart.version:
+        await ensure_helm_repo(chart.helm_repo, chart.helm_repo_url)
+        return chart.helm_chart
+    key = CHART_TARBALLS.get_key(chart.helm_repo_url, chart.helm_chart, chart.version)
+    async with CHART_TARBALLS.get_lock(key):
+        if tarball := CHART_TARBALLS.get(key):
+            return tarball
+        await ensure_helm_repo(chart.helm_repo, chart.helm_repo_url)
+        staging_folder = CHART_TARBALLS.make_staging_folder()
+        with tracer.start_as_current_span("helm_pull"):
+            await run(f"helm pull {chart.helm_chart} --version={chart.version} --destination {staging_folder}")
+        tarball = CHART_TARBALLS.add(key, staging_folder)
+    if tarball is None:
+        raise Exception(f"Pulling {chart.helm_chart} {chart.version} didn't produce a chart tarball")
+    return tarball
+
+
+@asynccontextmanager
+async def built_chart(url: str, ref: str | None) -> AsyncGenerator[str, None]:
+    """A checkout of a git chart with its dependencies built, to be treated as read only.
+
+    Charts at a sha are shared between apps and deploys (see `ChartWorkspaces`), while
+    branches can move, so are checked out afresh each time.
+    """
+    if is_sha(ref):
+        async with CHART_WORKSPACES.checkout(url, ref) as chart_folder_path:
+            yield chart_folder_path
+        return
+    async with temp_repo(url, ref=ref) as chart_folder_path:
+        await build_chart_dependencies(chart_folder_path)
+        yield chart_folder_path
 
 
 @tracer.start_as_current_span("post_init_summary")
@@ -54,21 +153,74 @@ async def post_result(app: App, result: UpdateAppResult, deployer: "Deployer", *
 
 @tracer.start_as_current_span("post_result_summary")
 async def post_result_summary(source: str, results: list[UpdateAppResult]):
-    n_success = sum([r["exit_code"] == 0 for r in results])
+    superseded = sorted(r["app_name"] for r in results if r.get("superseded"))
+    n_success = sum([r["exit_code"] == 0 and not r.get("superseded") for r in results])
     n_failed = sum([r["exit_code"] != 0 for r in results])
-    await slack.post(
+    message = (
         f"Deployment from `{source}` for `{settings.CLUSTER_NAME}` results summary:\n"
         f"\t• {n_success} succeeded\n"
         f"\t• {n_failed} failed"
     )
+    if superseded:
+        apps = ", ".join(f"`{app}`" for app in superseded)
+        message += f"\n\t• {len(superseded)} superseded by a later deploy: {apps}"
+    await slack.post(message)
 
 
 @tracer.start_as_current_span("load_app_definitions")
-async def load_app_definitions(url: str, sha: str) -> AppDefinitions:
-    logger.info(f'Loading app definitions at "{sha}".')
-    async with temp_repo(url, ref=sha) as repo:
-        app_definitions = AppDefinitions(name=get_repo_name_from_url(url), path=repo)
-        return app_definitions
+async def load_app_definitions(
+    url: str, sha: str, app_names: Iterable[str] | None = None, changed_paths: Iterable[str] | None = None
+) -> AppDefinitions:
+    """Load the apps of a cluster repo at `sha`.
+
+    Only the apps in `app_names` are returned, if given. If `changed_paths` is given, only
+    the apps those paths affect are returned (see `get_affected_app_names`).
+
+    Recently loaded commits are served from memory, and only apps whose content changed
+    since they were last loaded are parsed (see `AppSnapshots`). Apps are only parsed
+    once they're asked for, so a commit seen for the first time only has the apps a
+    push affects parsed.
+    """
+    snapshot = APP_SNAPSHOTS.get(url, sha)
+    async with AsyncExitStack() as stack:
+        repo = None
+        if snapshot is None:
+            logger.info(f'Loading app definitions at "{sha}".')
+            repo = await stack.enter_async_context(temp_repo(url, ref=sha))
+            extends_chains = get_extends_chains(repo)
+            snapshot = Snapshot(
+                apps={},
+                extends_chains=extends_chains,
+                app_keys=get_app_keys(await get_tree_hashes(repo), extends_chains),
+            )
+            APP_SNAPSHOTS.add(url, sha, snapshot)
+
+        if changed_paths is not None:
+            affected_app_names = get_affected_app_names(changed_paths, snapshot.extends_chains)
+            app_names = affected_app_names if app_names is None else affected_app_names & set(app_names)
+        app_names = sorted(snapshot.app_keys if app_names is None else set(app_names) & snapshot.app_keys.keys())
+
+        missing = {name: snapshot.app_keys[name] for name in app_names if name not in snapshot.apps}
+        snapshot.apps.update(APP_SNAPSHOTS.get_apps(missing))
+        if missing := {name: key for name, key in missing.items() if name not in snapshot.apps}:
+            if repo is None:
+                logger.info(f'Loading app definitions at "{sha}".')
+                repo = await stack.enter_async_context(temp_repo(url, ref=sha))
+            loaded = {app.name: app for app in await load_apps_in_background(get_app_entries(repo, missing))}
+            APP_SNAPSHOTS.add_apps(loaded, missing)
+            snapshot.apps.update(loaded)
+
+    EXTENDS_BASES.setdefault(url, set()).update(path for chain in snapshot.extends_chains.values() for path in chain)
+    apps = {name: snapshot.apps[name] for name in app_names if name in snapshot.apps}
+    return AppDefinitions(name=get_repo_name_from_url(url), apps=apps)
+
+
+def make_deploy_scheduler() -> DeployScheduler:
+    return DeployScheduler(
+        int(GITOPS_MAX_PARALLEL_DEPLOYS),
+        priorities=parse_tag_values(settings.DEPLOY_PRIORITIES),
+        quotas=parse_tag_values(settings.DEPLOY_TAG_QUOTAS),
+    )
 
 
 class Deployer:
@@ -80,8 +232,21 @@ class Deployer:
         current_app_definitions: AppDefinitions,
         previous_app_definitions: AppDefinitions,
         skip_migrations: bool = False,
+        scheduler: DeployScheduler | None = None,
+        app_locks: AppLocks | None = None,
+        progress: DeployProgress | None = None,
+        authors: list[str] | None = None,
     ):
+        """
+        :params scheduler: Limits and orders the helm installs running at once, shared between deployers
+        :params app_locks: Orders changes to each app, shared between deployers
+        :params progress: Where to record each app as it's deployed, and which apps were
+            already deployed before a restart
+        :params authors: Everyone whose pushes are deployed together, to credit them all.
+            Defaults to just `author_name`.
+        """
         self.author_name = author_name
+        self.authors = authors or [author_name]
         self.author_email = author_email
         self.commit_message = commit_message
         self.current_app_definitions = current_app_definitions
@@ -90,21 +255,37 @@ class Deployer:
         self.skip_migrations = skip_migrations
         # Max parallel helm installs at a time
         # Kube api may rate limit otherwise
-        self.semaphore = asyncio.Semaphore(int(GITOPS_MAX_PARALLEL_DEPLOYS))
+        self.scheduler = scheduler or make_deploy_scheduler()
+        self.app_locks = app_locks or AppLocks()
+        # Places reserved in `app_locks` for the apps this deploy changes.
+        self.tickets: dict[str, asyncio.Future] = {}
+        self.progress = progress
 
     @classmethod
-    async def from_push_event(cls, push_event):
+    async def from_push_event(cls, push_event, changed_paths: Iterable[str] | None = None, **kwargs):
+        """
+        :params push_event: The body of a GitHub push webhook
+        :params changed_paths: Paths changed by the push, if already known. Otherwise they're
+            worked out with a diff, falling back to loading every app.
+        :params kwargs: Passed on to the deployer (eg. a shared `scheduler` and `app_locks`)
+        """
         url = push_event["repository"]["clone_url"]
         author_name = push_event.get("head_commit", {}).get("author", {}).get("name")
         author_email = push_event.get("head_commit", {}).get("author", {}).get("email")
         commit_message = push_event.get("head_commit", {}).get("message")
-        skip_migrations = "--skip-migrations" in commit_message
+        # Pushes deployed together (see `merge_pushes`) credit all their authors.
+        authors = [author["name"] for author in push_event.get("authors", []) if author.get("name")]
+        # Pushes deployed together only skip migrations if all of them asked to.
+        skip_migrations = push_event.get("skip_migrations", "--skip-migrations" in commit_message)
         logger.info(f'Initialising deployer for "{url}".')
         before = push_event["before"]
         after = push_event["after"]
-        current_app_definitions = await load_app_definitions(url, sha=after)
+        # Only apps affected by the push need loading, everything else is unchanged.
+        if changed_paths is None:
+            changed_paths = await get_changed_paths(url, before, after)
+        current_app_definitions = await load_app_definitions(url, sha=after, changed_paths=changed_paths)
         # TODO: Handle case where there is no previous commit.
-        previous_app_definitions = await load_app_definitions(url, sha=before)
+        previous_app_definitions = await load_app_definitions(url, sha=before, changed_paths=changed_paths)
         return cls(
             author_name,
             author_email,
@@ -112,10 +293,37 @@ class Deployer:
             current_app_definitions,
             previous_app_definitions,
             skip_migrations,
+            authors=authors or None,
+            **kwargs,
         )
 
     async def deploy(self):
+        """Deploy the changed apps.
+
+        Must be called in the order deploys should apply in: each changed app is
+        reserved in `app_locks` before anything is awaited, so later deploys of the same
+        apps wait for this one, while deploys of other apps can go ahead alongside it.
+        """
         added_apps, updated_apps, removed_apps = self.calculate_app_deltas()
+        if self.progress and self.progress.completed_apps:
+            completed_apps = self.progress.completed_apps
+            logger.info(f"Resuming deployment, skipping apps already deployed: {sorted(completed_apps)}")
+            added_apps, updated_apps, removed_apps = (
+                added_apps - completed_apps,
+                updated_apps - completed_apps,
+                removed_apps - completed_apps,
+            )
+        self.tickets = {
+            app_name: self.app_locks.reserve(app_name, owner=self)
+            for app_name in sorted(added_apps | updated_apps | removed_apps)
+        }
+        try:
+            await self._deploy(added_apps, updated_apps, removed_apps)
+        finally:
+            for app_name, ticket in self.tickets.items():
+                self.app_locks.release(app_name, ticket)
+
+    async def _deploy(self, added_apps, updated_apps, removed_apps):
         current_span = trace.get_current_span()
         if current_span:
             current_span.set_attribute("gitops.added_apps", len(added_apps))
@@ -130,7 +338,7 @@ class Deployer:
         )
         await post_init_summary(
             source=self.current_app_definitions.name,
-            username=self.author_name,
+            username=", ".join(self.authors),
             added_apps=added_apps,
             updated_apps=updated_apps,
             removed_apps=removed_apps,
@@ -138,18 +346,49 @@ class Deployer:
         )
         update_results = await asyncio.gather(
             *[
-                self.update_app_deployment(self.current_app_definitions.apps[app_name])
+                self.with_app_lock(app_name, self.update_app_deployment, self.current_app_definitions.apps[app_name])
                 for app_name in (added_apps | updated_apps)
             ]
         )
         uninstall_results = await asyncio.gather(
-            *[self.uninstall_app(self.previous_app_definitions.apps[app_name]) for app_name in removed_apps]
+            *[
+                self.with_app_lock(app_name, self.uninstall_app, self.previous_app_definitions.apps[app_name])
+                for app_name in removed_apps
+            ]
         )
         await post_result_summary(self.current_app_definitions.name, update_results + uninstall_results)
 
+    async def with_app_lock(
+        self, app_name: str, change: Callable[[App], Awaitable[UpdateAppResult | None]], app: App
+    ) -> UpdateAppResult | None:
+        """Make a change to an app once this deploy's turn for it comes up."""
+        async with self.app_locks.hold(app_name, self.tickets[app_name]):
+            result = await change(app)
+        if self.progress:
+            self.progress.complete_app(app_name, result)
+        return result
+
+    def is_superseded(self, app: App) -> bool:
+        """Whether a later deploy, already waiting on this one, is going to change the app again.
+
+        There's no point installing a version of the app that's about to be replaced,
+        unless this deploy runs migrations the later one would skip.
+        """
+        ticket = self.tickets.get(app.name)
+        if ticket is None:
+            return False
+        later = self.app_locks.superseded_by(app.name, ticket)
+        return later is not None and (self.skip_migrations or not later.skip_migrations)
+
+    def superseded_result(self, app: App) -> UpdateAppResult:
+        logger.info(f"Skipping app {app.name!r}: superseded by a later deploy.")
+        return UpdateAppResult(
+            app_name=app.name, exit_code=0, output="Superseded by a later deploy.", slack_message="", superseded=True
+        )
+
     async def uninstall_app(self, app: App) -> UpdateAppResult:
         with tracer.start_as_current_span("uninstall_app", attributes={"app": app.name}):
-            async with self.semaphore:
+            async with self.scheduler.slot(app):
                 logger.info(f"Uninstalling app {app.name!r}.")
                 result = await run(f"helm uninstall {app.name} -n {app.namespace}", suppress_errors=True)
                 if result:
@@ -163,25 +402,30 @@ class Deployer:
 
     async def update_app_deployment(self, app: App) -> UpdateAppResult | None:
         with tracer.start_as_current_span("update_app_deployment", attributes={"app": app.name}) as span:
+            # Loaded apps are shared between deploys, so label a copy.
+            app = app.copy()
             app.set_value("deployment.labels.gitops/deploy_id", self.deploy_id)
             app.set_value("deployment.labels.gitops/status", github.STATUSES.in_progress)
             if github_deployment_url := app.values.get("github/deployment_url"):
                 app.set_value("deployment.annotations.github/deployment_url", github_deployment_url)
 
-            async with self.semaphore:
+            # Checked again right before installing, as later deploys may queue up while the
+            # chart is built. Once `helm upgrade` has started it's always left to finish.
+            if self.is_superseded(app):
+                return self.superseded_result(app)
+            async with self.scheduler.slot(app):
                 logger.info(f"Deploying app {app.name!r}.")
                 if app.chart.type == "git":
                     span.set_attribute("gitops.chart.type", "git")
                     assert app.chart.git_repo_url
-                    async with temp_repo(app.chart.git_repo_url, ref=app.chart.git_sha) as chart_folder_path:
-                        with tracer.start_as_current_span("helm_dependency_build"):
-                            await run(f"cd {chart_folder_path}; helm dependency build")
-
+                    async with built_chart(app.chart.git_repo_url, app.chart.git_sha) as chart_folder_path:
                         with tempfile.NamedTemporaryFile(suffix=".yml") as cfg:
                             cfg.write(json.dumps(app.values).encode())
                             cfg.flush()
                             os.fsync(cfg.fileno())
 
+                            if self.is_superseded(app):
+                                return self.superseded_result(app)
                             with tracer.start_as_current_span("helm_upgrade"):
                                 result = await run(
                                     "helm secrets upgrade --create-namespace"
@@ -201,10 +445,10 @@ class Deployer:
                         cfg.write(json.dumps(app.values).encode())
                         cfg.flush()
                         os.fsync(cfg.fileno())
-                        chart_version_arguments = f" --version={app.chart.version}" if app.chart.version else ""
-                        with tracer.start_as_current_span("helm_repo_add"):
-                            await run(f"helm repo add {app.chart.helm_repo} {app.chart.helm_repo_url}")
+                        helm_chart = await get_helm_chart(app.chart)
 
+                        if self.is_superseded(app):
+                            return self.superseded_result(app)
                         with tracer.start_as_current_span("helm_upgrade"):
                             result = await run(
                                 "helm secrets upgrade --create-namespace"
@@ -215,7 +459,7 @@ class Deployer:
                                 f" -f {cfg.name}"
                                 f" --namespace={app.namespace}"
                                 f" {app.name}"
-                                f" {app.chart.helm_chart} {chart_version_arguments}",
+                                f" {helm_chart}",
                                 suppress_errors=True,
                             )
                 else:
@@ -0,0 +1,103 @@
+"""A durable record of queued pushes, and how far their deploys got.
+
+Pushes are written to an SQLite database (in WAL mode) as they're queued, along with
+each app as its deploy completes, and only forgotten once their whole deploy is done.
+If the server restarts part way through, the pushes left over are queued again, and
+only the apps not yet deployed for them are deployed.
+"""
+
+import json
+import os
+import sqlite3
+from collections.abc import Iterable
+from dataclasses import dataclass
+
+from gitops_server.types import UpdateAppResult
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pushes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    body TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS completed_apps (
+    push_id INTEGER NOT NULL,
+    app_name TEXT NOT NULL,
+    status TEXT NOT NULL,
+    PRIMARY KEY (push_id, app_name)
+);
+"""
+
+
+def get_status(result: UpdateAppResult | None) -> str:
+    if result is None:
+        return "skipped"
+    if result.get("superseded"):
+        return "superseded"
+    return "succeeded" if result["exit_code"] == 0 else "failed"
+
+
+class DeployJournal:
+    def __init__(self, path: str):
+        """
+        :params path: The SQLite database to keep the journal in, created if need be
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        # WAL keeps writes cheap, and NORMAL syncing is still safe against the server crashing.
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    def add_push(self, push: dict) -> int:
+        """Record a queued push, returning its id."""
+        with self.connection:
+            cursor = self.connection.execute("INSERT INTO pushes (body) VALUES (?)", (json.dumps(push),))
+        assert cursor.lastrowid is not None
+        return cursor.lastrowid
+
+    def get_pushes(self) -> list[tuple[int, dict]]:
+        """Every push whose deploy hasn't finished yet, in the order they were queued."""
+        rows = self.connection.execute("SELECT id, body FROM pushes ORDER BY id")
+        return [(push_id, json.loads(body)) for push_id, body in rows]
+
+    def get_progress(self, push_ids: Iterable[int]) -> "DeployProgress":
+        """The apps already deployed for every one of the pushes (deployed together)."""
+        push_ids = list(push_ids)
+        rows = self.connection.execute(
+            "SELECT app_name FROM completed_apps WHERE push_id IN (SELECT value FROM json_each(?))"
+            " GROUP BY app_name HAVING COUNT(*) = ?",
+            (json.dumps(push_ids), len(push_ids)),
+        )
+        return DeployProgress(self, push_ids, {app_name for (app_name,) in rows})
+
+    def complete_app(self, push_ids: Iterable[int], app_name: str, status: str) -> None:
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO completed_apps (push_id, app_name, status) VALUES (?, ?, ?)",
+                [(push_id, app_name, status) for push_id in push_ids],
+            )
+
+    def complete_pushes(self, push_ids: Iterable[int]) -> None:
+        """Forget pushes whose deploy has finished."""
+        rows = [(push_id,) for push_id in push_ids]
+        with self.connection:
+            self.connection.executemany("DELETE FROM completed_apps WHERE push_id = ?", rows)
+            self.connection.executemany("DELETE FROM pushes WHERE id = ?", rows)
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+@dataclass
+class DeployProgress:
+    """How far the deploy of some pushes has got (see `DeployJournal`)."""
+
+    journal: DeployJournal
+    push_ids: list[int]
+    # Apps deployed already, before a restart, so not to be deployed again.
+    completed_apps: set[str]
+
+    def complete_app(self, app_name: str, result: UpdateAppResult | None) -> None:
+        self.completed_apps.add(app_name)
+        self.journal.complete_app(self.push_ids, app_name, get_status(result))
@@ -0,0 +1,62 @@
+import asyncio
+from collections import deque
+from collections.abc import AsyncGenerator
+from contextlib import asynccontextmanager
+from typing import Any
+
+
+class AppLocks:
+    """A lock per app, handed out in the order it was reserved in (like a ticket queue).
+
+    Deploys reserve the apps they're going to change as soon as they start, so pushes
+    touching different apps can deploy at the same time, while changes to any one app
+    are still applied in the order the pushes came in.
+
+    A ticket with another queued behind it is out of date: a later deploy is going to
+    change the app again (see `superseded_by`).
+    """
+
+    def __init__(self) -> None:
+        # Reserved tickets for each app. The first holds the lock.
+        self.queues: dict[str, deque[asyncio.Future]] = {}
+        # Who reserved each ticket.
+        self.owners: dict[asyncio.Future, Any] = {}
+
+    def reserve(self, app_name: str, owner: Any = None) -> asyncio.Future:
+        """Take a ticket for the app's lock. It is done once the lock is held."""
+        ticket = asyncio.get_running_loop().create_future()
+        queue = self.queues.setdefault(app_name, deque())
+        queue.append(ticket)
+        self.owners[ticket] = owner
+        if len(queue) == 1:
+            ticket.set_result(None)
+        return ticket
+
+    def superseded_by(self, app_name: str, ticket: asyncio.Future) -> Any:
+        """The owner of the latest ticket for the app, if it was reserved after `ticket`."""
+        queue = self.queues.get(app_name)
+        if not queue or ticket not in queue or queue[-1] is ticket:
+            return None
+        return self.owners[queue[-1]]
+
+    def release(self, app_name: str, ticket: asyncio.Future) -> None:
+        """Give up a ticket, whether or not it holds the lock yet. Releasing twice is harmless."""
+        queue = self.queues.get(app_name)
+        if not queue or ticket not in queue:
+            return
+        held = queue[0] is ticket
+        queue.remove(ticket)
+        del self.owners[ticket]
+        if not queue:
+            del self.queues[app_name]
+        elif held:
+            queue[0].set_result(None)
+
+    @asynccontextmanager
+    async def hold(self, app_name: str, ticket: asyncio.Future) -> AsyncGenerator[None, None]:
+        """Wait for a reserved ticket to hold the app's lock, releasing it afterwards."""
+        try:
+            await asyncio.shield(ticket)
+            yield
+        finally:
+            self.release(app_name, ticket)
@@ -0,0 +1,125 @@
+"""Hands out the limited slots for helm installs, most important apps first.
+
+Each app belongs to a class: whichever of its tags has the highest configured
+priority, or `default`. Waiting installs are granted slots by stride scheduling between classes,
+so a class with twice the priority is granted twice as many slots, and goes first
+when every class is waiting. Lower priority classes still get their share, rather
+than waiting for every higher one to finish. Within a class, installs go in the order
+they asked for a slot.
+
+Tags can also have a quota, capping how many apps with the tag install at once.
+"""
+
+import asyncio
+from collections import Counter, deque
+from collections.abc import AsyncGenerator
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+
+from gitops.common.app import App
+
+DEFAULT_CLASS = "default"
+# Each grant moves a class this far along, divided by its priority.
+STRIDE = 1.0
+
+
+def parse_tag_values(value: str) -> dict[str, int]:
+    """Parse settings like "production=8,sandbox=1" into a number for each tag."""
+    tag_values = {}
+    for entry in value.split(","):
+        if not entry.strip():
+            continue
+        tag, _, number = entry.partition("=")
+        if not tag.strip() or not number.strip().isdigit() or int(number) < 1:
+            raise ValueError(f"Expected a tag and a positive number, like 'production=8', not {entry!r}.")
+        tag_values[tag.strip()] = int(number)
+    return tag_values
+
+
+@dataclass
+class Request:
+    tags: set[str]
+    granted: asyncio.Future = field(default_factory=lambda: asyncio.get_running_loop().create_future())
+
+
+class DeployScheduler:
+    def __init__(self, slots: int, priorities: dict[str, int], quotas: dict[str, int]):
+        """
+        :params slots: How many installs can run at once
+        :params priorities: The priority of each tag class. Unconfigured apps fall in `default`.
+        :params quotas: How many apps with each tag can install at once
+        """
+        self.free = slots
+        self.priorities = priorities
+        self.quotas = quotas
+        self.running: Counter[str] = Counter()
+        self.waiting: dict[str, deque[Request]] = {}
+        # When each class is next due a grant. The class furthest behind goes next.
+        self.passes: dict[str, float] = {}
+        # The pass of the last grant, where newly busy classes join in.
+        self.virtual_time = 0.0
+
+    def get_class(self, tags: list[str]) -> str:
+        configured = [tag for tag in tags if tag in self.priorities]
+        return max(configured, key=self.get_priority) if configured else DEFAULT_CLASS
+
+    def get_priority(self, tag_class: str) -> int:
+        return self.priorities.get(tag_class, self.priorities.get(DEFAULT_CLASS, 1))
+
+    @asynccontextmanager
+    async def slot(self, app: App) -> AsyncGenerator[None, None]:
+        """Wait for a slot to install the app in."""
+        tag_class = self.get_class(app.tags)
+        request = Request(set(app.tags) & self.quotas.keys())
+        queue = self.waiting.setdefault(tag_class, deque())
+        if not queue:
+            # A class doesn't build up credit while it has nothing waiting: it joins in
+            # one stride on from the last grant.
+            self.passes[tag_class] = max(
+                self.passes.get(tag_class, 0.0), self.virtual_time + STRIDE / self.get_priority(tag_class)
+            )
+        queue.append(request)
+        self.dispatch()
+        try:
+            await asyncio.shield(request.granted)
+        except BaseException:
+            if request.granted.done():
+                self.release(request)
+            else:
+                queue.remove(request)
+                if not queue and self.waiting.get(tag_class) is queue:
+                    del self.waiting[tag_class]
+            raise
+        try:
+            yield
+        finally:
+            self.release(request)
+
+    def fits(self, request: Request) -> bool:
+        return all(self.running[tag] < self.quotas[tag] for tag in request.tags)
+
+    def dispatch(self) -> None:
+        """Grant free slots to waiting installs."""
+        while self.free > 0:
+            candidates = []
+            for tag_class, queue in self.waiting.items():
+                # The first install of the class that isn't held back by a quota.
+                request = next((request for request in queue if self.fits(request)), None)
+                if request is not None:
+                    candidates.append((self.passes[tag_class], -self.get_priority(tag_class), tag_class, request))
+            if not candidates:
+                return
+            pass_, _, tag_class, request = min(candidates, key=lambda candidate: candidate[:3])
+            self.waiting[tag_class].remove(request)
+            if not self.waiting[tag_class]:
+                del self.waiting[tag_class]
+            self.virtual_time = pass_
+            self.passes[tag_class] = pass_ + STRIDE / self.get_priority(tag_class)
+            self.free -= 1
+            self.running.update(request.tags)
+            request.granted.set_result(None)
+
+    def release(self, request: Request) -> None:
+        self.free += 1
+        self.running.subtract(request.tags)
+        self.dispatch()
@@ -0,0 +1,98 @@
+"""In memory caches of app definitions parsed from cluster repos.
+
+Consecutive pushes share most of their apps: the `before` of a push is usually the
+`after` of the one preceding it, and a push only changes a few app directories.
+`AppSnapshots` keeps the apps loaded at recent commits, so the `before` side of a
+push needn't be checked out or parsed again, and reuses individual apps whose
+directory (and chain of `extends` parents) is unchanged between commits, so only
+the changed directories of the `after` side are parsed. Newly parsed apps share
+equal values with the apps already kept (see `ValueInterner`).
+"""
+
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from gitops.common.app import App
+from gitops.common.utils import ValueInterner
+
+# The interner is started afresh once it holds this many distinct lists and dictionaries,
+# so values of apps that have since been evicted don't accumulate.
+MAX_INTERNED_VALUES = 200_000
+
+# Identifies the content an app was parsed from: its name, the git tree hash of its
+# directory and the blob hashes of its `extends` parents.
+AppKey = tuple[str, str, tuple[str | None, ...]]
+
+
+@dataclass
+class Snapshot:
+    # The apps of the repo at the commit loaded so far, including those not part of this
+    # cluster. The others are loaded when they're first asked for.
+    apps: dict[str, App]
+    # The `extends` chain of each app, relative to the repo root.
+    extends_chains: dict[str, list[str]]
+    # The content key of every app in the repo at the commit (see `get_app_keys`).
+    app_keys: dict[str, AppKey]
+
+
+def get_app_keys(tree_hashes: dict[str, str], extends_chains: dict[str, list[str]]) -> dict[str, AppKey]:
+    """Content keys for each app of a commit (see `get_tree_hashes`)."""
+    return {
+        name: (name, tree_hashes[f"apps/{name}"], tuple(tree_hashes.get(path) for path in chain))
+        for name, chain in extends_chains.items()
+        if f"apps/{name}" in tree_hashes
+    }
+
+
+class AppSnapshots:
+    def __init__(self, max_snapshots: int, max_apps: int):
+        """
+        :params max_snapshots: How many commits to keep the apps of
+        :params max_apps: How many distinct apps to keep for reuse across commits
+        """
+        self.max_snapshots = max_snapshots
+        self.max_apps = max_apps
+        self.snapshots: OrderedDict[tuple[str, str], Snapshot] = OrderedDict()
+        self.apps: OrderedDict[AppKey, App] = OrderedDict()
+        self.interner = ValueInterner()
+
+    def get(self, url: str, sha: str) -> Snapshot | None:
+        snapshot = self.snapshots.get((url, sha))
+        if snapshot is not None:
+            self.snapshots.move_to_end((url, sha))
+        return snapshot
+
+    def add(self, url: str, sha: str, snapshot: Snapshot) -> None:
+        self.snapshots[(url, sha)] = snapshot
+        self.snapshots.move_to_end((url, sha))
+        while len(self.snapshots) > self.max_snapshots:
+            self.snapshots.popitem(last=False)
+
+    def get_apps(self, keys: dict[str, AppKey]) -> dict[str, App]:
+        """The apps already parsed from the same content as `keys`, by name."""
+        apps = {}
+        for name, key in keys.items():
+            app = self.apps.get(key)
+            if app is not None:
+                self.apps.move_to_end(key)
+                apps[name] = app
+        return apps
+
+    def add_apps(self, apps: dict[str, App], keys: dict[str, AppKey]) -> None:
+        """Keep `apps` for reuse, sharing the values of newly parsed ones with other apps."""
+        if len(self.interner) > MAX_INTERNED_VALUES:
+            self.interner.clear()
+        for name, app in apps.items():
+            if name not in keys:
+                continue
+            if keys[name] not in self.apps:
+                app.share_values(self.interner)
+            self.apps[keys[name]] = app
+            self.apps.move_to_end(keys[name])
+        while len(self.apps) > self.max_apps:
+            self.apps.popitem(last=False)
+
+    def clear(self) -> None:
+        self.snapshots.clear()
+        self.apps.clear()
+        self.interner.clear()
@@ -3,19 +3,115 @@ import logging
 
 from opentelemetry import trace
 
-from .deploy import Deployer
+from gitops_server import settings
+
+from .deploy import EXTENDS_BASES, Deployer, make_deploy_scheduler
+from .journal import DeployJournal, DeployProgress
+from .locks import AppLocks
 
 logger = logging.getLogger("gitops_worker")
 
 tracer = trace.get_tracer(__name__)
 
+# GitHub only includes (up to) this many commits in a push payload.
+MAX_PAYLOAD_COMMITS = 20
+
+
+def get_push_changed_paths(work: dict) -> set[str] | None:
+    """Paths changed by a push, according to its payload.
+
+    Returns None if the payload can't be relied on for the full picture: it may
+    have been truncated, or the push doesn't have a simple linear history.
+    """
+    commits = work.get("commits")
+    if not commits or len(commits) >= MAX_PAYLOAD_COMMITS:
+        return None
+    if work.get("forced") or work.get("created") or work.get("deleted"):
+        return None
+    changed_paths = set()
+    for commit in commits:
+        paths = [*commit.get("added", []), *commit.get("modified", []), *commit.get("removed", [])]
+        if not paths:
+            # Merge commits and very large commits come without file lists.
+            return None
+        changed_paths.update(paths)
+    return changed_paths
+
+
+def is_relevant_push(url: str, changed_paths: set[str]) -> bool:
+    """Whether a push could have changed any app.
+
+    True if an app directory or a file apps have been seen to `extends` changed. Until
+    apps have been loaded from the repo, any yaml file might be an `extends` parent.
+    """
+    bases = EXTENDS_BASES.get(url)
+    for path in changed_paths:
+        if path.startswith("apps/") and path.count("/") >= 2:
+            return True
+        if bases is None and path.endswith((".yml", ".yaml")):
+            return True
+        if bases is not None and path in bases:
+            return True
+    return False
+
+
+def group_pushes(pushes: list[dict]) -> list[list[dict]]:
+    """Split pushes into runs of consecutive pushes that can be deployed as one.
+
+    A push joins the run before it if it's to the same repo and branch, and carries on
+    from where the previous push left off (its `before` is the other's `after`).
+    """
+    groups: list[list[dict]] = []
+    for push in pushes:
+        if groups:
+            previous = groups[-1][-1]
+            if (
+                push["repository"]["clone_url"] == previous["repository"]["clone_url"]
+                and push.get("ref") == previous.get("ref")
+                and push.get("before") == previous.get("after")
+            ):
+                groups[-1].append(push)
+                continue
+        groups.append([push])
+    return groups
+
+
+def merge_pushes(pushes: list[dict]) -> dict:
+    """A single push covering every push in a run (see `group_pushes`).
+
+    It goes from the first push's `before` to the last push's `after`, with every commit
+    message along the way. The head commit keeps the last push's author, who is told if
+    the deploy fails, and every author is credited in `authors`. Migrations are only
+    skipped if every push asked for them to be.
+    """
+    if len(pushes) == 1:
+        return pushes[0]
+    head_commits = [push.get("head_commit") or {} for push in pushes]
+    authors = [head_commit.get("author", {}) for head_commit in head_commits]
+    messages = [head_commit.get("message") or "" for head_commit in head_commits]
+    return {
+        **pushes[-1],
+        "before": pushes[0]["before"],
+        "commits": [commit for push in pushes for commit in push.get("commits") or []],
+        "forced": any(push.get("forced") for push in pushes),
+        "created": pushes[0].get("created", False),
+        "head_commit": {**head_commits[-1], "message": "\n\n".join(messages)},
+        "authors": [author for i, author in enumerate(authors) if author and author not in authors[:i]],
+        "skip_migrations": all("--skip-migrations" in message for message in messages),
+    }
+
 
 class DeployQueueWorker:
-    """Simple synchronous background work queue.
+    """Simple background work queue.
 
-    Deployments need to be carried out one at a time to ensure the cluster
-    doesn't get confused. The worker is based entirely on asyncio and runs
-    alongside the server for maximum efficiency.
+    Pushes are picked up one at a time, in order, but their deploys run alongside
+    each other: each app is locked while it's deployed (see `AppLocks`), so changes to
+    any one app are still applied in order without pushes to other apps waiting on
+    them. The worker is based entirely on asyncio and runs alongside the server for
+    maximum efficiency.
+
+    Queued pushes are also recorded on disk (see `DeployJournal`), so any left over
+    after a restart are picked up again where their deploys left off.
     """
 
     _worker = None
@@ -27,7 +123,17 @@ class DeployQueueWorker:
         return cls._worker
 
     def __init__(self):
-        self.queue = asyncio.Queue()
+        self.queue: asyncio.Queue[tuple[int, dict]] = asyncio.Queue()
+        self.journal = DeployJournal(settings.DEPLOY_QUEUE_PATH)
+        # Pushes left over from before a restart go first.
+        for push_id, work in self.journal.get_pushes():
+            self.queue.put_nowait((push_id, work))
+        if not self.queue.empty():
+            logger.info(f"Resuming {self.queue.qsize()} pushes queued before a restart.")
+        # Shared by every deploy, so helm installs are limited across the cluster.
+        self.scheduler = make_deploy_scheduler()
+        self.app_locks = AppLocks()
+        self.deploys: set[asyncio.Task] = set()
 
     async def enqueue(self, work):
         """Enqueue an item of work for future processing.
@@ -35,13 +141,14 @@ class DeployQueueWorker:
         The `work` argument is the body of an incoming GitHub push webhook.
         """
         logger.info(f"Enqueued work, {self.queue.qsize() + 1} items in the queue.")
-        await self.queue.put(work)
+        push_id = self.journal.add_push(work)
+        await self.queue.put((push_id, work))
 
     async def run(self):
         """Run the worker.
 
-        Enters into a loop that waits for work to be queued. Each task is
-        awaited here to ensure synchronous operation.
+        Enters into a loop that waits for work to be queued. Each push is
+        loaded here in turn, and its deploy started in the background.
         # TODO: Need to gracefully handle termination.
         """
         logger.info("Starting up deployer worker loop")
@@ -52,16 +159,78 @@ class DeployQueueWorker:
                 logger.error(str(e), exc_info=True)
 
     async def process_work(self):
-        work = await self.queue.get()
-        ref = work.get("ref")
-        logger.info(f'Have a push to "{ref}".')
-        if ref == "refs/heads/master":
-            with tracer.start_as_current_span("gitops_process_webhook") as current_span:
-                deployer = await Deployer.from_push_event(work)
-                current_span.set_attribute("gitops.ref", ref)
-                current_span.set_attribute("gitops.after", work.get("after"))
-                current_span.set_attribute("gitops.before", work.get("before"))
-                current_span.set_attribute("gitops.author_email", deployer.author_email)
-                current_span.set_attribute("gitops.author_name", deployer.author_name)
-                current_span.set_attribute("gitops.commit_message", deployer.commit_message)
-                await deployer.deploy()
+        """Deploy the next push, along with any others that have queued up behind it.
+
+        Runs of consecutive pushes are deployed as one, straight to the latest commit,
+        rather than deploying every intermediate commit in turn.
+        """
+        items = [await self.queue.get()]
+        while not self.queue.empty():
+            items.append(self.queue.get_nowait())
+        # The journal's id of each push, by the identity of its payload.
+        push_ids = {id(work): push_id for push_id, work in items}
+        master_pushes = []
+        for _, work in items:
+            ref = work.get("ref")
+            logger.info(f'Have a push to "{ref}".')
+            if ref == "refs/heads/master":
+                master_pushes.append(work)
+            else:
+                self.journal.complete_pushes([push_ids[id(work)]])
+
+        for group in group_pushes(master_pushes):
+            if len(group) > 1:
+                logger.info(f"Deploying {len(group)} consecutive pushes together.")
+            group_ids = [push_ids[id(work)] for work in group]
+            try:
+                await self.deploy_pushes(group, self.journal.get_progress(group_ids))
+            except Exception as e:
+                # Carry on with the rest of the pushes.
+                logger.error(str(e), exc_info=True)
+                self.journal.complete_pushes(group_ids)
+
+    async def deploy_pushes(self, pushes: list[dict], progress: DeployProgress):
+        work = merge_pushes(pushes)
+        changed_paths: set[str] | None = set()
+        for push in pushes:
+            push_changed_paths = get_push_changed_paths(push)
+            if push_changed_paths is None or changed_paths is None:
+                changed_paths = None
+            else:
+                changed_paths |= push_changed_paths
+        if changed_paths is not None and not is_relevant_push(work["repository"]["clone_url"], changed_paths):
+            logger.info("Push doesn't change any apps; skipping.")
+            self.journal.complete_pushes(progress.push_ids)
+            return
+        with tracer.start_as_current_span("gitops_process_webhook") as current_span:
+            deployer = await Deployer.from_push_event(
+                work,
+                changed_paths=changed_paths,
+                scheduler=self.scheduler,
+                app_locks=self.app_locks,
+                progress=progress,
+            )
+            current_span.set_attribute("gitops.ref", work["ref"])
+            current_span.set_attribute("gitops.after", work["after"])
+            current_span.set_attribute("gitops.before", work["before"])
+            current_span.set_attribute("gitops.author_email", deployer.author_email)
+            current_span.set_attribute("gitops.author_name", deployer.author_name)
+            current_span.set_attribute("gitops.commit_message", deployer.commit_message)
+            # Tasks start in the order they're created, so deploys reserve their apps in
+            # the order the pushes came in.
+            deploy = asyncio.create_task(self.deploy(deployer, progress))
+            self.deploys.add(deploy)
+            deploy.add_done_callback(self.deploys.discard)
+
+    async def deploy(self, deployer: Deployer, progress: DeployProgress):
+        try:
+            await deployer.deploy()
+        except Exception as e:
+            logger.error(str(e), exc_info=True)
+        # Not reached if the deploy is cancelled (eg. on shutdown), so it's resumed on restart.
+        self.journal.complete_pushes(progress.push_ids)
+
+    async def wait_for_deploys(self):
+        """Wait for every deploy that has started to finish."""
+        while self.deploys:
+            await asyncio.gather(*self.deploys)
@@ -1,3 +1,14 @@
+import os
+import tempfile
+
 import gitops_server.settings
 
 gitops_server.settings.CLUSTER_NAME = "test-cluster"
+gitops_server.settings.DEPLOY_QUEUE_PATH = os.path.join(
+    tempfile.mkdtemp(prefix="gitops-test-queue-"), "deploy-queue.sqlite3"
+)
+
+# Test repos are cloned from local paths, which don't need a token.
+os.environ.setdefault("GITHUB_OAUTH_TOKEN", "")
+# Keep the persistent caches out of the user's home directory.
+os.environ.setdefault("GITOPS_CACHE_DIR", tempfile.mkdtemp(prefix="gitops-test-cache-"))
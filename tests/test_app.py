@@ -1,3 +1,10 @@
+import json
+import pickle
+
+import pytest
+
+from gitops.common import app as app_module
+from gitops.common import utils
 from gitops.common.app import App, Chart
 
 from .utils import create_test_yaml
@@ -120,3 +127,215 @@ class TestChart:
 
         app_decoded = App("test", path, encode_secrets=False)
         assert app_decoded.secrets["SNAPE"] == "KILLS_DUMBLEDORE"
+
+
+class TestExtends:
+    def make_repo(self, tmp_path):
+        (tmp_path / "root.yml").write_text(
+            "chart: https://github.com/uptick/workforce\ndeployment:\n  labels:\n    a: b\n"
+        )
+        (tmp_path / "base.yml").write_text("extends: root.yml\nnamespace: base\nenvironment:\n  DEBUG: 'false'\n")
+        for name in ["app-1", "app-2"]:
+            (tmp_path / name).mkdir()
+            (tmp_path / name / "deployment.yml").write_text(f"extends: ../base.yml\nenvironment:\n  NAME: {name}\n")
+            (tmp_path / name / "secrets.yml").write_text("secrets: {}\n")
+
+    def test_multi_level_extends_are_resolved(self, tmp_path):
+        self.make_repo(tmp_path)
+        app = App("app-1", str(tmp_path / "app-1"))
+
+        assert app.namespace == "base"
+        assert app.values["chart"] == "https://github.com/uptick/workforce"
+        assert app.values["environment"] == {"DEBUG": "false", "NAME": "app-1"}
+
+    def test_base_files_are_parsed_once_per_extends_cache(self, tmp_path, monkeypatch):
+        self.make_repo(tmp_path)
+        parsed = []
+        safe_load = utils.safe_load
+
+        def counting_safe_load(stream):
+            parsed.append(stream)
+            return safe_load(stream)
+
+        monkeypatch.setattr(utils, "safe_load", counting_safe_load)
+        with utils.extends_cache():
+            App("app-1", str(tmp_path / "app-1"))
+            App("app-2", str(tmp_path / "app-2"))
+
+        assert sorted(parsed) == sorted(
+            [
+                (tmp_path / "app-1" / "deployment.yml").read_bytes(),
+                (tmp_path / "app-2" / "deployment.yml").read_bytes(),
+                (tmp_path / "base.yml").read_bytes(),
+                (tmp_path / "root.yml").read_bytes(),
+            ]
+        )
+
+    def test_set_value_does_not_leak_into_apps_sharing_a_base(self, tmp_path):
+        self.make_repo(tmp_path)
+        with utils.extends_cache():
+            app_1 = App("app-1", str(tmp_path / "app-1"))
+            app_2 = App("app-2", str(tmp_path / "app-2"))
+        assert app_1.values["deployment"] is app_2.values["deployment"]
+
+        app_1.set_value("deployment.labels.gitops/deploy_id", "1")
+
+        assert app_1.values["deployment"]["labels"] == {"a": "b", "gitops/deploy_id": "1"}
+        assert app_2.values["deployment"]["labels"] == {"a": "b"}
+
+    def test_copies_can_be_changed_independently(self, tmp_path):
+        self.make_repo(tmp_path)
+        app = App("app-1", str(tmp_path / "app-1"))
+
+        copy = app.copy()
+        copy.set_value("deployment.labels.gitops/deploy_id", "1")
+
+        assert app.values["deployment"]["labels"] == {"a": "b"}
+        assert copy.values["deployment"]["labels"] == {"a": "b", "gitops/deploy_id": "1"}
+        assert copy.namespace == app.namespace
+
+    def test_merge_does_not_modify_its_arguments(self):
+        parent = {"a": {"b": 1, "c": {"d": 2}}, "e": 3}
+        child = {"a": {"b": 4}, "f": 5}
+
+        merged = utils.merge(parent, child)
+
+        assert merged == {"a": {"b": 4, "c": {"d": 2}}, "e": 3, "f": 5}
+        assert parent == {"a": {"b": 1, "c": {"d": 2}}, "e": 3}
+        assert merged["a"]["c"] is parent["a"]["c"]
+
+
+class TestValueInterner:
+    def test_equal_values_are_shared(self):
+        interner = utils.ValueInterner()
+        first = interner.intern({"environment": {"A": "1", "B": ["x", {"y": 2}]}, "replicas": 1})
+        second = interner.intern({"environment": {"A": "1", "B": ["x", {"y": 2}]}, "replicas": 1})
+
+        assert first == second
+        assert first is second
+        assert interner.intern({"environment": {"A": "1"}})["environment"] is not first["environment"]
+        assert interner.intern(["x", {"y": 2}]) is first["environment"]["B"]
+
+    def test_equal_values_of_different_types_are_kept_apart(self):
+        interner = utils.ValueInterner()
+        values = [interner.intern({"a": value}) for value in [1, True, 1.0, "1"]]
+
+        assert [type(value["a"]) for value in values] == [int, bool, float, str]
+        assert values[0] is interner.intern({"a": 1})
+
+    def test_apps_share_values(self, tmp_path):
+        interner = utils.ValueInterner()
+        apps = []
+        for name in ["app-1", "app-2"]:
+            (tmp_path / name).mkdir()
+            (tmp_path / name / "deployment.yml").write_text(
+                f"chart: https://github.com/uptick/workforce\nnamespace: {name}\nenvironment:\n  A: b\n"
+            )
+            (tmp_path / name / "secrets.yml").write_text("secrets: {}\n")
+            apps.append(App(name, str(tmp_path / name)))
+            apps[-1].share_values(interner)
+
+        assert apps[0].values["environment"] is apps[1].values["environment"]
+        apps[0].set_value("environment.A", "c")
+        assert apps[1].values["environment"] == {"A": "b"}
+
+
+class TestLazyValues:
+    def make_app(self, tmp_path, account_id="123"):
+        (tmp_path / "deployment.yml").write_text(
+            "chart: https://github.com/uptick/workforce\nnamespace: test\nimages:\n"
+            "  template: '{account_id}.dkr.ecr.ap-southeast-2.amazonaws.com/uptick:{tag}'\n"
+            "image-tag: qa-server-1234\n"
+        )
+        (tmp_path / "secrets.yml").write_text("secrets:\n  SNAPE: KILLS_DUMBLEDORE\n")
+        return App("test", str(tmp_path), account_id=account_id)
+
+    @pytest.fixture
+    def secrets_loads(self, monkeypatch):
+        calls = []
+        load_secrets_file = app_module.load_secrets_file
+
+        def counting_load_secrets_file(*args):
+            calls.append(args)
+            return load_secrets_file(*args)
+
+        monkeypatch.setattr(app_module, "load_secrets_file", counting_load_secrets_file)
+        return calls
+
+    def test_secrets_are_loaded_on_first_access(self, tmp_path, secrets_loads):
+        app = self.make_app(tmp_path)
+        assert app.tags == []
+        assert "secrets" in app.values
+        assert secrets_loads == []
+
+        assert app.secrets == {"SNAPE": "S0lMTFNfRFVNQkxFRE9SRQ=="}
+        assert app.values["secrets"] is app.secrets
+        assert len(secrets_loads) == 1
+
+    def test_secrets_are_loaded_when_values_are_serialised(self, tmp_path):
+        values = json.loads(json.dumps(self.make_app(tmp_path).values))
+        assert values["secrets"] == {"SNAPE": "S0lMTFNfRFVNQkxFRE9SRQ=="}
+        assert dict(self.make_app(tmp_path).values)["secrets"] == {"SNAPE": "S0lMTFNfRFVNQkxFRE9SRQ=="}
+
+    def test_pickling_keeps_values_pending(self, tmp_path):
+        app = pickle.loads(pickle.dumps(self.make_app(tmp_path)))  # noqa: S301
+        assert app.values.is_pending("secrets")
+        assert app.secrets["SNAPE"] == "S0lMTFNfRFVNQkxFRE9SRQ=="
+
+    def test_account_id_is_only_looked_up_for_the_full_image(self, tmp_path):
+        lookups = []
+
+        def get_account_id():
+            lookups.append(True)
+            return "123"
+
+        app = self.make_app(tmp_path, account_id=get_account_id)
+        assert (app.image_repository_name, app.image_tag, app.image_prefix) == ("uptick", "qa-server-1234", "qa-server")
+        assert lookups == []
+
+        assert app.image == "123.dkr.ecr.ap-southeast-2.amazonaws.com/uptick:qa-server-1234"
+        assert app.values["image"] == app.image
+        assert len(lookups) == 1
+
+
+class TestFingerprint:
+    def make_app(self, name="test", **deployments):
+        return App(
+            name,
+            deployments={
+                "chart": "https://github.com/uptick/workforce",
+                "namespace": "test",
+                "images": {"template": "docker.io/uptick:{tag}"},
+                "image-tag": "qa-server-1234",
+                **deployments,
+            },
+        )
+
+    def test_apps_with_equal_values_are_equal(self):
+        app = self.make_app(environment={"A": "1", "B": "2"})
+        same = self.make_app(environment={"B": "2", "A": "1"})
+
+        assert app == same
+        assert app.fingerprint == same.fingerprint
+        assert len({app, same}) == 1
+        assert app != self.make_app(environment={"A": "1", "B": "3"})
+        assert app != self.make_app("other", environment={"A": "1", "B": "2"})
+
+    def test_set_value_updates_cached_properties(self):
+        app = self.make_app()
+        fingerprint = app.fingerprint
+        assert app.image_tag == "qa-server-1234"
+
+        app.set_value("image", "docker.io/uptick:qa-worker-5678")
+
+        assert app.fingerprint != fingerprint
+        assert (app.image_tag, app.image_prefix) == ("qa-worker-5678", "qa-worker")
+
+    def test_copies_keep_the_original_fingerprint(self):
+        app = self.make_app()
+        fingerprint = app.fingerprint
+
+        app.copy().set_value("deployment.labels.gitops/deploy_id", "1")
+
+        assert app.fingerprint == fingerprint
+        assert app == self.make_app()
@@ -0,0 +1,125 @@
+from textwrap import dedent
+
+from pytest import fixture
+
+from gitops.utils import cache
+
+
+@fixture
+def app_cache(tmp_path):
+    return cache.AppCache(tmp_path / "cache" / cache.CACHE_FILENAME)
+
+
+@fixture
+def parse_counter(monkeypatch):
+    calls = []
+    load = cache.load_yaml_with_digests
+
+    def counting_load(path):
+        calls.append(path)
+        return load(path)
+
+    monkeypatch.setattr(cache, "load_yaml_with_digests", counting_load)
+    return calls
+
+
+@fixture
+def cluster_repo(tmp_path):
+    apps = tmp_path / "apps"
+    (apps / "app").mkdir(parents=True)
+    (apps / "base.yml").write_text(
+        dedent(
+            """\
+            chart: https://github.com/uptick/workforce
+            environment:
+              DEBUG: "false"
+            """
+        )
+    )
+    (apps / "app" / "deployment.yml").write_text(
+        dedent(
+            """\
+            extends: ../base.yml
+            namespace: test
+            environment:
+              HELLO: WORLD
+            """
+        )
+    )
+    return apps
+
+
+class TestAppCache:
+    def test_repeat_loads_are_served_from_the_cache(self, app_cache, parse_counter, cluster_repo):
+        path = str(cluster_repo / "app" / "deployment.yml")
+        first, _ = app_cache.load_deployments(path)
+        second, _ = app_cache.load_deployments(path)
+
+        assert first == second
+        assert second["environment"] == {"DEBUG": "false", "HELLO": "WORLD"}
+        assert len(parse_counter) == 1
+
+    def test_cache_persists_across_instances(self, app_cache, parse_counter, cluster_repo):
+        path = str(cluster_repo / "app" / "deployment.yml")
+        app_cache.load_deployments(path)
+        cache.AppCache(app_cache.path).load_deployments(path)
+
+        assert len(parse_counter) == 1
+
+    def test_editing_the_file_invalidates_the_entry(self, app_cache, parse_counter, cluster_repo):
+        path = cluster_repo / "app" / "deployment.yml"
+        app_cache.load_deployments(str(path))
+        path.write_text(path.read_text().replace("WORLD", "THERE"))
+
+        assert app_cache.load_deployments(str(path))[0]["environment"]["HELLO"] == "THERE"
+        assert len(parse_counter) == 2
+
+    def test_editing_an_extends_parent_invalidates_the_entry(self, app_cache, parse_counter, cluster_repo):
+        path = str(cluster_repo / "app" / "deployment.yml")
+        app_cache.load_deployments(path)
+        (cluster_repo / "base.yml").write_text("chart: https://github.com/uptick/other\n")
+
+        assert app_cache.load_deployments(path)[0]["chart"] == "https://github.com/uptick/other"
+        assert len(parse_counter) == 2
+
+    def test_touching_the_file_without_changes_keeps_the_entry(self, app_cache, parse_counter, cluster_repo):
+        path = cluster_repo / "app" / "deployment.yml"
+        app_cache.load_deployments(str(path))
+        path.write_text(path.read_text())
+
+        app_cache.load_deployments(str(path))
+        assert len(parse_counter) == 1
+
+    def test_values_that_are_not_json_serialisable_are_not_cached(self, app_cache, parse_counter, tmp_path):
+        path = tmp_path / "deployment.yml"
+        path.write_text("namespace: test\ncreated: 2024-01-01\n")
+        app_cache.load_deployments(str(path))
+        app_cache.load_deployments(str(path))
+
+        assert len(parse_counter) == 2
+
+    def test_values_with_keys_that_are_not_strings_are_not_cached(self, app_cache, parse_counter, tmp_path):
+        path = tmp_path / "deployment.yml"
+        path.write_text("namespace: test\nnodeSelector:\n  on: true\n  80: http\n")
+        app_cache.load_deployments(str(path))
+
+        assert app_cache.load_deployments(str(path))[0]["nodeSelector"] == {True: True, 80: "http"}
+        assert len(parse_counter) == 2
+
+    def test_entries_are_stored_with_the_digest_of_what_was_parsed(
+        self, app_cache, parse_counter, cluster_repo, monkeypatch
+    ):
+        path = cluster_repo / "app" / "deployment.yml"
+        load = cache.load_yaml_with_digests
+
+        def load_then_edit(load_path):
+            # The file is edited after it's parsed, but before the entry is stored.
+            loaded = load(load_path)
+            path.write_text(path.read_text().replace("WORLD", "THERE"))
+            return loaded
+
+        monkeypatch.setattr(cache, "load_yaml_with_digests", load_then_edit)
+        assert app_cache.load_deployments(str(path))[0]["environment"]["HELLO"] == "WORLD"
+        monkeypatch.setattr(cache, "load_yaml_with_digests", load)
+
+        assert app_cache.load_deployments(str(path))[0]["environment"]["HELLO"] == "THERE"
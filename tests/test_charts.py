@@ -0,0 +1,235 @@
+import asyncio
+import os
+import stat
+
+import pytest
+
+from gitops.common.app import Chart
+from gitops_server.workers.deployer import deploy
+from gitops_server.workers.deployer.charts import (
+    ChartTarballs,
+    ChartWorkspaces,
+    DependencyCache,
+    HelmRepos,
+    get_dependencies_digest,
+)
+
+from .utils import StubPrepare
+
+URL = "https://github.com/uptick/workforce"
+SHA = "a" * 40
+
+
+@pytest.fixture
+def prepare():
+    return StubPrepare()
+
+
+@pytest.mark.asyncio
+class TestChartWorkspaces:
+    async def test_concurrent_checkouts_share_one_preparation(self, prepare):
+        workspaces = ChartWorkspaces(prepare, max_workspaces=10, max_age=60)
+        prepare.release.clear()
+        paths = []
+
+        async def deploy():
+            async with workspaces.checkout(URL, SHA) as path:
+                paths.append(path)
+
+        deploys = [asyncio.ensure_future(deploy()) for _ in range(5)]
+        await prepare.started.wait()
+        prepare.release.set()
+        await asyncio.gather(*deploys)
+
+        assert prepare.calls == [(URL, SHA)]
+        assert len(set(paths)) == 1
+        assert os.path.exists(os.path.join(paths[0], "Chart.yaml"))
+
+        async with workspaces.checkout(URL, SHA) as path:
+            assert path == paths[0]
+        assert prepare.calls == [(URL, SHA)]
+
+    async def test_workspaces_in_use_are_not_evicted(self, prepare):
+        workspaces = ChartWorkspaces(prepare, max_workspaces=1, max_age=60)
+
+        async with workspaces.checkout(URL, SHA) as first:
+            async with workspaces.checkout(URL, "b" * 40) as second:
+                pass
+            # Over the limit, but the first is still in use so the second goes.
+            assert os.path.exists(first)
+            assert not os.path.exists(second)
+
+        async with workspaces.checkout(URL, "c" * 40):
+            pass
+        assert not os.path.exists(first)
+        assert list(workspaces.workspaces) == [(URL, "c" * 40)]
+
+    async def test_old_workspaces_are_evicted(self, prepare):
+        workspaces = ChartWorkspaces(prepare, max_workspaces=10, max_age=0)
+
+        async with workspaces.checkout(URL, SHA) as path:
+            pass
+
+        assert not os.path.exists(path)
+        assert workspaces.workspaces == {}
+
+    async def test_failed_preparations_are_retried(self, prepare):
+        workspaces = ChartWorkspaces(prepare, max_workspaces=10, max_age=60)
+        prepare.fail = True
+
+        with pytest.raises(Exception, match="Could not build chart"):
+            async with workspaces.checkout(URL, SHA):
+                pass
+        assert workspaces.workspaces == {}
+
+        prepare.fail = False
+        async with workspaces.checkout(URL, SHA) as path:
+            assert os.path.exists(os.path.join(path, "Chart.yaml"))
+        assert len(prepare.calls) == 2
+
+
+# Records each call. Dependencies are "built" named after the lock file's contents, and
+# charts are "pulled" into the last argument (the destination).
+STUB_HELM = """#!/bin/sh
+echo "$@" >> "{calls}"
+case "$1" in
+  dependency)
+    mkdir -p charts
+    echo built > "charts/$(cat Chart.lock).tgz";;
+  pull)
+    for destination; do :; done
+    echo pulled > "$destination/chart-1.0.0.tgz";;
+esac
+"""
+
+
+@pytest.fixture
+def helm_calls(tmp_path, monkeypatch):
+    bin_path = tmp_path / "bin"
+    bin_path.mkdir()
+    calls = tmp_path / "helm-calls"
+    calls.touch()
+    helm = bin_path / "helm"
+    helm.write_text(STUB_HELM.format(calls=calls))
+    helm.chmod(helm.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", f"{bin_path}{os.pathsep}{os.environ['PATH']}")
+    return calls
+
+
+@pytest.mark.asyncio
+class TestDependencyCache:
+    @pytest.fixture(autouse=True)
+    def cache(self, tmp_path, monkeypatch):
+        cache = DependencyCache(str(tmp_path / "cache"), max_entries=2)
+        monkeypatch.setattr(deploy, "HELM_DEPENDENCIES", cache)
+        return cache
+
+    def make_chart(self, tmp_path, name, lock="dependency-1.0.0"):
+        chart = tmp_path / name
+        chart.mkdir()
+        (chart / "Chart.yaml").write_text("name: workforce\ndependencies:\n  - name: dependency\n")
+        if lock:
+            (chart / "Chart.lock").write_text(lock)
+        return str(chart)
+
+    async def test_dependencies_are_built_once(self, tmp_path, helm_calls):
+        for name in ["first", "second"]:
+            chart = self.make_chart(tmp_path, name)
+            await deploy.build_chart_dependencies(chart)
+            assert os.listdir(os.path.join(chart, "charts")) == ["dependency-1.0.0.tgz"]
+
+        assert helm_calls.read_text() == "dependency build\n"
+
+    async def test_changed_or_unpinned_dependencies_are_built(self, tmp_path, helm_calls):
+        await deploy.build_chart_dependencies(self.make_chart(tmp_path, "first"))
+        chart = self.make_chart(tmp_path, "second", lock="dependency-2.0.0")
+        await deploy.build_chart_dependencies(chart)
+        assert os.listdir(os.path.join(chart, "charts")) == ["dependency-2.0.0.tgz"]
+
+        assert get_dependencies_digest(self.make_chart(tmp_path, "unpinned", lock=None)) is None
+        assert helm_calls.read_text() == "dependency build\n" * 2
+
+    @pytest.mark.parametrize("local", ["subchart", "file"])
+    async def test_charts_with_local_dependencies_are_not_cached(self, tmp_path, helm_calls, cache, local):
+        for name in ["first", "second"]:
+            chart = self.make_chart(tmp_path, name)
+            if local == "subchart":
+                os.makedirs(os.path.join(chart, "charts", "subchart"))
+            else:
+                with open(os.path.join(chart, "Chart.yaml"), "a") as f:
+                    f.write("    repository: file://../subchart\n")
+            assert get_dependencies_digest(chart) is None
+            await deploy.build_chart_dependencies(chart)
+
+        assert helm_calls.read_text() == "dependency build\n" * 2
+        assert not os.path.exists(cache.path)
+
+    async def test_only_downloaded_tarballs_are_cached_and_restored(self, tmp_path, cache):
+        chart = self.make_chart(tmp_path, "first")
+        digest = get_dependencies_digest(chart)
+        os.makedirs(os.path.join(chart, "charts", "subchart"))
+        with open(os.path.join(chart, "charts", "dependency-1.0.0.tgz"), "w") as f:
+            f.write("built\n")
+        cache.store(digest, chart)
+        assert os.listdir(os.path.join(cache.path, digest)) == ["dependency-1.0.0.tgz"]
+
+        chart = self.make_chart(tmp_path, "second")
+        os.makedirs(os.path.join(chart, "charts"))
+        with open(os.path.join(chart, "charts", "dependency-1.0.0.tgz"), "w") as f:
+            f.write("committed\n")
+        assert cache.restore(digest, chart)
+        with open(os.path.join(chart, "charts", "dependency-1.0.0.tgz")) as f:
+            assert f.read() == "committed\n"
+
+    async def test_least_recently_used_dependencies_are_evicted(self, tmp_path, helm_calls, cache):
+        digests = []
+        for version in range(3):
+            chart = self.make_chart(tmp_path, f"chart-{version}", lock=f"dependency-{version}")
+            digests.append(get_dependencies_digest(chart))
+            await deploy.build_chart_dependencies(chart)
+            # Keep the modification times apart.
+            os.utime(os.path.join(cache.path, digests[-1]), (version, version))
+
+        assert sorted(os.listdir(cache.path)) == sorted(digests[1:])
+
+
+@pytest.mark.asyncio
+class TestHelmCharts:
+    @pytest.fixture(autouse=True)
+    def helm_repos(self, tmp_path, monkeypatch):
+        helm_repos = HelmRepos(update_interval=600)
+        monkeypatch.setattr(deploy, "HELM_REPOS", helm_repos)
+        monkeypatch.setattr(deploy, "CHART_TARBALLS", ChartTarballs(str(tmp_path / "charts")))
+        return helm_repos
+
+    def make_chart(self, version=None):
+        return Chart(
+            {
+                "type": "helm",
+                "helm_repo": "brigade",
+                "helm_repo_url": "https://helm.charts",
+                "helm_chart": "brigade/brigade",
+                "version": version,
+            }
+        )
+
+    async def test_versioned_charts_are_pulled_once(self, helm_calls):
+        tarballs = await asyncio.gather(*[deploy.get_helm_chart(self.make_chart("1.0.0")) for _ in range(3)])
+        tarballs.append(await deploy.get_helm_chart(self.make_chart("1.0.0")))
+
+        assert len(set(tarballs)) == 1
+        with open(tarballs[0]) as f:
+            assert f.read() == "pulled\n"
+        calls = helm_calls.read_text().splitlines()
+        assert calls[0] == "repo add brigade https://helm.charts"
+        assert calls[1].startswith("pull brigade/brigade --version=1.0.0 --destination ")
+        assert len(calls) == 2
+
+    async def test_repos_are_added_once_and_updated_when_stale(self, helm_calls, helm_repos):
+        for _ in range(3):
+            assert await deploy.get_helm_chart(self.make_chart()) == "brigade/brigade"
+        assert helm_calls.read_text() == "repo add brigade https://helm.charts\n"
+
+        helm_repos.update_interval = 0
+        await deploy.get_helm_chart(self.make_chart())
+        assert helm_calls.read_text().splitlines()[1:] == ["repo update brigade"]
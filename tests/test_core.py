@@ -5,6 +5,7 @@ from invoke import MockContext
 from pytest import fixture
 
 import gitops.utils.apps as apps
+import gitops.utils.images as images
 from gitops import core
 
 
@@ -258,3 +259,55 @@ class TestUnsetEnv(TestMixin):
                 chart: test
             """
         )
+
+
+class TestBump:
+    def test_bump_resolves_each_repository_once_and_updates_apps(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(apps, "get_apps_directory", lambda: tmp_path)
+        for name, tag in [("app-1", "qa-server-aaaa"), ("app-2", "release-aaaa"), ("app-3", "qa-server-bbbb")]:
+            (tmp_path / name).mkdir()
+            (tmp_path / name / "deployment.yml").write_text(
+                f"namespace: test\nchart: test\nimages:\n  template: uptick:{{tag}}\nimage-tag: {tag}\n"
+            )
+            (tmp_path / name / "secrets.yml").write_text("{}")
+        loaded = []
+
+        def load_images(repository_name, refresh=False):
+            # Recent image listings are used unless a refresh is asked for.
+            assert not refresh
+            loaded.append(repository_name)
+            return [
+                {"imageTags": ["qa-server-bbbb"], "imagePushedAt": 2},
+                {"imageTags": ["release-cccc"], "imagePushedAt": 1},
+            ]
+
+        monkeypatch.setattr(images, "load_images", load_images)
+        images.get_image_index.cache_clear()
+        core.bump(MockContext(), filter="app-1|app-2|app-3", interactive=False)
+        images.get_image_index.cache_clear()
+
+        assert loaded == ["uptick"]
+        assert "image-tag: qa-server-bbbb" in (tmp_path / "app-1" / "deployment.yml").read_text()
+        assert "image-tag: release-cccc" in (tmp_path / "app-2" / "deployment.yml").read_text()
+        assert "image-tag: qa-server-bbbb" in (tmp_path / "app-3" / "deployment.yml").read_text()
+
+    def test_empty_prefix_bumps_to_tags_without_a_dash(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(apps, "get_apps_directory", lambda: tmp_path)
+        (tmp_path / "app-1").mkdir()
+        (tmp_path / "app-1" / "deployment.yml").write_text(
+            "namespace: test\nchart: test\nimages:\n  template: uptick:{tag}\nimage-tag: qa-server-aaaa\n"
+        )
+        (tmp_path / "app-1" / "secrets.yml").write_text("{}")
+
+        def load_images(repository_name, refresh=False):
+            return [
+                {"imageTags": ["qa-server-bbbb"], "imagePushedAt": 2},
+                {"imageTags": ["cccc"], "imagePushedAt": 1},
+            ]
+
+        monkeypatch.setattr(images, "load_images", load_images)
+        images.get_image_index.cache_clear()
+        core.bump(MockContext(), filter="app-1", prefix="", interactive=False)
+        images.get_image_index.cache_clear()
+
+        assert "image-tag: cccc" in (tmp_path / "app-1" / "deployment.yml").read_text()
@@ -1,14 +1,20 @@
+import asyncio
+import os
 import re
 from unittest.mock import patch
 
 import pytest
 
 from gitops.common.app import App
-from gitops_server.types import AppDefinitions
-from gitops_server.workers.deployer import Deployer
+from gitops_server import types
+from gitops_server.types import AppDefinitions, get_affected_app_names, get_extends_chains
+from gitops_server.utils import run
+from gitops_server.workers.deployer import Deployer, deploy
+from gitops_server.workers.deployer.charts import ChartTarballs, ChartWorkspaces, HelmRepos
+from gitops_server.workers.deployer.snapshots import AppSnapshots
 
 from .sample_data import SAMPLE_GITHUB_PAYLOAD, SAMPLE_GITHUB_PAYLOAD_SKIP_MIGRATIONS
-from .utils import create_test_yaml, mock_load_app_definitions
+from .utils import StubPrepare, create_test_yaml, make_dummy_repo, mock_get_changed_paths, mock_load_app_definitions
 
 # Patch gitops_server.git.run & check correct commands + order
 # Patch command that reads yaml from cluster repo +
@@ -17,9 +23,15 @@ from .utils import create_test_yaml, mock_load_app_definitions
 
 @pytest.mark.asyncio
 class TestDeploy:
+    @pytest.fixture(autouse=True)
+    def helm_repos(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(deploy, "HELM_REPOS", HelmRepos(update_interval=600))
+        monkeypatch.setattr(deploy, "CHART_TARBALLS", ChartTarballs(str(tmp_path / "charts")))
+
     @patch("gitops_server.workers.deployer.deploy.run")
     @patch("gitops_server.utils.slack.post")
     @patch("gitops_server.workers.deployer.deploy.load_app_definitions", mock_load_app_definitions)
+    @patch("gitops_server.workers.deployer.deploy.get_changed_paths", mock_get_changed_paths)
     @patch("gitops_server.workers.deployer.deploy.temp_repo")
     async def test_deployer_git(self, temp_repo_mock, post_mock, run_mock):
         """Fake a deploy to two servers, bumping fg from 2 to 4."""
@@ -55,6 +67,7 @@ class TestDeploy:
     @patch("gitops_server.workers.deployer.deploy.run")
     @patch("gitops_server.workers.deployer.deploy.post_result")
     @patch("gitops_server.workers.deployer.deploy.load_app_definitions", mock_load_app_definitions)
+    @patch("gitops_server.workers.deployer.deploy.get_changed_paths", mock_get_changed_paths)
     @patch("gitops_server.workers.deployer.deploy.temp_repo")
     async def test_deployer_update_helm_app(self, temp_repo_mock, post_mock, run_mock):
         run_mock.return_value = {"exit_code": 0, "output": ""}
@@ -88,6 +101,7 @@ class TestDeploy:
     @patch("gitops_server.workers.deployer.deploy.run")
     @patch("gitops_server.utils.slack.post")
     @patch("gitops_server.workers.deployer.deploy.load_app_definitions", mock_load_app_definitions)
+    @patch("gitops_server.workers.deployer.deploy.get_changed_paths", mock_get_changed_paths)
     @patch("gitops_server.workers.deployer.deploy.temp_repo")
     async def test_deployer_skip_migrations_in_commit_message_should_run_helm_without_hooks(
         self, temp_repo_mock, post_mock, run_mock
@@ -122,6 +136,27 @@ class TestDeploy:
         for where, check in check_in_run_mock:
             assert check in post_mock.call_args_list[where][0][0]
 
+    @patch("gitops_server.workers.deployer.deploy.run")
+    @patch("gitops_server.workers.deployer.deploy.post_result")
+    async def test_apps_sharing_a_chart_sha_build_it_once(self, post_mock, run_mock, monkeypatch):
+        run_mock.return_value = {"exit_code": 0, "output": ""}
+        prepare = StubPrepare()
+        monkeypatch.setattr(deploy, "CHART_WORKSPACES", ChartWorkspaces(prepare, max_workspaces=10, max_age=60))
+        chart = "https://github.com/uptick/workforce@" + "a" * 40
+        apps = {
+            name: App(name, deployments={"chart": chart, "namespace": "mynamespace", "cluster": "test-cluster"})
+            for name in ["app-1", "app-2", "app-3"]
+        }
+        deployer = Deployer("Author", "author@example.com", "message", AppDefinitions("mock-repo", apps), None)
+
+        await asyncio.gather(*[deployer.update_app_deployment(app) for app in apps.values()])
+
+        assert prepare.calls == [("https://github.com/uptick/workforce", "a" * 40)]
+        assert run_mock.call_count == 3
+        assert {call[0][0].split()[-1] for call in run_mock.call_args_list} == {
+            deploy.CHART_WORKSPACES.workspaces[prepare.calls[0]].path
+        }
+
 
 class TestLoadAppDefinitions:
     def test_load_app_definitions_ignores_suspended_apps(self):
@@ -134,3 +169,113 @@ class TestLoadAppDefinitions:
             },
         )
         assert len(app_definitions.apps) == 1
+
+
+class TestAffectedApps:
+    def make_repo(self, tmp_path):
+        (tmp_path / "apps").mkdir()
+        (tmp_path / "common").mkdir()
+        (tmp_path / "common" / "root.yml").write_text("chart: https://github.com/uptick/workforce\n")
+        (tmp_path / "apps" / "base.yml").write_text("extends: ../common/root.yml\nnamespace: base\n")
+        for name, extends in [("app-1", "../base.yml"), ("app-2", "'../../common/root.yml'"), ("app-3", None)]:
+            (tmp_path / "apps" / name).mkdir()
+            deployment = f"extends: {extends}\n" if extends else ""
+            (tmp_path / "apps" / name / "deployment.yml").write_text(deployment + f"cluster: test-cluster\n# {name}\n")
+            (tmp_path / "apps" / name / "secrets.yml").write_text("secrets: {}\n")
+        return str(tmp_path)
+
+    def test_changes_in_app_directories(self, tmp_path):
+        repo = self.make_repo(tmp_path)
+        changed = ["apps/app-1/deployment.yml", "apps/app-4/secrets.yml", "README.md", ".github/workflows/ci.yml"]
+
+        assert get_affected_app_names(changed, get_extends_chains(repo)) == {"app-1", "app-4"}
+
+    def test_changes_to_extends_parents(self, tmp_path):
+        repo = self.make_repo(tmp_path)
+
+        assert get_affected_app_names(["apps/base.yml"], get_extends_chains(repo)) == {"app-1"}
+        assert get_affected_app_names(["common/root.yml"], get_extends_chains(repo)) == {"app-1", "app-2"}
+
+    def test_app_definitions_only_load_the_given_apps(self, tmp_path):
+        repo = self.make_repo(tmp_path)
+        (tmp_path / "apps" / "app-3" / "deployment.yml").write_text("not: [valid")
+
+        app_definitions = AppDefinitions("mock-repo", path=repo, app_names=["app-1", "app-4"])
+
+        assert list(app_definitions.apps) == ["app-1"]
+
+
+@pytest.mark.asyncio
+class TestAppSnapshots:
+    @pytest.fixture
+    def loaded(self, monkeypatch):
+        loaded = []
+        load_app = types.load_app
+
+        def counting_load_app(entry):
+            loaded.append(entry[0])
+            return load_app(entry)
+
+        monkeypatch.setattr(types, "load_app", counting_load_app)
+        monkeypatch.setattr(deploy, "APP_SNAPSHOTS", AppSnapshots(max_snapshots=8, max_apps=100))
+        return loaded
+
+    async def commit(self, repo, files):
+        for path, content in files.items():
+            os.makedirs(os.path.join(repo, os.path.dirname(path)), exist_ok=True)
+            with open(os.path.join(repo, path), "w") as f:
+                f.write(content)
+        await run("git add . && git commit -m 'change apps'", cwd=repo)
+        return (await run("git rev-parse HEAD", cwd=repo))["output"].strip()
+
+    async def test_only_changed_apps_are_parsed(self, loaded):
+        deployment = "chart: https://github.com/uptick/workforce\ncluster: test-cluster\nnamespace: ns-{}\n"
+        async with make_dummy_repo() as repo:
+            first = await self.commit(
+                repo,
+                {
+                    "apps/base.yml": "environment:\n  A: a\n",
+                    "apps/app-1/deployment.yml": "extends: ../base.yml\n" + deployment.format(1),
+                    "apps/app-2/deployment.yml": deployment.format(2),
+                    "apps/app-3/deployment.yml": deployment.format(3),
+                    **{f"apps/app-{i}/secrets.yml": "secrets: {}\n" for i in range(1, 4)},
+                },
+            )
+            second = await self.commit(repo, {"apps/app-2/deployment.yml": deployment.format(22)})
+            third = await self.commit(repo, {"apps/base.yml": "environment:\n  A: b\n"})
+
+            apps = (await deploy.load_app_definitions(repo, first)).apps
+            assert len(apps) == 3
+            assert sorted(loaded) == ["app-1", "app-2", "app-3"]
+            assert apps["app-2"].values["chart"] is apps["app-3"].values["chart"]
+
+            current = await deploy.load_app_definitions(repo, second, changed_paths=["apps/app-2/deployment.yml"])
+            previous = await deploy.load_app_definitions(repo, first, changed_paths=["apps/app-2/deployment.yml"])
+            assert current.apps["app-2"].namespace == "ns-22"
+            assert previous.apps["app-2"].namespace == "ns-2"
+            assert list(current.apps) == list(previous.apps) == ["app-2"]
+            assert loaded[3:] == ["app-2"]
+
+            current = await deploy.load_app_definitions(repo, third, changed_paths=["apps/base.yml"])
+            assert current.apps["app-1"].values["environment"] == {"A": "b"}
+            assert loaded[4:] == ["app-1"]
+
+    async def test_only_affected_apps_are_parsed_on_a_cold_start(self, loaded):
+        deployment = "chart: https://github.com/uptick/workforce\ncluster: test-cluster\nnamespace: ns-{}\n"
+        async with make_dummy_repo() as repo:
+            first = await self.commit(
+                repo,
+                {
+                    **{f"apps/app-{i}/deployment.yml": deployment.format(i) for i in range(1, 4)},
+                    **{f"apps/app-{i}/secrets.yml": "secrets: {}\n" for i in range(1, 4)},
+                },
+            )
+
+            current = await deploy.load_app_definitions(repo, first, changed_paths=["apps/app-2/deployment.yml"])
+            assert list(current.apps) == ["app-2"]
+            assert loaded == ["app-2"]
+
+            # The rest are parsed once they're asked for.
+            apps = (await deploy.load_app_definitions(repo, first)).apps
+            assert list(apps) == ["app-1", "app-2", "app-3"]
+            assert sorted(loaded) == ["app-1", "app-2", "app-3"]
@@ -1,29 +1,12 @@
+import asyncio
 import os
-import tempfile
-from contextlib import asynccontextmanager
+import shutil
 
 import pytest
 
 from gitops_server.utils import git, run
 
-os.environ["GITHUB_OAUTH_TOKEN"] = ""
-
-
-@asynccontextmanager
-async def make_dummy_repo():
-    with tempfile.TemporaryDirectory() as temporary_folder_path:
-        if os.environ.get("CI"):
-            await run("git config --global user.email 'you@example.com'")
-            await run("git config --global user.name 'Your Name'")
-            await run("git config --global init.defaultBranch main")
-        await run("git init", cwd=temporary_folder_path)
-        for _ in range(10):
-            await run("git commit -m 'temporary commit' --allow-empty", cwd=temporary_folder_path)
-        await run("git checkout -b 'test'", cwd=temporary_folder_path)
-        for _ in range(10):
-            await run("git commit -m 'temporary commit' --allow-empty", cwd=temporary_folder_path)
-        await run("git checkout main", cwd=temporary_folder_path)
-        yield temporary_folder_path
+from .utils import make_dummy_repo
 
 
 @pytest.mark.asyncio
@@ -48,3 +31,104 @@ class TestGit:
 
             async with git.temp_repo(test_repo, ref=sha):
                 pass
+
+    async def test_get_changed_paths(self):
+        async with make_dummy_repo() as test_repo:
+            before = (await run("git rev-parse HEAD", cwd=test_repo))["output"].strip()
+            os.makedirs(os.path.join(test_repo, "apps", "app-1"))
+            with open(os.path.join(test_repo, "apps", "app-1", "deployment.yml"), "w") as f:
+                f.write("cluster: test\n")
+            with open(os.path.join(test_repo, "README.md"), "w") as f:
+                f.write("Hello\n")
+            await run("git add . && git commit -m 'add app'", cwd=test_repo)
+            after = (await run("git rev-parse HEAD", cwd=test_repo))["output"].strip()
+
+            assert sorted(await git.get_changed_paths(test_repo, before, after)) == [
+                "README.md",
+                "apps/app-1/deployment.yml",
+            ]
+            assert await git.get_changed_paths(test_repo, "0" * 40, after) is None
+            assert await git.get_changed_paths(test_repo, "abcdef" * 6 + "abcd", after) is None
+
+    async def test_checkouts_are_worktrees_of_the_repo_cache(self):
+        async with make_dummy_repo() as test_repo:
+            shas = [(await run(f"git rev-parse {ref}", cwd=test_repo))["output"].strip() for ref in ["main", "test"]]
+            cache_path = await git.ensure_repo_cache(test_repo)
+
+            async with git.temp_repo(test_repo, ref=shas[0]) as first, git.temp_repo(test_repo, ref=shas[1]) as second:
+                # A worktree's .git is a file pointing back at the cache.
+                assert os.path.isfile(os.path.join(first, ".git"))
+                for path, sha in zip([first, second], shas, strict=True):
+                    assert (await run("git rev-parse HEAD", cwd=path))["output"].strip() == sha
+
+            worktrees = (await run("git worktree list --porcelain", cwd=cache_path))["output"]
+            assert first not in worktrees
+            assert second not in worktrees
+            assert not os.path.exists(first)
+
+    async def add_secrets(self, test_repo, secrets):
+        with open(os.path.join(test_repo, ".gitattributes"), "w") as f:
+            f.write("secrets.yml filter=git-crypt diff=git-crypt\n")
+        with open(os.path.join(test_repo, "secrets.yml"), "wb") as f:
+            f.write(secrets)
+        await run("git add . && git commit -m 'add secrets'", cwd=test_repo)
+        return (await run("git rev-parse HEAD", cwd=test_repo))["output"].strip()
+
+    async def test_encrypted_worktrees_fall_back_to_copying_the_cache(self, monkeypatch):
+        async with make_dummy_repo() as test_repo:
+            sha = await self.add_secrets(test_repo, git.GIT_CRYPT_HEADER + b"ciphertext")
+            cache_path = await git.ensure_repo_cache(test_repo)
+            monkeypatch.setenv("GIT_CRYPT_KEY_FILE", "/tmp/cluster.key")
+
+            with pytest.raises(Exception, match="Could not decrypt secrets.yml"):
+                async with git.temp_repo(test_repo, ref=sha):
+                    pass
+
+            # As git-crypt leaves the unlocked cache's files.
+            with open(cache_path / "secrets.yml", "w") as f:
+                f.write("password: hunter2\n")
+            async with git.temp_repo(test_repo, ref=sha) as path:
+                assert os.path.isdir(os.path.join(path, ".git"))
+                with open(os.path.join(path, "secrets.yml")) as f:
+                    assert f.read() == "password: hunter2\n"
+
+    @pytest.mark.skipif(not shutil.which("git-crypt"), reason="git-crypt is not installed")
+    async def test_worktrees_are_decrypted_by_git_crypt(self, monkeypatch, tmp_path):
+        async with make_dummy_repo() as test_repo:
+            await run("git-crypt init", cwd=test_repo)
+            await run(f"git-crypt export-key {tmp_path / 'cluster.key'}", cwd=test_repo)
+            sha = await self.add_secrets(test_repo, b"password: hunter2\n")
+            monkeypatch.setenv("GIT_CRYPT_KEY_FILE", str(tmp_path / "cluster.key"))
+
+            async with git.temp_repo(test_repo, ref=sha) as path:
+                with open(os.path.join(path, "secrets.yml")) as f:
+                    assert f.read() == "password: hunter2\n"
+
+    async def test_fetches_are_shared_and_skipped_for_known_commits(self, monkeypatch):
+        fetches = []
+        git_run = git.run
+
+        async def counting_run(command, **kwargs):
+            if command.endswith("git fetch"):
+                fetches.append(command)
+            return await git_run(command, **kwargs)
+
+        async with make_dummy_repo() as test_repo:
+            before = (await run("git rev-parse HEAD", cwd=test_repo))["output"].strip()
+            await git.ensure_repo_cache(test_repo)
+            monkeypatch.setattr(git, "run", counting_run)
+
+            await git.ensure_commits(test_repo, before)
+            assert fetches == []
+
+            await run("git commit -m 'new commit' --allow-empty", cwd=test_repo)
+            after = (await run("git rev-parse HEAD", cwd=test_repo))["output"].strip()
+            await asyncio.gather(*[git.ensure_commits(test_repo, before, after) for _ in range(3)])
+            assert len(fetches) == 1
+
+            assert await git.get_changed_paths(test_repo, before, after) == []
+            assert len(fetches) == 1
+
+    async def test_each_repo_has_its_own_lock(self):
+        assert git.get_repo_lock("https://github.com/uptick/a") is git.get_repo_lock("https://github.com/uptick/a")
+        assert git.get_repo_lock("https://github.com/uptick/a") is not git.get_repo_lock("https://github.com/uptick/b")
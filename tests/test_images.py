@@ -0,0 +1,166 @@
+from datetime import UTC, datetime, timedelta
+
+import pytest
+
+from gitops.utils import images
+
+START = datetime(2024, 1, 1, tzinfo=UTC)
+
+IMAGES = [
+    {"imageTags": ["qa-server-aaaa"], "imagePushedAt": START},
+    {"imageTags": ["qa-server-bbbb", "qa-server-latest"], "imagePushedAt": START + timedelta(days=2)},
+    {"imageTags": ["qa-worker-cccc"], "imagePushedAt": START + timedelta(days=3)},
+    {"imageTags": ["release-dddd", "latest"], "imagePushedAt": START + timedelta(days=1)},
+    {"imageTags": ["release-eeee"], "imagePushedAt": START + timedelta(days=1)},
+    {"imageTags": ["stable"], "imagePushedAt": START},
+]
+
+
+def make_images():
+    return [{**image, "imageDigest": f"sha256:{i}"} for i, image in enumerate(IMAGES)]
+
+
+class StubPaginator:
+    def __init__(self, client, operation):
+        self.client = client
+        self.operation = operation
+
+    def paginate(self, repositoryName, **kwargs):  # noqa: N803
+        self.client.calls.append((self.operation, repositoryName))
+        for i in range(0, len(self.client.images), 2):
+            page = self.client.images[i : i + 2]
+            if self.operation == "describe_images":
+                yield {"imageDetails": page}
+            else:
+                yield {
+                    "imageIds": [
+                        {"imageDigest": image["imageDigest"], "imageTag": tag}
+                        for image in page
+                        for tag in image["imageTags"]
+                    ]
+                }
+
+
+class StubECRClient:
+    def __init__(self):
+        self.images = make_images()
+        self.calls = []
+
+    def get_paginator(self, operation):
+        return StubPaginator(self, operation)
+
+    def describe_images(self, repositoryName, imageIds):  # noqa: N803
+        digests = [image_id["imageDigest"] for image_id in imageIds]
+        self.calls.append(("describe_images", repositoryName, digests))
+        return {"imageDetails": [image for image in self.images if image["imageDigest"] in digests]}
+
+
+@pytest.fixture
+def ecr_client(monkeypatch, tmp_path):
+    client = StubECRClient()
+    monkeypatch.setenv("GITOPS_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(images.boto3, "client", lambda service: client)
+    images.get_image_index.cache_clear()
+    yield client
+    images.get_image_index.cache_clear()
+
+
+class TestGetLatestImage:
+    @pytest.mark.parametrize(
+        "prefix,expected",
+        [
+            ("qa-server", "qa-server-bbbb"),
+            ("qa", "qa-worker-cccc"),
+            ("release", "release-dddd"),
+            ("", "latest"),
+            ("missing", None),
+        ],
+    )
+    def test_latest_image_with_prefix(self, ecr_client, prefix, expected):
+        assert images.get_latest_image("uptick", prefix) == expected
+
+    def test_repository_is_scanned_once(self, ecr_client):
+        for prefix in ["qa-server", "qa", "release", ""]:
+            images.get_latest_image("uptick", prefix)
+        images.get_latest_image("other", "qa")
+
+        assert ecr_client.calls == [("describe_images", "uptick"), ("describe_images", "other")]
+
+    def test_tag_prefixes(self):
+        assert list(images.get_tag_prefixes("qa-server-1234")) == ["qa", "qa-server"]
+        assert list(images.get_tag_prefixes("latest")) == [""]
+
+
+class TestImageCache:
+    def run_bump(self, repository="uptick", prefix="qa-server", refresh=False):
+        # Each bump is a new process, with nothing cached in memory.
+        images.get_image_index.cache_clear()
+        return images.get_latest_image(repository, prefix, refresh=refresh)
+
+    def test_recent_listings_are_served_from_the_cache(self, ecr_client):
+        assert self.run_bump() == "qa-server-bbbb"
+        assert self.run_bump() == "qa-server-bbbb"
+
+        assert ecr_client.calls == [("describe_images", "uptick")]
+
+    def test_stale_listings_are_refreshed_incrementally(self, ecr_client, monkeypatch):
+        self.run_bump()
+        ecr_client.images.pop(1)
+        ecr_client.images.append(
+            {"imageDigest": "sha256:new", "imageTags": ["qa-server-ffff"], "imagePushedAt": START + timedelta(days=9)}
+        )
+        ecr_client.calls.clear()
+        monkeypatch.setenv("GITOPS_IMAGE_CACHE_TTL", "0")
+
+        assert self.run_bump() == "qa-server-ffff"
+        assert self.run_bump(prefix="qa-worker") == "qa-worker-cccc"
+        assert ecr_client.calls == [
+            ("list_images", "uptick"),
+            ("describe_images", "uptick", ["sha256:new"]),
+            ("list_images", "uptick"),
+        ]
+
+    def test_recent_listings_without_the_prefix_are_refreshed(self, ecr_client):
+        self.run_bump()
+        ecr_client.images.append(
+            {"imageDigest": "sha256:new", "imageTags": ["hotfix-ffff"], "imagePushedAt": START + timedelta(days=9)}
+        )
+        ecr_client.calls.clear()
+
+        assert self.run_bump(prefix="hotfix") == "hotfix-ffff"
+        assert ecr_client.calls == [("list_images", "uptick"), ("describe_images", "uptick", ["sha256:new"])]
+
+    def test_retagged_images_are_described_again(self, ecr_client):
+        self.run_bump()
+        ecr_client.images[0] = {**ecr_client.images[0], "imageTags": ["qa-server-aaaa", "qa-server-gggg"]}
+        ecr_client.calls.clear()
+
+        self.run_bump(refresh=True)
+        assert ecr_client.calls == [("list_images", "uptick"), ("describe_images", "uptick", ["sha256:0"])]
+
+    def test_refresh_removes_deleted_images(self, ecr_client):
+        self.run_bump()
+        del ecr_client.images[1]
+
+        assert self.run_bump(refresh=True) == "qa-server-aaaa"
+
+    def test_disabled_cache_always_scans(self, ecr_client, monkeypatch):
+        monkeypatch.setenv("GITOPS_DISABLE_CACHE", "1")
+        self.run_bump()
+        self.run_bump()
+
+        assert ecr_client.calls == [("describe_images", "uptick"), ("describe_images", "uptick")]
+
+
+class TestGetLatestImages:
+    def test_each_repository_is_loaded_once(self, ecr_client):
+        latest = images.get_latest_images(
+            [("uptick", "qa-server"), ("uptick", "qa"), ("uptick", "qa-server"), ("other", "release")]
+        )
+
+        assert latest == {
+            ("uptick", "qa-server"): "qa-server-bbbb",
+            ("uptick", "qa"): "qa-worker-cccc",
+            ("other", "release"): "release-dddd",
+        }
+        assert sorted(ecr_client.calls) == [("describe_images", "other"), ("describe_images", "uptick")]
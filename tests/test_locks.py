@@ -0,0 +1,109 @@
+import asyncio
+import json
+from unittest.mock import patch
+
+import pytest
+
+from gitops_server.workers.deployer import Deployer, deploy
+from gitops_server.workers.deployer.locks import AppLocks
+from gitops_server.workers.deployer.scheduler import DeployScheduler
+
+from .utils import make_deployer
+
+
+@pytest.mark.asyncio
+class TestAppLocks:
+    async def test_tickets_hold_the_lock_in_order(self):
+        locks = AppLocks()
+        first, second, third = (locks.reserve("app-1") for _ in range(3))
+        other = locks.reserve("app-2")
+
+        assert first.done() and other.done()
+        assert not second.done()
+
+        locks.release("app-1", second)
+        locks.release("app-1", first)
+        assert third.done()
+
+        locks.release("app-1", third)
+        locks.release("app-1", third)
+        assert locks.queues == {"app-2": locks.queues["app-2"]}
+
+    async def test_disjoint_deploys_run_concurrently(self):
+        locks = AppLocks()
+        scheduler = DeployScheduler(5, priorities={}, quotas={})
+        events = []
+        finish = {name: asyncio.Event() for name in ["app-1", "app-2"]}
+
+        async def update_app_deployment(self, app):
+            events.append(f"start {app.name} {app.values['environment']['VERSION']}")
+            await finish[app.name].wait()
+            events.append(f"finish {app.name} {app.values['environment']['VERSION']}")
+            return {"app_name": app.name, "exit_code": 0, "output": "", "slack_message": ""}
+
+        with (
+            patch.object(Deployer, "update_app_deployment", update_app_deployment),
+            patch("gitops_server.workers.deployer.deploy.post_init_summary"),
+            patch("gitops_server.workers.deployer.deploy.post_result_summary"),
+        ):
+            deploys = [
+                asyncio.create_task(make_deployer("1", "2", "app-1", scheduler=scheduler, app_locks=locks).deploy()),
+                asyncio.create_task(make_deployer("1", "2", "app-2", scheduler=scheduler, app_locks=locks).deploy()),
+                asyncio.create_task(make_deployer("2", "3", "app-1", scheduler=scheduler, app_locks=locks).deploy()),
+            ]
+            finish["app-2"].set()
+            await deploys[1]
+            assert events == ["start app-1 2", "start app-2 2", "finish app-2 2"]
+
+            finish["app-1"].set()
+            await asyncio.gather(*deploys)
+
+        assert events[3:] == ["finish app-1 2", "start app-1 3", "finish app-1 3"]
+
+    @pytest.mark.parametrize(
+        "skip_migrations, installed",
+        [
+            ((False, False, False), ["2", "4"]),
+            # The superseding deploy would skip migrations the skipped one needs.
+            ((False, False, True), ["2", "3", "4"]),
+        ],
+    )
+    async def test_superseded_deploys_are_skipped(self, skip_migrations, installed):
+        locks = AppLocks()
+        installing = asyncio.Event()
+        finish = asyncio.Event()
+        versions = []
+
+        async def run(command, suppress_errors=False):
+            if command.startswith("helm secrets upgrade"):
+                with open(command.split(" -f ")[1].split()[0]) as f:
+                    versions.append(json.load(f)["environment"]["VERSION"])
+                installing.set()
+                await finish.wait()
+            return {"exit_code": 0, "output": ""}
+
+        async def get_helm_chart(chart):
+            return chart.helm_chart
+
+        with (
+            patch.object(deploy, "run", run),
+            patch.object(deploy, "get_helm_chart", get_helm_chart),
+            patch.object(deploy, "post_result"),
+            patch("gitops_server.utils.slack.post") as post_mock,
+        ):
+            deployers = [
+                make_deployer(str(version), str(version + 1), "app-1", skip_migrations=skip, app_locks=locks)
+                for version, skip in zip(range(1, 4), skip_migrations, strict=True)
+            ]
+            first = asyncio.create_task(deployers[0].deploy())
+            await installing.wait()
+            # The first deploy is installing, so is left to finish.
+            later = [asyncio.create_task(deployer.deploy()) for deployer in deployers[1:]]
+            await asyncio.sleep(0)
+            finish.set()
+            await asyncio.gather(first, *later)
+
+        assert versions == installed
+        summaries = [call[0][0] for call in post_mock.call_args_list if "results summary" in call[0][0]]
+        assert len(summaries) == 3
+        assert ("superseded" in summaries[1]) == (installed == ["2", "4"])
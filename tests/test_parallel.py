@@ -0,0 +1,108 @@
+import pytest
+
+import gitops.utils.apps as apps
+from gitops.common import parallel, utils
+from gitops.utils import tag_index
+from gitops_server import types
+
+
+def square(value):
+    return value * value
+
+
+def get_account_id():
+    return "UNKNOWN"
+
+
+def chunk_sizes(chunk):
+    return [(item, len(chunk)) for item in chunk]
+
+
+def fail_on_three(value):
+    if value == 3:
+        raise ValueError("three")
+    return value
+
+
+class TestParallelMap:
+    def test_results_are_returned_in_order(self):
+        assert parallel.parallel_map(square, range(20), workers=3, threshold=0) == [i * i for i in range(20)]
+
+    def test_exceptions_are_reraised(self):
+        with pytest.raises(ValueError, match="three"):
+            parallel.parallel_map(fail_on_three, range(10), workers=3, threshold=0)
+
+    def test_small_inputs_are_processed_serially(self, monkeypatch):
+        monkeypatch.setattr(parallel, "ProcessPoolExecutor", None)
+        assert parallel.parallel_map(square, range(5), workers=3, threshold=10) == [0, 1, 4, 9, 16]
+
+    def test_chunks_are_mapped_in_order(self):
+        results = parallel.parallel_map_chunks(chunk_sizes, range(24), workers=2, threshold=0)
+        assert results == [(i, 3) for i in range(24)]
+        assert parallel.parallel_map_chunks(chunk_sizes, range(5), workers=2) == [(i, 5) for i in range(5)]
+
+
+class TestParallelGetApps:
+    @pytest.fixture
+    def apps_directory(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(apps, "get_apps_directory", lambda: tmp_path)
+        monkeypatch.setattr(apps, "get_account_id", get_account_id)
+        for i in range(12):
+            (tmp_path / f"app-{i:02}").mkdir()
+            (tmp_path / f"app-{i:02}" / "deployment.yml").write_text(
+                f"namespace: test\nchart: test\ncluster: cluster-{i % 2}\n"
+            )
+            (tmp_path / f"app-{i:02}" / "secrets.yml").write_text("secrets:\n  KEY: value\n")
+        return tmp_path
+
+    def test_parallel_and_serial_loading_agree(self, apps_directory, monkeypatch):
+        serial = apps.get_apps(filter="cluster-1", mode="SILENT")
+        monkeypatch.setattr(parallel, "PARALLEL_THRESHOLD", 0)
+        monkeypatch.setenv("GITOPS_LOAD_WORKERS", "3")
+        parallel_apps = apps.get_apps(filter="cluster-1", mode="SILENT")
+
+        assert [app.name for app in parallel_apps] == ["app-01", "app-03", "app-05", "app-07", "app-09", "app-11"]
+        assert parallel_apps == serial
+
+    def test_base_files_are_parsed_once_per_chunk_in_workers(self, tmp_path, monkeypatch):
+        (tmp_path / "base.yml").write_text("namespace: test\nchart: test\n")
+        for i in range(24):
+            (tmp_path / f"app-{i:02}").mkdir()
+            (tmp_path / f"app-{i:02}" / "deployment.yml").write_text(f"extends: ../base.yml\ncluster: cluster-{i}\n")
+        parses = tmp_path / "parses"
+        parses.touch()
+        safe_load = utils.safe_load
+
+        def counting_safe_load(content):
+            # Worker processes are forked, so they record their parses in a file.
+            with open(parses, "a") as f:
+                f.write(f"{content.decode().splitlines()[0]}\n")
+            return safe_load(content)
+
+        monkeypatch.setattr(utils, "safe_load", counting_safe_load)
+        monkeypatch.setenv("GITOPS_DISABLE_CACHE", "1")
+        monkeypatch.setenv("GITOPS_LOAD_WORKERS", "2")
+        monkeypatch.setattr(parallel, "PARALLEL_THRESHOLD", 0)
+        tag_index.load_tag_index(tmp_path, [f"app-{i:02}" for i in range(24)])
+
+        # 24 apps over 2 workers go in chunks of 3.
+        assert parses.read_text().splitlines().count("namespace: test") == 8
+
+
+@pytest.mark.asyncio
+class TestServerAppLoading:
+    async def test_apps_are_loaded_in_a_long_lived_pool_without_forking(self, tmp_path, monkeypatch):
+        for i in range(6):
+            (tmp_path / "apps" / f"app-{i}").mkdir(parents=True)
+            (tmp_path / "apps" / f"app-{i}" / "deployment.yml").write_text("namespace: test\nchart: test\n")
+            (tmp_path / "apps" / f"app-{i}" / "secrets.yml").write_text("secrets: {}\n")
+        monkeypatch.setattr(parallel, "PARALLEL_THRESHOLD", 0)
+        monkeypatch.setenv("GITOPS_LOAD_WORKERS", "2")
+
+        loaded = await types.load_apps_in_background(types.get_app_entries(str(tmp_path)))
+
+        assert [app.name for app in loaded] == [f"app-{i}" for i in range(6)]
+        assert loaded == types.load_apps(types.get_app_entries(str(tmp_path)))
+        loader = types.get_app_loader()
+        assert loader is types.get_app_loader()
+        assert loader._mp_context.get_start_method() != "fork"
@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+from gitops.common.app import App
+from gitops_server.workers.deployer.scheduler import DeployScheduler, parse_tag_values
+
+PRIORITIES = {"production": 8, "default": 4, "sandbox": 1}
+
+
+def make_app(name, *tags):
+    return App(
+        name,
+        deployments={
+            "chart": "https://github.com/uptick/workforce",
+            "namespace": "mynamespace",
+            "cluster": "test-cluster",
+            "tags": list(tags),
+        },
+    )
+
+
+class TestParseTagValues:
+    def test_tag_values_are_parsed(self):
+        assert parse_tag_values("production=8, sandbox=1,") == {"production": 8, "sandbox": 1}
+        assert parse_tag_values("") == {}
+
+    @pytest.mark.parametrize("value", ["production", "production=high", "production=0", "=1"])
+    def test_invalid_values_are_rejected(self, value):
+        with pytest.raises(ValueError, match="Expected a tag and a positive number"):
+            parse_tag_values(value)
+
+
+@pytest.mark.asyncio
+class TestDeployScheduler:
+    async def install(self, scheduler, app, installed, finish=None):
+        async with scheduler.slot(app):
+            installed.append(app.name)
+            if finish:
+                await finish.wait()
+
+    async def test_higher_priorities_go_first_without_starving_others(self):
+        scheduler = DeployScheduler(1, PRIORITIES, quotas={})
+        installed = []
+        finish = asyncio.Event()
+        first = asyncio.create_task(self.install(scheduler, make_app("p0", "production"), installed, finish))
+        await asyncio.sleep(0)
+
+        apps = [
+            make_app("s1", "sandbox", "preview"),
+            make_app("d1"),
+            make_app("p1", "production", "sandbox"),
+            make_app("p2", "production"),
+            make_app("p3", "production"),
+        ]
+        installs = [asyncio.create_task(self.install(scheduler, app, installed)) for app in apps]
+        await asyncio.sleep(0)
+        finish.set()
+        await asyncio.gather(first, *installs)
+
+        assert installed == ["p0", "p1", "p2", "d1", "p3", "s1"]
+
+    async def test_tag_quotas_are_kept_to(self):
+        scheduler = DeployScheduler(3, PRIORITIES, quotas={"preview": 1})
+        installed = []
+        finish = asyncio.Event()
+        installs = [
+            asyncio.create_task(self.install(scheduler, make_app(name, *tags), installed, finish))
+            for name, tags in [("a", ["preview"]), ("b", ["preview"]), ("c", [])]
+        ]
+        await asyncio.sleep(0)
+        assert installed == ["a", "c"]
+
+        finish.set()
+        await asyncio.gather(*installs)
+        assert installed == ["a", "c", "b"]
+        assert scheduler.free == 3
+
+    async def test_cancelled_waits_give_up_their_place(self):
+        scheduler = DeployScheduler(1, PRIORITIES, quotas={})
+        installed = []
+        finish = asyncio.Event()
+        first = asyncio.create_task(self.install(scheduler, make_app("a"), installed, finish))
+        cancelled = asyncio.create_task(self.install(scheduler, make_app("b"), installed))
+        last = asyncio.create_task(self.install(scheduler, make_app("c"), installed))
+        await asyncio.sleep(0)
+
+        cancelled.cancel()
+        finish.set()
+        await asyncio.gather(first, last)
+
+        assert installed == ["a", "c"]
+        assert scheduler.free == 1
+        assert scheduler.waiting == {}
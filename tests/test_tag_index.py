@@ -0,0 +1,126 @@
+import pytest
+
+import gitops.utils.apps as apps
+from gitops.utils import cache, tag_index
+from gitops.utils.exceptions import InvalidFilterExpression
+from gitops.utils.tag_index import FilterExpression, TagIndex
+
+APP_TAGS = {
+    "alpha": ["customer", "production"],
+    "bravo": ["customer", "sandbox"],
+    "charlie": ["internal", "production", "inactive"],
+    "delta": ["internal", "production"],
+    "echo": ["sandbox"],
+}
+
+
+@pytest.fixture
+def index():
+    return TagIndex.from_app_tags(APP_TAGS)
+
+
+def select(index, expression):
+    return index.get_names(FilterExpression(expression)(index))
+
+
+class TestFilterExpression:
+    @pytest.mark.parametrize(
+        "expression,expected",
+        [
+            ("", ["alpha", "bravo", "charlie", "delta", "echo"]),
+            ("production", ["alpha", "charlie", "delta"]),
+            ("customer,production", ["alpha"]),
+            ("customer&production", ["alpha"]),
+            ("customer|internal", ["alpha", "bravo", "charlie", "delta"]),
+            ("!production", ["bravo", "echo"]),
+            ("(customer|internal)&production&!inactive", ["alpha", "delta"]),
+            ("customer|internal&production", ["alpha", "bravo", "charlie", "delta"]),
+            ("!!sandbox", ["bravo", "echo"]),
+            ("unknown", []),
+        ],
+    )
+    def test_expressions_select_matching_apps(self, index, expression, expected):
+        assert select(index, expression) == expected
+
+    def test_tags_are_collected(self):
+        assert FilterExpression("(customer|internal)&production&!inactive").tags == {
+            "customer",
+            "internal",
+            "production",
+            "inactive",
+        }
+
+    @pytest.mark.parametrize("expression", ["(customer", "customer|", "customer)", "&production", "!"])
+    def test_invalid_expressions_are_rejected(self, expression):
+        with pytest.raises(InvalidFilterExpression):
+            FilterExpression(expression)
+
+
+class TestGetAppsWithTagIndex:
+    @pytest.fixture
+    def apps_directory(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(apps, "get_apps_directory", lambda: tmp_path)
+        monkeypatch.setattr(apps, "get_account_id", lambda: "UNKNOWN")
+        for name, tags in APP_TAGS.items():
+            (tmp_path / name).mkdir()
+            (tmp_path / name / "deployment.yml").write_text(
+                f"namespace: test\nchart: test\ncluster: test\ntags: [{', '.join(tags)}]\n"
+            )
+            (tmp_path / name / "secrets.yml").write_text("secrets: {}\n")
+        return tmp_path
+
+    def test_only_selected_apps_are_loaded(self, apps_directory, monkeypatch):
+        loaded = []
+        get_app_details = apps.get_app_details
+
+        def counting_get_app_details(app_name, **kwargs):
+            loaded.append(app_name)
+            return get_app_details(app_name, **kwargs)
+
+        monkeypatch.setattr(apps, "get_app_details", counting_get_app_details)
+        selected = apps.get_apps(filter="(customer|internal)&production", mode="SILENT")
+
+        assert [app.name for app in selected] == ["alpha", "delta"]
+        assert loaded == ["alpha", "delta"]
+
+    def test_exclude_and_inactive_are_applied(self, apps_directory):
+        selected = apps.get_apps(filter="production", exclude="alpha", mode="SILENT")
+        assert [app.name for app in selected] == ["delta"]
+
+        selected = apps.get_apps(filter="production", autoexclude_inactive=False, mode="SILENT")
+        assert [app.name for app in selected] == ["alpha", "charlie", "delta"]
+
+    def test_unknown_tags_are_rejected(self, apps_directory):
+        with pytest.raises(Exception, match="Unrecognised tags: unknown"):
+            apps.get_apps(filter="customer|unknown", mode="SILENT")
+
+    def test_an_unusable_cache_directory_is_ignored(self, apps_directory, tmp_path, monkeypatch):
+        (tmp_path / "not-a-directory").write_text("")
+        monkeypatch.setenv("GITOPS_CACHE_DIR", str(tmp_path / "not-a-directory" / "gitops"))
+
+        selected = apps.get_apps(filter="production", mode="SILENT")
+        assert [app.name for app in selected] == ["alpha", "delta"]
+
+    def test_persisted_index_is_reused_until_an_app_changes(self, apps_directory, monkeypatch):
+        parsed = []
+        load_app_tags = tag_index.load_app_tags
+
+        def counting_load_app_tags(directory, app_name):
+            parsed.append(app_name)
+            return load_app_tags(directory, app_name)
+
+        monkeypatch.setattr(tag_index, "load_app_tags", counting_load_app_tags)
+
+        # Files this fresh are never trusted by their stat information alone.
+        apps.get_apps(filter="sandbox", mode="SILENT")
+        apps.get_apps(filter="sandbox", mode="SILENT")
+        assert len(parsed) == 10
+
+        monkeypatch.setattr(cache, "RACY_MTIME_WINDOW_NS", 0)
+        apps.get_apps(filter="sandbox", mode="SILENT")
+        apps.get_apps(filter="sandbox", mode="SILENT")
+        assert len(parsed) == 15
+
+        (apps_directory / "alpha" / "deployment.yml").write_text("namespace: test\nchart: test\ntags: [sandbox]\n")
+        assert [app.name for app in apps.get_apps(filter="sandbox", mode="SILENT")] == ["alpha", "bravo", "echo"]
+        assert len(parsed) == 20
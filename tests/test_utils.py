@@ -1,6 +1,8 @@
 import yaml
 
 import gitops.utils.kube as kube
+from gitops.common.utils import safe_load
+from gitops.utils import yaml as gitops_yaml
 
 template = """
 apiVersion: batch/v1
@@ -169,3 +171,15 @@ spec:
         output = yaml.safe_load(rendered_template)
 
         assert expected == output
+
+
+class TestSafeLoad:
+    def test_safe_load_matches_the_pure_python_loader(self):
+        rendered_template = kube.render_template(
+            template, {"name": "name", "app": "app", "image": "image", "command": "[]"}
+        )
+        assert safe_load(rendered_template) == yaml.load(rendered_template, Loader=yaml.SafeLoader)  # noqa: S506
+
+    def test_dump_keeps_indented_dashed_lists(self):
+        data = gitops_yaml.safe_load("b:\n  - 1\n  - x:\n      - 2\na:\n  c: d\n")
+        assert gitops_yaml.dump(data, default_flow_style=False) == "b:\n  - 1\n  - x:\n      - 2\na:\n  c: d\n"
@@ -0,0 +1,246 @@
+import copy
+from unittest.mock import ANY, AsyncMock, patch
+
+import pytest
+
+from gitops_server import settings
+from gitops_server.workers.deployer import Deployer, deploy, hooks, worker
+from gitops_server.workers.deployer.worker import (
+    DeployQueueWorker,
+    get_push_changed_paths,
+    group_pushes,
+    is_relevant_push,
+    merge_pushes,
+)
+
+from .sample_data import SAMPLE_GITHUB_PAYLOAD
+from .utils import make_deployer, mock_get_changed_paths, mock_load_app_definitions
+
+URL = SAMPLE_GITHUB_PAYLOAD["repository"]["clone_url"]
+
+
+@pytest.fixture(autouse=True)
+def deploy_queue_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "deploy-queue.sqlite3")
+    monkeypatch.setattr(settings, "DEPLOY_QUEUE_PATH", path)
+    return path
+
+
+def make_push(*changes, **kwargs):
+    push = copy.deepcopy(SAMPLE_GITHUB_PAYLOAD)
+    push["commits"] = [{**push["commits"][0], "added": [], "removed": [], "modified": paths} for paths in changes]
+    push.update(kwargs)
+    return push
+
+
+class TestPushChangedPaths:
+    def test_paths_of_every_commit_are_collected(self):
+        push = make_push(["apps/app-1/deployment.yml"], ["README.md"])
+        push["commits"][1]["removed"] = ["apps/app-2/secrets.yml"]
+
+        assert get_push_changed_paths(push) == {"apps/app-1/deployment.yml", "README.md", "apps/app-2/secrets.yml"}
+
+    @pytest.mark.parametrize(
+        "push",
+        [
+            make_push(*[["README.md"]] * 20),
+            make_push(["README.md"], forced=True),
+            make_push(["README.md"], created=True),
+            make_push(["README.md"], []),
+            make_push(),
+        ],
+    )
+    def test_unreliable_payloads_fall_back(self, push):
+        assert get_push_changed_paths(push) is None
+
+
+def make_chain(*messages, start=0):
+    """Consecutive pushes, each changing its own app."""
+    pushes = []
+    for i, message in enumerate(messages, start):
+        push = make_push([f"apps/app-{i}/deployment.yml"], before=f"{i:040x}", after=f"{i + 1:040x}")
+        push["head_commit"] = {
+            **push["head_commit"],
+            "message": message,
+            "author": {"name": f"Author {i % 2}", "email": f"author-{i % 2}@example.com"},
+        }
+        pushes.append(push)
+    return pushes
+
+
+class TestCoalescing:
+    def test_consecutive_pushes_are_grouped(self):
+        first, second, third = make_chain("one", "two", "three")
+        other_branch = {**make_chain("four", start=3)[0], "ref": "refs/heads/develop"}
+        unrelated = make_chain("five", start=9)[0]
+
+        assert group_pushes([first, second, third, other_branch, unrelated]) == [
+            [first, second, third],
+            [other_branch],
+            [unrelated],
+        ]
+
+    def test_merged_push_covers_every_push(self):
+        pushes = make_chain("one", "two", "three")
+        merged = merge_pushes(pushes)
+
+        assert (merged["before"], merged["after"]) == (pushes[0]["before"], pushes[-1]["after"])
+        assert len(merged["commits"]) == 3
+        assert merged["head_commit"]["author"] == pushes[-1]["head_commit"]["author"]
+        assert merged["authors"] == [
+            {"name": "Author 0", "email": "author-0@example.com"},
+            {"name": "Author 1", "email": "author-1@example.com"},
+        ]
+        assert merged["head_commit"]["message"] == "one\n\ntwo\n\nthree"
+        assert merge_pushes(pushes[:1]) is pushes[0]
+
+    def test_migrations_are_only_skipped_if_every_push_asks(self):
+        assert not merge_pushes(make_chain("one --skip-migrations", "two"))["skip_migrations"]
+        assert merge_pushes(make_chain("one --skip-migrations", "two --skip-migrations"))["skip_migrations"]
+
+    @pytest.mark.asyncio
+    async def test_failed_merged_deploys_are_put_to_the_last_author(self):
+        pushes = make_chain("one", "two", "three")
+        pushes[0]["head_commit"]["author"] = {"name": "Devops", "email": "devops@example.com"}
+        with (
+            patch.object(deploy, "load_app_definitions", mock_load_app_definitions),
+            patch.object(deploy, "get_changed_paths", mock_get_changed_paths),
+        ):
+            deployer = await Deployer.from_push_event(merge_pushes(pushes))
+        assert deployer.authors == ["Devops", "Author 1", "Author 0"]
+
+        app = deployer.current_app_definitions.apps["sample-app-1"]
+        result = {"app_name": app.name, "exit_code": 1, "output": "Failed", "slack_message": ""}
+        with patch.object(hooks, "find_commiter_slack_user", new_callable=AsyncMock) as find_user:
+            find_user.return_value = None
+            await hooks.handle_failed_deploy(app, result, deployer)
+
+        find_user.assert_called_once_with(name="Author 0", email="author-0@example.com")
+
+
+class TestRelevantPush:
+    @pytest.fixture(autouse=True)
+    def extends_bases(self, monkeypatch):
+        bases = {}
+        monkeypatch.setattr(worker, "EXTENDS_BASES", bases)
+        return bases
+
+    def test_app_changes_are_relevant(self):
+        assert is_relevant_push(URL, {"README.md", "apps/app-1/deployment.yml"})
+        assert not is_relevant_push(URL, {"README.md", "docs/deploying.md"})
+
+    def test_any_yaml_might_be_a_base_until_bases_are_known(self, extends_bases):
+        assert is_relevant_push(URL, {".github/workflows/ci.yml"})
+
+        extends_bases[URL] = {"apps/base.yml"}
+        assert not is_relevant_push(URL, {".github/workflows/ci.yml"})
+        assert is_relevant_push(URL, {"apps/base.yml"})
+
+
+@pytest.mark.asyncio
+class TestProcessWork:
+    @pytest.fixture(autouse=True)
+    def extends_bases(self, monkeypatch):
+        monkeypatch.setattr(worker, "EXTENDS_BASES", {URL: set()})
+
+    async def process(self, push):
+        queue_worker = DeployQueueWorker()
+        await queue_worker.enqueue(push)
+        with patch.object(worker.Deployer, "from_push_event", new_callable=AsyncMock) as from_push_event:
+            await queue_worker.process_work()
+            await queue_worker.wait_for_deploys()
+        return from_push_event
+
+    async def test_irrelevant_pushes_are_skipped(self):
+        from_push_event = await self.process(make_push(["README.md"], [".github/workflows/ci.yml"]))
+
+        from_push_event.assert_not_called()
+
+    async def test_relevant_pushes_are_deployed_with_their_changed_paths(self):
+        push = make_push(["apps/app-1/deployment.yml"])
+        from_push_event = await self.process(push)
+
+        from_push_event.assert_called_once_with(
+            push, changed_paths={"apps/app-1/deployment.yml"}, scheduler=ANY, app_locks=ANY, progress=ANY
+        )
+
+    async def test_truncated_pushes_are_deployed_in_full(self):
+        push = make_push(*[["README.md"]] * 20)
+        from_push_event = await self.process(push)
+
+        from_push_event.assert_called_once_with(push, changed_paths=None, scheduler=ANY, app_locks=ANY, progress=ANY)
+
+    async def test_queued_pushes_are_deployed_together(self):
+        queue_worker = DeployQueueWorker()
+        pushes = make_chain("one", "two", "three")
+        for push in pushes:
+            await queue_worker.enqueue(push)
+        with patch.object(worker.Deployer, "from_push_event", new_callable=AsyncMock) as from_push_event:
+            await queue_worker.process_work()
+            await queue_worker.wait_for_deploys()
+
+        from_push_event.assert_called_once_with(
+            merge_pushes(pushes),
+            changed_paths={f"apps/app-{i}/deployment.yml" for i in range(3)},
+            scheduler=ANY,
+            app_locks=ANY,
+            progress=ANY,
+        )
+        assert queue_worker.queue.empty()
+
+
+@pytest.mark.asyncio
+class TestDurableQueue:
+    @pytest.fixture(autouse=True)
+    def extends_bases(self, monkeypatch):
+        monkeypatch.setattr(worker, "EXTENDS_BASES", {URL: set()})
+
+    async def test_pushes_are_resumed_after_a_restart(self):
+        queue_worker = DeployQueueWorker()
+        pushes = make_chain("one", "two")
+        for push in pushes:
+            await queue_worker.enqueue(push)
+        # One app was deployed before the restart.
+        push_ids = [push_id for push_id, _ in queue_worker.journal.get_pushes()]
+        queue_worker.journal.get_progress(push_ids).complete_app("app-0", {"exit_code": 0})
+
+        queue_worker = DeployQueueWorker()
+        assert queue_worker.queue.qsize() == 2
+        with patch.object(worker.Deployer, "from_push_event", new_callable=AsyncMock) as from_push_event:
+            await queue_worker.process_work()
+            await queue_worker.wait_for_deploys()
+
+        from_push_event.assert_called_once()
+        assert from_push_event.call_args[0][0] == merge_pushes(pushes)
+        assert from_push_event.call_args[1]["progress"].completed_apps == {"app-0"}
+        assert queue_worker.journal.get_pushes() == []
+
+    async def test_apps_are_only_completed_for_pushes_deployed_together(self):
+        journal = DeployQueueWorker().journal
+        first, second = (journal.add_push(push) for push in make_chain("one", "two"))
+        journal.get_progress([first]).complete_app("app-0", {"exit_code": 0})
+        journal.get_progress([first, second]).complete_app("app-1", {"exit_code": 1})
+
+        assert journal.get_progress([first]).completed_apps == {"app-0", "app-1"}
+        assert journal.get_progress([first, second]).completed_apps == {"app-1"}
+
+    async def test_completed_apps_are_not_deployed_again(self):
+        journal = DeployQueueWorker().journal
+        push_id = journal.add_push(make_push(["apps/app-1/deployment.yml"]))
+        journal.get_progress([push_id]).complete_app("app-1", {"exit_code": 0})
+        deployed = []
+
+        async def update_app_deployment(self, app):
+            deployed.append(app.name)
+            return {"app_name": app.name, "exit_code": 0, "output": "", "slack_message": ""}
+
+        with (
+            patch.object(Deployer, "update_app_deployment", update_app_deployment),
+            patch("gitops_server.workers.deployer.deploy.post_init_summary"),
+            patch("gitops_server.workers.deployer.deploy.post_result_summary"),
+        ):
+            deployer = make_deployer("1", "2", "app-1", "app-2", progress=journal.get_progress([push_id]))
+            await deployer.deploy()
+
+        assert deployed == ["app-2"]
+        assert journal.get_progress([push_id]).completed_apps == {"app-1", "app-2"}
@@ -0,0 +1,103 @@
+from textwrap import dedent
+
+import pytest
+
+from gitops.utils import yaml
+from gitops.utils.yaml_patch import patch_top_level_keys
+
+DEPLOYMENT = dedent(
+    """\
+    # Managed by gitops
+    namespace: workforce
+    chart: https://github.com/uptick/workforce
+    image-tag: qa-server-aaaa  # bumped automatically
+
+    tags:
+      - customer
+      - production
+    environment:
+      DEBUG: 'false'
+      NAME: "quoted the other way"
+    containers:
+      fg:
+        replicas: 2
+    """
+)
+
+
+class TestPatchTopLevelKeys:
+    def test_only_changed_keys_are_rewritten(self):
+        patched = patch_top_level_keys(DEPLOYMENT, {"image-tag": "qa-server-bbbb"}, set())
+
+        assert patched == DEPLOYMENT.replace(
+            "image-tag: qa-server-aaaa  # bumped automatically", "image-tag: qa-server-bbbb"
+        )
+
+    def test_collections_are_rewritten_as_a_full_dump_would(self):
+        patched = patch_top_level_keys(DEPLOYMENT, {"tags": ["customer", "sandbox"], "environment": {"A": "b"}}, set())
+
+        assert patched == DEPLOYMENT.replace("- production", "- sandbox").replace(
+            "  DEBUG: 'false'\n  NAME: \"quoted the other way\"\n", "  A: b\n"
+        )
+        assert yaml.safe_load(patched)["containers"] == {"fg": {"replicas": 2}}
+
+    def test_keys_are_added_and_removed(self):
+        patched = patch_top_level_keys(DEPLOYMENT, {"cluster": "eks-prod"}, {"environment", "missing"})
+
+        assert "environment" not in patched
+        assert "# Managed by gitops\n" in patched
+        assert patched.endswith("    replicas: 2\ncluster: eks-prod\n")
+        assert yaml.safe_load(patched) == {
+            **{k: v for k, v in yaml.safe_load(DEPLOYMENT).items() if k != "environment"},
+            "cluster": "eks-prod",
+        }
+
+    def test_last_key_without_trailing_newline(self):
+        assert patch_top_level_keys("namespace: a\ncluster: b", {"cluster": "c"}, set()) == "namespace: a\ncluster: c\n"
+        assert patch_top_level_keys("namespace: a", {"cluster": "c"}, set()) == "namespace: a\ncluster: c\n"
+
+    @pytest.mark.parametrize(
+        "text",
+        [
+            "{namespace: a, cluster: b}\n",
+            "---\nnamespace: a\ncluster: b\n",
+            "namespace: a\ncluster: b\n...\n",
+            "base: &base\n  a: b\nenvironment: *base\ncluster: b\n",
+            "namespace: a\ncluster: |\n  b\n",
+            "'cluster': b\n",
+            "cluster: a\ncluster: b\n",
+            "cluster: b\n",
+            "- a\n- b\n",
+            "cluster: [\n",
+        ],
+    )
+    def test_unusual_documents_fall_back_to_a_full_dump(self, text):
+        assert patch_top_level_keys(text, {}, {"cluster"}) is None
+
+
+class TestUpdateApp:
+    def test_unchanged_lines_and_comments_are_kept(self, tmp_path, monkeypatch):
+        from gitops.utils import apps
+
+        monkeypatch.setattr(apps, "get_apps_directory", lambda: tmp_path)
+        (tmp_path / "app").mkdir()
+        path = tmp_path / "app" / "deployment.yml"
+        path.write_text(DEPLOYMENT)
+
+        apps.update_app("app", **{"image-tag": "qa-server-bbbb", "environment": {}})
+
+        assert path.read_text() == DEPLOYMENT.replace(
+            "image-tag: qa-server-aaaa  # bumped automatically", "image-tag: qa-server-bbbb"
+        ).replace("environment:\n  DEBUG: 'false'\n  NAME: \"quoted the other way\"\n", "")
+
+    def test_flow_style_documents_are_dumped_in_full(self, tmp_path, monkeypatch):
+        from gitops.utils import apps
+
+        monkeypatch.setattr(apps, "get_apps_directory", lambda: tmp_path)
+        (tmp_path / "app").mkdir()
+        path = tmp_path / "app" / "deployment.yml"
+        path.write_text("{namespace: a, cluster: b}\n")
+
+        apps.update_app("app", cluster="c")
+
+        assert path.read_text() == "namespace: a\ncluster: c\n"
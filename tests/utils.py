@@ -1,12 +1,22 @@
+import asyncio
+import os
+import tempfile
+from contextlib import asynccontextmanager
 from typing import Any
 
 import yaml
 
 from gitops.common.app import App
 from gitops_server.types import AppDefinitions
+from gitops_server.utils import run
+from gitops_server.workers.deployer import Deployer
 
 
-async def mock_load_app_definitions(url, sha):
+async def mock_get_changed_paths(url, before, after):
+    return None
+
+
+async def mock_load_app_definitions(url, sha, **kwargs):
     # Set different fg amounts for different sha's to mock a change to app_definitions
     if sha == "bef04e58a0001234567890123456789012345678":
         fg = 4
@@ -57,6 +67,76 @@ def create_test_yaml(fg=4, bg=2, **kwargs: Any):
     return "/tmp/"
 
 
+@asynccontextmanager
+async def make_dummy_repo():
+    with tempfile.TemporaryDirectory() as temporary_folder_path:
+        if os.environ.get("CI"):
+            await run("git config --global user.email 'you@example.com'")
+            await run("git config --global user.name 'Your Name'")
+            await run("git config --global init.defaultBranch main")
+        await run("git init", cwd=temporary_folder_path)
+        for _ in range(10):
+            await run("git commit -m 'temporary commit' --allow-empty", cwd=temporary_folder_path)
+        await run("git checkout -b 'test'", cwd=temporary_folder_path)
+        for _ in range(10):
+            await run("git commit -m 'temporary commit' --allow-empty", cwd=temporary_folder_path)
+        await run("git checkout main", cwd=temporary_folder_path)
+        yield temporary_folder_path
+
+
+class StubPrepare:
+    def __init__(self):
+        self.calls = []
+        self.fail = False
+        self.started = asyncio.Event()
+        self.release = asyncio.Event()
+        self.release.set()
+
+    async def __call__(self, url, sha, path):
+        self.calls.append((url, sha))
+        self.started.set()
+        await self.release.wait()
+        if self.fail:
+            raise Exception("Could not build chart")
+        with open(os.path.join(path, "Chart.yaml"), "w") as f:
+            f.write(f"name: {sha}\n")
+
+
+def make_apps(version, *names):
+    return AppDefinitions(
+        "mock-repo",
+        {
+            name: App(
+                name,
+                deployments={
+                    "chart": {
+                        "type": "helm",
+                        "helm_repo": "brigade",
+                        "helm_repo_url": "https://helm.charts",
+                        "helm_chart": "brigade/brigade",
+                    },
+                    "namespace": "mynamespace",
+                    "cluster": "test-cluster",
+                    "environment": {"VERSION": version},
+                },
+            )
+            for name in names
+        },
+    )
+
+
+def make_deployer(before, after, *names, skip_migrations=False, **kwargs):
+    return Deployer(
+        "Author",
+        "author@example.com",
+        "message",
+        make_apps(after, *names),
+        make_apps(before, *names),
+        skip_migrations=skip_migrations,
+        **kwargs,
+    )
+
+
 # def create_test_kubeconfig():
 #     data = {
 #         'apiVersion': 'v1',